@@ -0,0 +1,72 @@
+"""
+Measures the startup import cost of every dkmonitor subcommand
+Each subcommand is run with --help under 'python -X importtime' in an empty
+directory, the script prints the total import time, the number of imported
+modules, the wall time and the slowest top level imports of each subcommand
+
+USAGE: python benchmarks/import_time.py [--repeat N] [--top N] [subcommand ...]
+"""
+
+import argparse, os, subprocess, sys, tempfile, time
+
+SUBCOMMANDS = ("run", "view", "task", "database", "restore")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_importtime(output):
+    """
+    Parses the stderr of python -X importtime
+
+    INPUT: stderr text
+    OUTPUT: (total cumulative us of top level imports, module count, list of (us, module))
+    """
+    total = 0
+    module_count = 0
+    top_level = []
+    for line in output.splitlines():
+        if (line.startswith("import time:") is False) or ("[us]" in line):
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|", 2)
+        module_count += 1
+        if module.startswith("  ") is False: #Nested imports are indented
+            total += int(cumulative)
+            top_level.append((int(cumulative), module.strip()))
+    return total, module_count, sorted(top_level, reverse=True)
+
+def measure(subcommand, work_dir):
+    """Runs one subcommand with --help and returns (wall seconds, parsed importtime output)"""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-m", "dkmonitor",
+                             subcommand, "--help"],
+                            cwd=work_dir, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    return time.perf_counter() - start_time, parse_importtime(result.stderr)
+
+def main(args=None):
+    """Benchmark command line interface"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description="Import time of every dkmonitor subcommand")
+    parser.add_argument("subcommands", nargs="*", default=list(SUBCOMMANDS),
+                        help="Subcommands to measure (default: all)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per subcommand, the fastest run is reported")
+    parser.add_argument("--top", type=int, default=5,
+                        help="Number of slowest top level imports to list")
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as work_dir: #Nothing may be written to the cwd
+        for subcommand in args.subcommands:
+            runs = [measure(subcommand, work_dir) for _ in range(max(1, args.repeat))]
+            wall_time, (total, module_count, top_level) = min(runs, key=lambda run: run[1][0])
+            print("{:<9} imports {:8.1f} ms  modules {:4d}  wall {:8.1f} ms".format(
+                subcommand, total / 1000, module_count, wall_time * 1000))
+            for cumulative, module in top_level[:args.top]:
+                print("          {:8.1f} ms  {}".format(cumulative / 1000, module))
+            leftovers = os.listdir(work_dir)
+            if leftovers:
+                print("          files created at startup: {}".format(", ".join(leftovers)))
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,17 @@
 This script runs the main commandline interface for dkmonitor
 """
 
-import argparse
+import argparse, importlib
 
-import sys, os
-sys.path.append(os.path.abspath(".."))
+import sys
 
-from dkmonitor.monitor_manager import main as monitor_main
-from dkmonitor.config.task_manager import main as task_main
-from dkmonitor.stat_viewer import main as admin_main
-from dkmonitor.database_manager import main as data_main
+#Module whose main runs each subcommand, imported only when the subcommand is used
+#so a cron run of 'run' never loads the viewer and 'task list' never loads the scanners
+SUBCOMMANDS = {"run": "dkmonitor.monitor_manager",
+               "view": "dkmonitor.stat_viewer",
+               "task": "dkmonitor.config.task_manager",
+               "database": "dkmonitor.database_manager",
+               "restore": "dkmonitor.restore_manager"}
 
 def description():
     """Returns the description string for command line interface"""
@@ -20,13 +22,14 @@ def description():
 def main(args=None):
     """Run the main Commandline interface for Dkmonitor"""
     if args is None:
-        if (sys.argv[1] == "-h") or (sys.argv[1] == "--help"):
+        if (len(sys.argv) > 1) and ((sys.argv[1] == "-h") or (sys.argv[1] == "--help")):
             print(description())
             print("""USAGE:
        run      -- Task running interface
        view     -- Database stat viewing interface
        task     -- Task manager interface
-       database -- Database manager interface""")
+       database -- Database manager interface
+       restore  -- Restore relocated files from the clean journal""")
             sys.exit(1)
         args = sys.argv[1:]
 
@@ -34,34 +37,16 @@ def main(args=None):
 
     subparsers = parser.add_subparsers()
 
-    run_parser = subparsers.add_parser("run")
-    run_parser.set_defaults(which="run")
-
-    view_parser = subparsers.add_parser("view")
-    view_parser.set_defaults(which="view")
-
-    task_parser = subparsers.add_parser("task")
-    task_parser.set_defaults(which="task")
-
-    data_parser = subparsers.add_parser("database")
-    data_parser.set_defaults(which="database")
+    for subcommand in SUBCOMMANDS:
+        subcommand_parser = subparsers.add_parser(subcommand)
+        subcommand_parser.set_defaults(which=subcommand)
 
     try:
         parsed_arg = parser.parse_args([args[0]])
-        if parsed_arg.which == "run":
-            monitor_main(args[1:])
-        elif parsed_arg.which == "view":
-            admin_main(args[1:])
-        elif parsed_arg.which == "task":
-            task_main(args[1:])
-        elif parsed_arg.which == "database":
-            data_main(args[1:])
     except IndexError:
-        print("First argument required (run, view, task, database)", file=sys.stderr)
-    """
-    except TypeError:
-        parser.print_help()
-        """
+        print("First argument required (run, view, task, database, restore)", file=sys.stderr)
+        return
+    importlib.import_module(SUBCOMMANDS[parsed_arg.which]).main(args[1:])
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,116 @@
 """
-This module loads the settings.cfg file and parses the settings into a dict
+This module loads the settings.cfg file and parses the settings into a read only mapping
+Known settings are converted to the type in SETTINGS_SCHEMA and missing ones get its default.
+The parsed settings are cached per process and only parsed again when a settings file changes
 """
 
-import configparser
+import configparser, threading, logging
+from types import MappingProxyType
 
-import sys, os
-sys.path.append(os.path.abspath("../.."))
+import os
 
-from dkmonitor.utilities.log_setup import setup_logger
 
 class SettingsFileNotFoundError(Exception):
     """Error for when settings.cfg is not found"""
     def __init__(self, message):
         super(SettingsFileNotFoundError, self).__init__(message)
 
+class SettingsValueError(Exception):
+    """Error for when a setting can not be converted to its type"""
+    def __init__(self, message):
+        super(SettingsValueError, self).__init__(message)
+
+
+#(type, default) of every known setting, empty values get the default
+#Settings that are not in the schema are kept as strings (digit strings as ints)
+SETTINGS_SCHEMA = {
+    "DataBase_Settings": {"username": (str, ""),
+                          "password": (str, ""),
+                          "database": (str, ""),
+                          "hostname": (str, ""),
+                          "db_type": (str, ""),
+                          "pool_size": (int, 5),
+                          "pool_pre_ping": (bool, True),
+                          "create_tables": (bool, True)},
+    "DataBase_Cleaning_Settings": {"purge_database": (bool, False),
+                                   "purge_after_day_number": (int, None),
+                                   "hourly_purge_after_day_number": (int, None),
+                                   "daily_purge_after_day_number": (int, None),
+                                   "weekly_purge_after_day_number": (int, None),
+                                   "purge_interval": (int, 0),
+                                   "purge_chunk_size": (int, 10000),
+                                   "purge_time_budget": (int, 0)},
+    "Store_Settings": {"bulk_insert": (bool, False),
+                       "use_copy": (bool, False),
+                       "combine_tasks": (bool, False),
+                       "buffer_rows": (int, 10000)},
+    "Thread_Settings": {"thread_mode": (bool, False),
+                        "scan_threads": (int, 1),
+                        "scan_processes": (int, 0),
+                        "clean_threads": (int, 4),
+                        "copy_threads": (int, 4),
+                        "clean_queue_size": (int, 10000)},
+    "Scan_Settings": {"single_pass": (bool, False),
+                      "preload_users": (bool, False),
+                      "uid_cache_file": (str, None),
+                      "uid_cache_max_age": (int, 24),
+                      "incremental": (bool, False),
+                      "index_dir": (str, "~/.dkmonitor/index"),
+                      "checkpoint": (bool, False),
+                      "checkpoint_files": (int, 100000),
+                      "checkpoint_seconds": (int, 300),
+                      "checkpoint_max_age": (int, 24),
+                      "state_dir": (str, "~/.dkmonitor/state")},
+    "Cleaning_Settings": {"clean_target": (str, "all"),
+                          "max_clean_candidates": (int, 1000000),
+                          "usage_check_interval": (int, 1000),
+                          "large_file_size": (int, 268435456),
+                          "copy_chunk_size": (int, 67108864),
+                          "relocation_reserve": (int, 0),
+                          "capacity_check_interval": (int, 1000),
+                          "delete_batch_size": (int, 1000),
+                          "relocation_mode": (str, "move"),
+                          "archive_max_file_size": (int, 1048576),
+                          "archive_size": (int, 1073741824),
+                          "archive_compress_level": (int, 6),
+                          "archive_sync_files": (int, 1000),
+                          "journal": (bool, False),
+                          "journal_dir": (str, "~/.dkmonitor/journal"),
+                          "journal_sync_entries": (int, 1000),
+                          "journal_sync_seconds": (int, 5)},
+    "Email_Settings": {"user_postfix": (str, "")},
+    "Logging_Settings": {"log_file": (str, None),
+                         "log_level": (str, "info"),
+                         "module_levels": (str, ""),
+                         "log_format": (str, "text"),
+                         "max_bytes": (int, 1048576),
+                         "backup_count": (int, 5)}
+}
+
+SETTINGS_CACHE = {"stamp": None, "settings": None}
+CACHE_LOCK = threading.Lock()
+
 
-logger = setup_logger(__name__)
+#Plain logger, log_setup imports this module to read Logging_Settings
+logger = logging.getLogger(__name__)
+
+def settings_paths():
+    """Returns the settings files in the order load_settings looks for them"""
+    paths = ["/etc/dkmonitor.cfg", os.path.expanduser("~/.dkmonitor/settings.conf")]
+    if "DKM_CONF" in os.environ:
+        paths.append(os.path.join(os.environ["DKM_CONF"], "settings.cfg"))
+    return paths
+
+def settings_stamp():
+    """Returns the path, mtime and size of every settings file (None for missing files)"""
+    stamp = []
+    for path in settings_paths():
+        try:
+            file_stat = os.stat(path)
+            stamp.append((path, file_stat.st_mtime_ns, file_stat.st_size))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
 
 def load_settings():
     """Loads settings.cfg into a configparser object"""
@@ -37,19 +132,47 @@ def load_settings():
     return raw_settings
 
 def export_settings():
-    """Exports all settings as a dictionary"""
-    raw_settings = load_settings()
+    """
+    Exports all settings as a read only mapping of read only section mappings
+    The files are parsed again only when one of them was changed, created or removed
+    """
+    stamp = settings_stamp() #Taken before reading so a change while reading is seen next time
+    with CACHE_LOCK:
+        if SETTINGS_CACHE["stamp"] != stamp:
+            SETTINGS_CACHE["settings"] = parse_settings(load_settings())
+            SETTINGS_CACHE["stamp"] = stamp
+            logger.info("Settings loaded")
+        return SETTINGS_CACHE["settings"]
+
+def parse_settings(raw_settings):
+    """Converts a configparser object into read only section mappings with typed values"""
     formatted_settings = {}
+    for section, schema in SETTINGS_SCHEMA.items():
+        formatted_settings[section] = {field: default for field, (_, default) in schema.items()}
     for section in raw_settings.sections():
-        formatted_settings[section] = section_to_dict(raw_settings, section)
+        formatted_section = formatted_settings.setdefault(section, {})
+        schema = SETTINGS_SCHEMA.get(section, {})
+        for field, value in raw_settings.items(section):
+            formatted_section[field] = convert_setting(section, field, value, schema.get(field))
 
-    return formatted_settings
+    return MappingProxyType({section: MappingProxyType(values)
+                             for section, values in formatted_settings.items()})
 
-def section_to_dict(raw_settings, section):
-    """Converts each section of the settings file into a dictionary"""
-    formatted_section = dict(raw_settings.items(section))
-    for field in formatted_section.keys():
-        if formatted_section[field].isdigit():
-            formatted_section[field] = int(formatted_section[field])
+def convert_setting(section, field, value, field_schema):
+    """Converts one raw setting to the type of its schema entry"""
+    if field_schema is None:
+        return int(value) if value.isdigit() else value
 
-    return formatted_section
+    value_type, default = field_schema
+    value = value.strip()
+    if value == "":
+        return default
+    try:
+        if value_type is bool:
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        return value_type(value)
+    except (KeyError, ValueError):
+        message = "[{}] {} = '{}' is not a valid {}".format(section, field, value,
+                                                             value_type.__name__)
+        logger.error(message)
+        raise SettingsValueError(message)
@@ -5,10 +5,9 @@ This module deals with loading, modifying and displaying tasks
 import argparse, datetime, socket
 from sqlalchemy.exc import InvalidRequestError, DataError
 
-import sys, os
-sys.path.append(os.path.abspath("../.."))
+import sys
 
-from dkmonitor.database_manager import Tasks, DataBase
+from dkmonitor.database_manager import Tasks, DataBase, database_options
 from dkmonitor.config.settings_manager import export_settings
 from dkmonitor.utilities import log_setup
 
@@ -16,19 +15,15 @@ class TaskDataBase(DataBase):
     """An interface used to create, display, edit, remove, and list tasks"""
 
     def __init__(self, db_settings):
-        super().__init__(hostname=db_settings["hostname"],
-                         database=db_settings["database"],
-                         password=db_settings["password"],
-                         username=db_settings["username"],
-                         db_type=db_settings["db_type"])
+        super().__init__(**database_options(db_settings))
 
         self.logger = log_setup.setup_logger(__name__)
 
     def remove_task(self, taskname):
         """Removes a task forthe database"""
-        session = self.create_session()
-        if session.query(Tasks).filter(Tasks.taskname == taskname).delete() == 1:
-            session.commit()
+        with self.session_scope() as session:
+            deleted = session.query(Tasks).filter(Tasks.taskname == taskname).delete()
+        if deleted == 1:
             print("Task '{}' was deleted".format(taskname))
             self.logger.info("Task %s was deleted", taskname)
         else:
@@ -36,11 +31,11 @@ class TaskDataBase(DataBase):
 
     def update_column(self, taskname, column_name, update_value):
         """Changes a column value in an existing row"""
-        session = self.create_session()
         try:
-            if session.query(Tasks).filter(Tasks.taskname == taskname).\
-                                    update({column_name: update_value}) == 1:
-                session.commit()
+            with self.session_scope() as session:
+                updated = session.query(Tasks).filter(Tasks.taskname == taskname).\
+                                               update({column_name: update_value})
+            if updated == 1:
                 print("Task: '{task}', column: '{cname}' was set to {val}".format(task=taskname,
                                                                                   cname=column_name,
                                                                                   val=update_value))
@@ -57,14 +52,14 @@ class TaskDataBase(DataBase):
 
     def get_all_tasks(self):
         """Gets a list of all tasks"""
-        session = self.create_session()
-        tasks = session.query(Tasks).all()
+        with self.session_scope() as session:
+            tasks = session.query(Tasks).all()
         return tasks
 
     def get_task_info(self, taskname):
         """Gets a task row based on task name"""
-        session = self.create_session()
-        task = session.query(Tasks).filter(Tasks.taskname == taskname).all()
+        with self.session_scope() as session:
+            task = session.query(Tasks).filter(Tasks.taskname == taskname).all()
         task_info = {}
         try:
             task = task[0]
@@ -90,6 +85,7 @@ class TaskDataBase(DataBase):
         email_usage_warnings....: {email_usage_warnings}
         email_data_alterations..: {email_data_alterations}
         email_top_percent.......: {email_top_percent} %
+        scan_threads............: {scan_threads}
         enabled.................: {enabled}"""
 
         if task_info is not None:
@@ -99,8 +95,8 @@ class TaskDataBase(DataBase):
 
     def display_tasks(self):
         """Displays tasks nicely to the console"""
-        session = self.create_session()
-        tasks = [task for task in session.query(Tasks.taskname).distinct()]
+        with self.session_scope() as session:
+            tasks = [task for task in session.query(Tasks.taskname).distinct()]
         if tasks != []:
             print("Saved tasks:")
             for task in tasks:
@@ -122,7 +118,8 @@ def parse_create_command(args):
                      old_file_threshold=args.old_file_threshold,
                      email_usage_warnings=args.email_usage_warnings,
                      email_data_alterations=args.email_data_alterations,
-                     email_top_percent=args.email_top_percent)
+                     email_top_percent=args.email_top_percent,
+                     scan_threads=args.scan_threads)
     return new_task
 
 def creation_interface():
@@ -253,6 +250,7 @@ def create_quick_task(args):
                   "email_usage_warnings":args.email_usage_warnings,
                   "email_data_alterations":args.email_data_alterations,
                   "email_top_percent":args.email_top_percent,
+                  "scan_threads":None,
                   "enabled":True}
     return quick_task
 
@@ -335,6 +333,11 @@ def get_args(args):
                                        type=int,
                                        default=25,
                                        help="Percent of users to flag as top users")
+    create_command_parser.add_argument("--scan_threads",
+                                       dest="scan_threads",
+                                       type=int,
+                                       help=("Number of threads used to scan the target_path "
+                                             "(default: scan_threads in Thread_Settings)"))
     create_command_parser.add_argument("--disabled",
                                        action="store_true",
                                        help="Use this flag to disable the task you are creating")
@@ -390,6 +393,7 @@ def main(args=None):
         taskdb.update_column(args.ditaskname, "enabled", False)
     elif args.which == "edit":
         taskdb.update_column(args.edtaskname, args.column_name.lower(), args.update_value)
+    taskdb.close()
 
 if __name__ == "__main__":
     main()
@@ -2,18 +2,21 @@
 This module outlines the table objects and raw database interfaces for dkmonitor
 """
 
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, MetaData, Table, Index, inspect, select
 from sqlalchemy import Column, String, DateTime, BigInteger, Integer, Float, Boolean
+from sqlalchemy import func, and_, bindparam, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, aliased
 
-import datetime, argparse
+import datetime, argparse, threading, csv, io, sqlite3, time, socket, zlib
+import contextlib
+from contextlib import contextmanager
 
 import os, sys
-sys.path.append(os.path.abspath("../.."))
 
-from dkmonitor.emailer.email_obj import Email
 from dkmonitor.config.settings_manager import export_settings
+from dkmonitor.utilities import log_setup
 #from dkmonitor.utilities.dk_stat import get_disk_use_percent
 
 
@@ -22,7 +25,8 @@ Base = declarative_base()
 class StatObj(object):
     """Object used to keep disk usage stats"""
 
-    datetime = Column("datetime", DateTime, primary_key=True)
+    id = Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    datetime = Column("datetime", DateTime, nullable=False)
     hostname = Column("hostname", String)
     taskname = Column("taskname", String)
     target_path = Column("target_path", String)
@@ -45,6 +49,14 @@ class StatObj(object):
             self.number_of_old_files_count += 1
             self.total_old_file_size_count += file_to_add.file_size
 
+    def add_counts(self, counter, now):
+        """Adds the totals of a FileCounter built by a scan to the stat counts"""
+        self.total_file_size_count += counter.total_file_size
+        self.number_of_files_count += counter.number_of_files
+        self.total_access_time_count += counter.total_access_time(now)
+        self.number_of_old_files_count += counter.number_of_old_files
+        self.total_old_file_size_count += counter.total_old_file_size
+
     def get_total_space(self):
         """Calculates total file size of all files in file_list"""
         self.total_file_size = self.total_file_size_count
@@ -79,6 +91,10 @@ class StatObj(object):
 class DirectoryStats(StatObj, Base):
     """extention of StatObj used for storing directory stats"""
     __tablename__ = "directorystats"
+    __table_args__ = (Index("ix_directorystats_host_path_time",
+                            "hostname", "target_path", "datetime"),
+                      Index("ix_directorystats_datetime", "datetime"),
+                      Index("ix_directorystats_taskname", "taskname"))
     disk_use_percent = None
 
     def display_stats(self):
@@ -101,6 +117,12 @@ class UserStats(StatObj, Base):
     """Extention of StatObj that is used for storing a user's stats"""
 
     __tablename__ = "userstats"
+    __table_args__ = (Index("ix_userstats_user_host_path_time",
+                            "username", "hostname", "target_path", "datetime"),
+                      Index("ix_userstats_host_path_time",
+                            "hostname", "target_path", "datetime"),
+                      Index("ix_userstats_datetime", "datetime"),
+                      Index("ix_userstats_taskname", "taskname"))
     username = Column("username", String)
 
     def display_stats(self):
@@ -119,6 +141,8 @@ class UserStats(StatObj, Base):
 
     def email_usage_warning(self, task, postfix, problem_users):
         """Method that sends a usage warning email to the user"""
+        from dkmonitor.emailer.email_obj import Email #smtplib is only loaded to send mail
+
         email_info = self.build_email_stats(task)
         address = '@'.join([email_info["username"], postfix])
         message = Email(address, email_info, "usage_warning")
@@ -146,6 +170,8 @@ class UserStats(StatObj, Base):
 
     def email_alteration_notice(self, task, postfix, notice_type):
         """Sends data alteration notice to user"""
+        from dkmonitor.emailer.email_obj import Email #smtplib is only loaded to send mail
+
         if self.number_of_old_files_count > 0:
             print("Emailing data alteration notice to: {}".format(self.username))
             email_info = self.build_email_stats(task)
@@ -215,18 +241,213 @@ class Tasks(Base):
     email_usage_warnings = Column("email_usage_warnings", Boolean)
     email_data_alterations = Column("email_data_alterations", Boolean)
     email_top_percent = Column("email_top_percent", Integer)
+    scan_threads = Column("scan_threads", Integer)
     enabled = Column("enabled", Boolean)
 
 
+class Maintenance(Base):
+    """Last run of a shared maintenance job, used so only one host runs it per interval"""
+
+    __tablename__ = "maintenance"
+
+    name = Column("name", String, primary_key=True)
+    hostname = Column("hostname", String)
+    last_run = Column("last_run", DateTime)
+
+
+class LatestStatObj(object):
+    """
+    Latest and previous stats of one directory or user, the rows are upserted
+    in the same transaction that stores the history rows
+    """
+
+    hostname = Column("hostname", String, primary_key=True)
+    target_path = Column("target_path", String, primary_key=True)
+    taskname = Column("taskname", String)
+    datetime = Column("datetime", DateTime, nullable=False)
+    total_file_size = Column("total_file_size", BigInteger)
+    average_file_age = Column("average_file_age", Float)
+    previous_datetime = Column("previous_datetime", DateTime)
+    previous_total_file_size = Column("previous_total_file_size", BigInteger)
+    previous_average_file_age = Column("previous_average_file_age", Float)
+
+
+class LatestDirectoryStats(LatestStatObj, Base):
+    """Latest and previous directorystats row of every directory"""
+    __tablename__ = "latest_directorystats"
+
+class LatestUserStats(LatestStatObj, Base):
+    """Latest and previous userstats row of every user on every directory"""
+    __tablename__ = "latest_userstats"
+    username = Column("username", String, primary_key=True)
+    disk_use_percent = Column("disk_use_percent", Float)
+    previous_disk_use_percent = Column("previous_disk_use_percent", Float)
+
+
+LATEST_TABLES = {DirectoryStats.__table__: LatestDirectoryStats.__table__,
+                 UserStats.__table__: LatestUserStats.__table__}
+
+
+class RollupStatObj(object):
+    """
+    Aggregate of the stats rows of one directory or user in one period
+    Means are the _sum columns divided by sample_count
+    """
+
+    period_start = Column("period_start", DateTime, primary_key=True)
+    hostname = Column("hostname", String, primary_key=True)
+    target_path = Column("target_path", String, primary_key=True)
+    taskname = Column("taskname", String)
+    sample_count = Column("sample_count", Integer)
+    last_datetime = Column("last_datetime", DateTime)
+    total_file_size_sum = Column("total_file_size_sum", BigInteger)
+    total_file_size_max = Column("total_file_size_max", BigInteger)
+    average_file_age_sum = Column("average_file_age_sum", Float)
+
+
+class UserRollupStatObj(RollupStatObj):
+    """Rollup columns of a user on a directory"""
+    username = Column("username", String, primary_key=True)
+    disk_use_percent_sum = Column("disk_use_percent_sum", Float)
+
+class DirectoryStatsHourly(RollupStatObj, Base):
+    """Hourly rollup of directorystats"""
+    __tablename__ = "directorystats_hourly"
+
+class DirectoryStatsDaily(RollupStatObj, Base):
+    """Daily rollup of directorystats"""
+    __tablename__ = "directorystats_daily"
+
+class DirectoryStatsWeekly(RollupStatObj, Base):
+    """Weekly rollup of directorystats, weeks start on monday"""
+    __tablename__ = "directorystats_weekly"
+
+class UserStatsHourly(UserRollupStatObj, Base):
+    """Hourly rollup of userstats"""
+    __tablename__ = "userstats_hourly"
+
+class UserStatsDaily(UserRollupStatObj, Base):
+    """Daily rollup of userstats"""
+    __tablename__ = "userstats_daily"
+
+class UserStatsWeekly(UserRollupStatObj, Base):
+    """Weekly rollup of userstats, weeks start on monday"""
+    __tablename__ = "userstats_weekly"
+
+
+ROLLUP_PERIODS = ("hourly", "daily", "weekly")
+PERIOD_LENGTHS = {"hourly": datetime.timedelta(hours=1),
+                  "daily": datetime.timedelta(days=1),
+                  "weekly": datetime.timedelta(weeks=1)}
+ROLLUP_TABLES = {DirectoryStats.__table__: {"hourly": DirectoryStatsHourly.__table__,
+                                            "daily": DirectoryStatsDaily.__table__,
+                                            "weekly": DirectoryStatsWeekly.__table__},
+                 UserStats.__table__: {"hourly": UserStatsHourly.__table__,
+                                       "daily": UserStatsDaily.__table__,
+                                       "weekly": UserStatsWeekly.__table__}}
+
+def period_start(moment, period):
+    """Returns the start of the hourly, daily or weekly period moment is in"""
+    start = moment.replace(minute=0, second=0, microsecond=0)
+    if period != "hourly":
+        start = start.replace(hour=0)
+    if period == "weekly":
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+def covered_period_start(oldest, period):
+    """
+    Returns the start of the first period that the history covers completely
+    when oldest is the datetime of the oldest history row
+    """
+    start = period_start(oldest, period)
+    if start < oldest: #Rows before oldest in its period may have been purged
+        start = period_start(start + PERIOD_LENGTHS[period], period)
+    return start
+
+def rollup_purge_days(cleaning_settings):
+    """Returns the purge_after_day_number of every rollup period, None keeps a period forever"""
+    return {period: cleaning_settings["{}_purge_after_day_number".format(period)]
+            for period in ROLLUP_PERIODS}
+
+ENGINES = {}
+SESSION_MAKERS = {}
+CREATED_SCHEMAS = set()
+ENGINE_LOCK = threading.Lock()
+
+def get_engine(eng_str, pool_size=5, pool_pre_ping=True):
+    """
+    Returns the process wide engine of a database url, creating it on first use
+    Every DataBase object on the same url shares the engine's connection pool
+    """
+    with ENGINE_LOCK:
+        engine = ENGINES.get(eng_str)
+        if engine is None:
+            options = {"pool_pre_ping": pool_pre_ping}
+            if eng_str.startswith("sqlite") is False: #SQLite pools take no size
+                options["pool_size"] = pool_size
+            engine = create_engine(eng_str, **options)
+            ENGINES[eng_str] = engine
+            SESSION_MAKERS[eng_str] = sessionmaker(bind=engine, expire_on_commit=False)
+    return engine
+
+def create_tables_once(eng_str, force=False):
+    """
+    Creates the missing dkmonitor tables once per process (every time with force)
+    Task columns added since the tasks table was created are added to it as well
+    """
+    with ENGINE_LOCK:
+        if (force is True) or (eng_str not in CREATED_SCHEMAS):
+            Base.metadata.create_all(ENGINES[eng_str])
+            add_missing_columns(ENGINES[eng_str], Tasks.__table__)
+            CREATED_SCHEMAS.add(eng_str)
+
+def add_missing_columns(engine, table):
+    """
+    Adds the columns of the current schema that an existing table does not have
+    Returns the names of the added columns
+    """
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    columns = [column["name"] for column in inspector.get_columns(table.name)]
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    for column in table.columns:
+        if column.name not in columns:
+            engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                preparer.quote(table.name),
+                preparer.quote(column.name),
+                column.type.compile(dialect=engine.dialect)))
+            added.append(column.name)
+    return added
+
+
+#DataBase_Settings that DataBase takes, other keys in the section are ignored
+DATABASE_OPTIONS = ("db_type", "hostname", "database", "username", "password",
+                    "pool_size", "pool_pre_ping", "create_tables")
+
+def database_options(db_settings):
+    """Returns the keyword arguments of DataBase in a DataBase_Settings section"""
+    return {name: value for name, value in db_settings.items() if name in DATABASE_OPTIONS}
+
+
 class DataBase:
-    """The Base class for dealing with the dkmonitor database"""
+    """
+    The Base class for dealing with the dkmonitor database
+    Engines and session makers are shared per database url, tables are created
+    the first time a url is used unless create_tables is False
+    """
 
     def __init__(self,
                  db_type='postgresql',
                  hostname='127.0.0.1',
                  database='postgres',
                  username='postgres',
-                 password=''):
+                 password='',
+                 pool_size=5,
+                 pool_pre_ping=True,
+                 create_tables=True):
 
         eng_str = '{db_type}://{user}:{passwd}@{host}/{dbname}'.format(db_type=db_type,
                                                                        user=username,
@@ -234,35 +455,493 @@ class DataBase:
                                                                        host=hostname,
                                                                        dbname=database)
 
-        self.db_engine = create_engine(eng_str)
-        Base.metadata.bind = self.db_engine
-        Base.metadata.create_all()
+        self.eng_str = eng_str
+        self.db_engine = get_engine(eng_str, pool_size, pool_pre_ping)
+        if create_tables is True:
+            create_tables_once(eng_str)
+        self.sessions = []
 
     def store(self, data):
-        """Stores rows in database"""
-        session = self.create_session()
-        if isinstance(data, list) is True:
+        """Stores rows in database, the latest stats tables are updated in the same transaction"""
+        if isinstance(data, list) is False:
+            data = [data]
+        with self.session_scope() as session:
             session.add_all(data)
+            tables = {}
+            for row in data:
+                if row.__table__ in LATEST_TABLES:
+                    tables.setdefault(row.__table__, []).append(row_values(row))
+            if tables:
+                update_latest(session.connection(), tables)
+                update_rollups(session.connection(), tables)
+
+    def bulk_store(self, rows, use_copy=False):
+        """
+        Stores stat rows in a single transaction with one executemany per table
+        With use_copy on a PostgreSQL (psycopg2) database each table is written with COPY
+        """
+        tables = {}
+        for row in rows:
+            tables.setdefault(row.__table__, []).append(row_values(row))
+
+        copy_flag = (use_copy is True) and (self.db_engine.dialect.name == "postgresql") and \
+                    (self.db_engine.driver == "psycopg2")
+        with self.db_engine.begin() as connection:
+            for table, values in tables.items():
+                if copy_flag is True:
+                    copy_rows(connection, table, values)
+                else:
+                    connection.execute(table.insert(), values)
+            update_latest(connection, tables)
+            update_rollups(connection, tables)
+
+    def window_functions(self):
+        """Returns True if the database supports ROW_NUMBER() OVER (...)"""
+        dialect = self.db_engine.dialect
+        if dialect.name == "sqlite":
+            return sqlite3.sqlite_version_info >= (3, 25, 0)
+        if dialect.name == "mysql":
+            if dialect.server_version_info is None:
+                self.db_engine.connect().close()
+            if getattr(dialect, "_is_mariadb", False) is True:
+                return dialect.server_version_info >= (10, 2)
+            return dialect.server_version_info >= (8, 0)
+        return True
+
+    def latest_snapshots(self, session, table, filters, partition):
+        """
+        Returns the latest and previous rows of table for every distinct
+        combination of the partition columns, sorted by the partition columns
+        One window function query, or two grouped queries on databases without them
+
+        INPUT: session, UserStats or DirectoryStats, filter expressions, partition columns
+        OUTPUT: list of [latest row, previous row] lists (previous is left out if missing)
+        """
+        if self.window_functions() is True:
+            row_number = func.row_number().over(partition_by=partition,
+                                                order_by=table.datetime.desc())
+            subquery = session.query(table, row_number.label("row_number")).\
+                               filter(*filters).subquery()
+            snapshot = aliased(table, subquery)
+            rows = session.query(snapshot).filter(subquery.c.row_number <= 2).all()
         else:
-            session.add(data)
-        session.commit()
-        session.close()
+            latest = session.query(*partition, func.max(table.datetime).label("latest")).\
+                             filter(*filters).group_by(*partition).subquery()
+            same_group = and_(*[column == latest.c[column.key] for column in partition])
+            previous = session.query(*partition, func.max(table.datetime).label("previous")).\
+                               join(latest, same_group).\
+                               filter(table.datetime < latest.c.latest).\
+                               filter(*filters).group_by(*partition).subquery()
+            rows = session.query(table).\
+                           join(latest, and_(same_group, table.datetime == latest.c.latest)).\
+                           filter(*filters).all()
+            rows.extend(session.query(table).\
+                                join(previous, and_(*[column == previous.c[column.key]
+                                                      for column in partition] +
+                                                     [table.datetime == previous.c.previous])).\
+                                filter(*filters).all())
+
+        groups = {}
+        for row in rows:
+            key = tuple(getattr(row, column.key) for column in partition)
+            groups.setdefault(key, []).append(row)
+        return [sorted(groups[key], key=lambda row: row.datetime, reverse=True)[:2]
+                for key in sorted(groups)]
 
     def create_session(self):
-        """Short hand for creating database sessions"""
-        session = sessionmaker(bind=self.db_engine, expire_on_commit=False)
-        return session()
+        """
+        Short hand for creating database sessions
+        Sessions are tracked and released by close
+        """
+        session = SESSION_MAKERS[self.eng_str]()
+        self.sessions.append(session)
+        return session
+
+    @contextmanager
+    def session_scope(self):
+        """Yields a session that is committed on success, rolled back on error and always closed"""
+        session = SESSION_MAKERS[self.eng_str]()
+        try:
+            yield session
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def close(self):
+        """Closes every session made by create_session"""
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+
+class StatsBuffer:
+    """
+    Collects the stat rows of several tasks so they are written in one transaction
+    Rows are written by flush or once max_rows rows are waiting
+    """
+
+    def __init__(self, db_settings, use_copy=False, max_rows=10000):
+        self.db_settings = db_settings
+        self.use_copy = use_copy
+        self.max_rows = max_rows
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def add(self, rows):
+        """Adds the rows of one task"""
+        with self.lock:
+            self.rows.extend(rows)
+            if len(self.rows) >= self.max_rows:
+                self.flush_locked()
+
+    def flush(self):
+        """Writes all waiting rows"""
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        """Writes all waiting rows, the caller holds the lock"""
+        if self.rows:
+            rows, self.rows = self.rows, []
+            DataBase(**database_options(self.db_settings)).bulk_store(rows, self.use_copy)
+
+
+def row_values(row):
+    """Returns the column values of a table object as a dict, unset primary keys are left out"""
+    values = {}
+    for column in row.__table__.columns:
+        value = getattr(row, column.key)
+        if (value is None) and (column.primary_key is True):
+            continue
+        values[column.name] = value
+    return values
+
+def latest_row(values, previous=None):
+    """
+    Builds a latest stats row from the values of a history row
+    The tracked values of the previous latest row (or history row) become the previous_ columns
+    """
+    latest_table = LATEST_TABLES[UserStats.__table__ if "username" in values
+                                 else DirectoryStats.__table__]
+    row = {}
+    for column in latest_table.columns:
+        if column.name.startswith("previous_") is True:
+            name = column.name[len("previous_"):]
+            row[column.name] = None if previous is None else previous[name]
+        else:
+            row[column.name] = values.get(column.name)
+    return row
+
+def update_latest(connection, tables):
+    """
+    Upserts the latest stats tables in the connection's transaction
+    Existing rows of the stored hosts and paths are read with one query, then
+    new keys are inserted and newer snapshots updated with one executemany each
+
+    INPUT: connection, dict of history table to list of row value dicts
+    """
+    for table, values in tables.items():
+        latest_table = LATEST_TABLES.get(table)
+        if (latest_table is None) or (not values):
+            continue
+        keys = [column.name for column in latest_table.primary_key]
+
+        existing = {}
+        query = select([latest_table]).\
+                where(latest_table.c.hostname.in_({value["hostname"] for value in values})).\
+                where(latest_table.c.target_path.in_({value["target_path"] for value in values}))
+        for row in connection.execute(query):
+            existing[tuple(row[key] for key in keys)] = dict(row)
+
+        changed = {}
+        for value in sorted(values, key=lambda value: value["datetime"]):
+            key = tuple(value[name] for name in keys)
+            current = changed.get(key, existing.get(key))
+            if (current is not None) and (current["datetime"] >= value["datetime"]):
+                continue
+            changed[key] = latest_row(value, current)
+
+        inserts = [row for key, row in changed.items() if key not in existing]
+        updates = [row for key, row in changed.items() if key in existing]
+        if inserts:
+            connection.execute(latest_table.insert(), inserts)
+        if updates:
+            statement = latest_table.update().\
+                        where(and_(*[latest_table.c[key] == bindparam("key_" + key)
+                                     for key in keys])).\
+                        values({column.name: bindparam("new_" + column.name)
+                                for column in latest_table.columns
+                                if column.primary_key is False})
+            connection.execute(statement, [{("key_" if name in keys else "new_") + name: value
+                                            for name, value in row.items()}
+                                           for row in updates])
+
+def rollup_buckets(rollup_table, period, values):
+    """
+    Aggregates history row values into the buckets of one rollup table
+
+    INPUT: rollup table, period name, list of row value dicts
+    OUTPUT: dict of bucket key to rollup row values
+    """
+    keys = [column.name for column in rollup_table.primary_key]
+    sums = [column.name[:-len("_sum")] for column in rollup_table.columns
+            if column.name.endswith("_sum")]
+    buckets = {}
+    for value in values:
+        value = dict(value, period_start=period_start(value["datetime"], period))
+        key = rollup_key(keys, period, value)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = {name: value[name] for name in keys}
+            bucket.update({name + "_sum": 0 for name in sums})
+            bucket.update(sample_count=0,
+                          taskname=value["taskname"],
+                          last_datetime=value["datetime"],
+                          total_file_size_max=value["total_file_size"])
+            buckets[key] = bucket
+
+        bucket["sample_count"] += 1
+        for name in sums:
+            bucket[name + "_sum"] += value[name] or 0
+        bucket["total_file_size_max"] = max(bucket["total_file_size_max"] or 0,
+                                            value["total_file_size"] or 0)
+        if value["datetime"] >= bucket["last_datetime"]:
+            bucket["last_datetime"] = value["datetime"]
+            bucket["taskname"] = value["taskname"]
+    return buckets
+
+def rollup_key(keys, period, value):
+    """Returns the key (primary key values) of the rollup bucket a history row belongs to"""
+    return tuple(period_start(value["datetime"], period) if name == "period_start"
+                 else value[name] for name in keys)
+
+def update_rollups(connection, tables):
+    """
+    Adds stored history rows to the hourly, daily and weekly rollup tables in the
+    connection's transaction
+
+    INPUT: connection, dict of history table to list of row value dicts
+    """
+    for table, values in tables.items():
+        for period, rollup_table in ROLLUP_TABLES.get(table, {}).items():
+            update_rollup_table(connection, rollup_table, period, values)
+
+def update_rollup_table(connection, rollup_table, period, values):
+    """
+    Adds history rows to one rollup table. Existing buckets are found with one query,
+    new buckets are inserted and existing ones incremented in the database
+    """
+    if not values:
+        return
+    buckets = rollup_buckets(rollup_table, period, values)
+    keys = [column.name for column in rollup_table.primary_key]
+    columns = rollup_table.columns
+
+    query = select([columns[name] for name in keys]).\
+            where(columns.period_start.in_({key[0] for key in buckets})).\
+            where(columns.hostname.in_({value["hostname"] for value in values})).\
+            where(columns.target_path.in_({value["target_path"] for value in values}))
+    existing = {tuple(row) for row in connection.execute(query)}
+
+    inserts = [bucket for key, bucket in buckets.items() if key not in existing]
+    updates = [bucket for key, bucket in buckets.items() if key in existing]
+    if inserts:
+        connection.execute(rollup_table.insert(), inserts)
+    if updates:
+        new_values = {"taskname": bindparam("new_taskname")}
+        for column in columns:
+            new_value = bindparam("new_" + column.name)
+            if (column.name == "sample_count") or column.name.endswith("_sum"):
+                new_values[column.name] = column + new_value
+            elif (column.name == "last_datetime") or column.name.endswith("_max"):
+                new_values[column.name] = case([(column < new_value, new_value)],
+                                               else_=column)
+        statement = rollup_table.update().\
+                    where(and_(*[columns[key] == bindparam("key_" + key) for key in keys])).\
+                    values(new_values)
+        connection.execute(statement, [{("key_" if name in keys else "new_") + name: value
+                                        for name, value in bucket.items()}
+                                       for bucket in updates])
+
+def copy_rows(connection, table, values):
+    """Writes rows to a PostgreSQL table with COPY FROM STDIN in the connection's transaction"""
+    columns = list(values[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for value in values:
+        writer.writerow(["\\N" if value[column] is None else value[column] for column in columns])
+    buffer.seek(0)
+
+    preparer = connection.dialect.identifier_preparer
+    statement = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+        table=preparer.format_table(table),
+        columns=", ".join(preparer.quote(column) for column in columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
 
 
 class DataBaseCleaner(DataBase):
     """A class used to modify the database from the commandline/clean when running tasks"""
 
     def __init__(self, db_settings):
-        super().__init__(hostname=db_settings["hostname"],
-                         database=db_settings["database"],
-                         password=db_settings["password"],
-                         username=db_settings["username"],
-                         db_type=db_settings["db_type"])
+        super().__init__(**database_options(db_settings))
+
+    def init_tables(self):
+        """Creates all missing dkmonitor tables"""
+        create_tables_once(self.eng_str, force=True)
+        print("Database tables created")
+
+    def migrate(self, batch_size=10000):
+        """
+        Upgrades an existing database to the current schema in place
+        Stats tables without a surrogate id are copied into the new layout,
+        missing task columns, indexes and tables are added
+        """
+        for table in (UserStats.__table__, DirectoryStats.__table__):
+            self.migrate_stats_table(table, batch_size)
+        self.add_missing_columns(Tasks.__table__)
+        create_tables_once(self.eng_str, force=True)
+        self.rebuild_latest()
+        if self.rollups_empty() is True: #Rollups are kept up to date by every store
+            self.rebuild_rollups(batch_size)
+        print("Database migrated")
+
+    def rollups_empty(self):
+        """Returns True if no rollup table holds a bucket"""
+        for rollup_tables in ROLLUP_TABLES.values():
+            for rollup_table in rollup_tables.values():
+                if self.db_engine.execute(select([rollup_table.columns.period_start]).\
+                                          limit(1)).first() is not None:
+                    return False
+        return True
+
+    def rebuild_latest(self):
+        """Recreates the latest stats tables from the userstats and directorystats history"""
+        create_tables_once(self.eng_str)
+        partitions = {UserStats: [UserStats.hostname, UserStats.target_path, UserStats.username],
+                      DirectoryStats: [DirectoryStats.hostname, DirectoryStats.target_path]}
+        with self.session_scope() as session:
+            for table, partition in partitions.items():
+                latest_table = LATEST_TABLES[table.__table__]
+                rows = [latest_row(row_values(snapshots[0]),
+                                   row_values(snapshots[1]) if len(snapshots) > 1 else None)
+                        for snapshots in self.latest_snapshots(session, table, [], partition)]
+                session.execute(latest_table.delete())
+                if rows:
+                    session.execute(latest_table.insert(), rows)
+                print("Table '{}' rebuilt: {} rows".format(latest_table.name, len(rows)))
+
+    def migrate_stats_table(self, table, batch_size):
+        """
+        Copies a stats table into a table with the current schema batch_size rows
+        per transaction, then replaces the old table with it
+        Rows are read in datetime order, the old primary key, so every batch starts
+        after the last datetime the batch before copied
+        """
+        inspector = inspect(self.db_engine)
+        if table.name not in inspector.get_table_names():
+            return
+        columns = [column["name"] for column in inspector.get_columns(table.name)]
+        if "id" in columns:
+            self.create_missing_indexes(table, inspector)
+            return
+
+        old_table = Table(table.name, MetaData(), autoload_with=self.db_engine)
+        new_table = table.tometadata(MetaData(), name="{}_new".format(table.name))
+        new_table.drop(self.db_engine, checkfirst=True) #Left by an interrupted migration
+        new_table.create(self.db_engine)
+        copy_columns = [name for name in columns if name in new_table.columns]
+
+        last_datetime = None
+        copied_count = 0
+        while True:
+            with self.db_engine.begin() as connection:
+                last_datetime, row_count = copy_batch(connection, old_table, new_table,
+                                                      copy_columns, last_datetime, batch_size)
+            copied_count += row_count
+            if row_count < batch_size:
+                break
+            print("Table '{}': {} rows copied".format(table.name, copied_count))
+
+        preparer = self.db_engine.dialect.identifier_preparer
+        with self.db_engine.begin() as connection:
+            row_count = batch_size
+            while row_count == batch_size: #Rows stored while the copy ran
+                last_datetime, row_count = copy_batch(connection, old_table, new_table,
+                                                      copy_columns, last_datetime, batch_size)
+                copied_count += row_count
+            connection.execute("ALTER TABLE {} RENAME TO {}".format(
+                preparer.quote(table.name), preparer.quote("{}_old".format(table.name))))
+            connection.execute("ALTER TABLE {} RENAME TO {}".format(
+                preparer.quote(new_table.name), preparer.quote(table.name)))
+            connection.execute("DROP TABLE {}".format(preparer.quote("{}_old".format(table.name))))
+        print("Table '{}' migrated: {} rows".format(table.name, copied_count))
+
+    def rebuild_rollups(self, batch_size=10000):
+        """
+        Recomputes the rollup tables from the userstats and directorystats history
+        Only buckets of periods the history still covers completely are recomputed.
+        Older buckets hold the aggregates of purged rows and are kept, a bucket of the
+        period of the oldest history row is only built from the history if it is missing
+        """
+        create_tables_once(self.eng_str)
+        with self.db_engine.begin() as connection:
+            for table, rollup_tables in ROLLUP_TABLES.items():
+                oldest = connection.execute(select([func.min(table.columns.datetime)])).scalar()
+                if oldest is None:
+                    print("Rollups of '{}' rebuilt: 0 rows".format(table.name))
+                    continue
+
+                covered = {}
+                kept = {}
+                for period, rollup_table in rollup_tables.items():
+                    covered[period] = covered_period_start(oldest, period)
+                    connection.execute(rollup_table.delete().\
+                                       where(rollup_table.columns.period_start >=
+                                             covered[period]))
+                    keys = [column.name for column in rollup_table.primary_key]
+                    query = select([rollup_table.columns[name] for name in keys]).\
+                            where(rollup_table.columns.period_start ==
+                                  period_start(oldest, period))
+                    kept[period] = {tuple(row) for row in connection.execute(query)}
+
+                last_id = None
+                row_count = 0
+                while True:
+                    query = select([table]).order_by(table.columns.id).limit(batch_size)
+                    if last_id is not None:
+                        query = query.where(table.columns.id > last_id)
+                    rows = [dict(row) for row in connection.execute(query)]
+                    if not rows:
+                        break
+                    for period, rollup_table in rollup_tables.items():
+                        keys = [column.name for column in rollup_table.primary_key]
+                        update_rollup_table(connection, rollup_table, period,
+                                            [row for row in rows
+                                             if (row["datetime"] >= covered[period]) or
+                                             (rollup_key(keys, period, row) not in kept[period])])
+                    last_id = rows[-1]["id"]
+                    row_count += len(rows)
+                print("Rollups of '{}' rebuilt: {} rows".format(table.name, row_count))
+
+    def add_missing_columns(self, table):
+        """Adds columns of the current schema that an existing table does not have"""
+        for column_name in add_missing_columns(self.db_engine, table):
+            print("Table '{}': column '{}' added".format(table.name, column_name))
+
+    def create_missing_indexes(self, table, inspector):
+        """Creates indexes of the current schema that an existing table does not have"""
+        indexes = [index["name"] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(self.db_engine)
+                print("Table '{}': index '{}' created".format(table.name, index.name))
 
     def drop_table(self, tablename):
         """Drops a table specied by string"""
@@ -292,31 +971,216 @@ class DataBaseCleaner(DataBase):
         for table in meta_data.tables.values():
             print(table.name)
 
-    def clean_table(self, days, tablename):
-        """Deletes all rows older than days in tablename"""
+    def clean_table(self, days, tablename, chunk_size=10000, deadline=None):
+        """
+        Deletes all rows older than days in tablename, rollup tables by their period_start
+        Rows are deleted oldest first in chunks of about chunk_size rows with a commit
+        after every chunk, no new chunk is started after the deadline (time.time() value)
+        Returns False if old rows were left because the deadline was reached
+        """
         meta_data = MetaData()
         meta_data.reflect(self.db_engine)
         too_old = datetime.datetime.now() - datetime.timedelta(days=days)
         found_flag = False
-        try:
-            for table in reversed(meta_data.sorted_tables):
-                if table.name == tablename:
-                    self.db_engine.execute(table.delete().where(table.columns.datetime <= too_old))
-                    print("Table '{}' was successfully cleaned".format(table.name))
-                    found_flag = True
-        except AttributeError:
-            print("Table '{}' does not have a date column".format(tablename), file=sys.stderr)
+        finished = True
+        for table in reversed(meta_data.sorted_tables):
+            if table.name == tablename:
+                found_flag = True
+                date_column = table.columns.get("period_start", table.columns.get("datetime"))
+                if date_column is None:
+                    print("Table '{}' does not have a date column".format(tablename),
+                          file=sys.stderr)
+                    continue
+                row_count, finished = self.delete_chunks(table, date_column, too_old,
+                                                         chunk_size, deadline)
+                if finished is True:
+                    print("Table '{}' was successfully cleaned: {} rows deleted".format(
+                        table.name, row_count))
+                else:
+                    print("Table '{}' was partly cleaned: {} rows deleted before the time limit"\
+                          .format(table.name, row_count))
 
         if found_flag is False:
             print("Table '{}' was not found".format(tablename), file=sys.stderr)
+        return finished
+
+    def delete_chunks(self, table, date_column, too_old, chunk_size, deadline=None):
+        """
+        Deletes the rows of table with date_column <= too_old, one transaction per chunk
+        Every chunk ends at the date of the chunk_size-th oldest row (found with the
+        date index), rows sharing that date are deleted with the chunk
+        Returns (number of deleted rows, True if no old rows are left)
+        """
+        chunk_size = max(1, chunk_size)
+        row_count = 0
+        while True:
+            if (deadline is not None) and (time.time() >= deadline):
+                return row_count, False
+            boundary = self.db_engine.execute(select([date_column]).\
+                                              where(date_column <= too_old).\
+                                              order_by(date_column).\
+                                              offset(chunk_size - 1).limit(1)).scalar()
+            with self.db_engine.begin() as connection:
+                result = connection.execute(table.delete().where(
+                    date_column <= (too_old if boundary is None else boundary)))
+            row_count += max(result.rowcount, 0)
+            if boundary is None:
+                return row_count, True
+
+    def clean_rollups(self, rollup_days, chunk_size=10000, deadline=None):
+        """
+        Deletes the rollup rows older than the days of their period, None keeps a period
+        Returns False if old rows were left because the deadline was reached
+        """
+        finished = True
+        for period, days in rollup_days.items():
+            if days in ("", None, 0):
+                continue
+            for rollup_tables in ROLLUP_TABLES.values():
+                if finished is True:
+                    finished = self.clean_table(int(days), rollup_tables[period].name,
+                                                chunk_size, deadline)
+        return finished
+
+    @contextmanager
+    def maintenance_claim(self, name, interval):
+        """
+        Yields True if this host claimed the maintenance job name because nobody ran it
+        within interval (a datetime.timedelta). The claim is written before the job runs
+        so other hosts skip it, if the job raises the claim is taken back so the job
+        is retried by the next run instead of being skipped for the whole interval
+        """
+        table = Maintenance.__table__
+        now = datetime.datetime.now()
+        hostname = socket.gethostname()
+        previous = self.db_engine.execute(select([table.columns.hostname,
+                                                  table.columns.last_run]).\
+                                          where(table.columns.name == name)).first()
+        if previous is None:
+            try: #First run of the job, another host may insert it at the same time
+                with self.db_engine.begin() as connection:
+                    connection.execute(table.insert().values(name=name,
+                                                             hostname=hostname,
+                                                             last_run=now))
+            except IntegrityError:
+                yield False
+                return
+        else:
+            if (previous["last_run"] is not None) and (previous["last_run"] > now - interval):
+                yield False
+                return
+            with self.db_engine.begin() as connection: #Only one host replaces the last run
+                result = connection.execute(table.update().\
+                                            where(table.columns.name == name).\
+                                            where(table.columns.last_run ==
+                                                  previous["last_run"]).\
+                                            values(hostname=hostname, last_run=now))
+            if result.rowcount != 1:
+                yield False
+                return
+
+        try:
+            yield True
+        except BaseException:
+            with self.db_engine.begin() as connection:
+                claim = and_(table.columns.name == name,
+                             table.columns.hostname == hostname,
+                             table.columns.last_run == now)
+                if previous is None:
+                    connection.execute(table.delete().where(claim))
+                else:
+                    connection.execute(table.update().where(claim).\
+                                       values(hostname=previous["hostname"],
+                                              last_run=previous["last_run"]))
+            raise
+
+    @contextmanager
+    def advisory_lock(self, name):
+        """
+        Yields True if this session holds the named PostgreSQL advisory lock
+        (pg_try_advisory_lock), the lock is released on exit
+        Other databases have no advisory locks and always yield True
+        """
+        if self.db_engine.dialect.name != "postgresql":
+            yield True
+            return
+
+        key = zlib.crc32(name.encode())
+        connection = self.db_engine.connect()
+        try:
+            locked = connection.execute(select([func.pg_try_advisory_lock(key)])).scalar()
+            try:
+                yield locked
+            finally:
+                if locked is True:
+                    connection.execute(select([func.pg_advisory_unlock(key)]))
+        finally:
+            connection.close()
 
 
-def clean_database(days):
-    """Deletes all rows older than days databases userstats and directorystats"""
+def copy_batch(connection, old_table, new_table, columns, last_datetime, batch_size):
+    """
+    Copies the next batch_size rows after last_datetime from old_table to new_table
+    Returns (datetime of the last copied row, number of copied rows)
+    """
+    query = select([old_table.columns[name] for name in columns]).\
+            order_by(old_table.columns.datetime).limit(batch_size)
+    if last_datetime is not None:
+        query = query.where(old_table.columns.datetime > last_datetime)
+    rows = connection.execute(query).fetchall()
+    if rows:
+        connection.execute(new_table.insert(), [dict(zip(columns, row)) for row in rows])
+        last_datetime = rows[-1][columns.index("datetime")]
+    return last_datetime, len(rows)
+
+def clean_database(days, rollup_days=None, chunk_size=10000, time_budget=0, interval=0):
+    """
+    Deletes all rows older than days in userstats and directorystats and
+    the rollup rows older than the days of their period in rollup_days
+    Rows are deleted in chunks of chunk_size, no chunk is started after time_budget
+    seconds (0 is no limit). With an interval (hours) only one host purges per interval,
+    a host that finds the purge already running or claimed skips it. A purge that fails
+    gives its claim back so the next run retries it, the error is logged and not raised
+    Returns True if the purge ran
+    """
     database_settings = export_settings()["DataBase_Settings"]
-    database_cleaner = DataBaseCleaner(database_settings)
-    database_cleaner.clean_table(days, "userstats")
-    database_cleaner.clean_table(days, "directorystats")
+    try:
+        database_cleaner = DataBaseCleaner(database_settings)
+        with database_cleaner.advisory_lock("dkmonitor_purge") as locked:
+            if locked is False:
+                print("Database purge skipped: running on another host")
+                return False
+            if interval > 0:
+                claim = database_cleaner.maintenance_claim("purge",
+                                                           datetime.timedelta(hours=interval))
+            else:
+                claim = contextlib.nullcontext(True)
+            with claim as claimed:
+                if claimed is False:
+                    print("Database purge skipped: already run in the last {} hours".format(
+                        interval))
+                    return False
+                purge_tables(database_cleaner, days, rollup_days, chunk_size, time_budget)
+    except Exception as err: #The claim is given back, the scans of this run go on
+        print("Database purge failed, it is retried by the next run: {}".format(err),
+              file=sys.stderr)
+        log_setup.setup_logger(__name__).exception("Database purge failed")
+        return False
+    return True
+
+def purge_tables(database_cleaner, days, rollup_days, chunk_size, time_budget):
+    """Runs the chunked purge of the stats tables, then of the rollup tables"""
+    deadline = None
+    if time_budget > 0:
+        deadline = time.time() + time_budget
+    finished = True
+    if days not in ("", None, 0):
+        for tablename in ("userstats", "directorystats"):
+            if finished is True:
+                finished = database_cleaner.clean_table(int(days), tablename,
+                                                        chunk_size, deadline)
+    if (rollup_days is not None) and (finished is True):
+        database_cleaner.clean_rollups(rollup_days, chunk_size, deadline)
 
 def get_args(args):
     """Sets arguements for argparse"""
@@ -325,6 +1189,28 @@ def get_args(args):
     parser = argparse.ArgumentParser(description=description)
     subparsers = parser.add_subparsers()
 
+    init_parser = subparsers.add_parser("init")
+    init_parser.set_defaults(which="init")
+
+    migrate_parser = subparsers.add_parser("migrate")
+    migrate_parser.set_defaults(which="migrate")
+    migrate_parser.add_argument("--batch_size",
+                                dest="batch_size",
+                                type=int,
+                                default=10000,
+                                help="Number of rows copied per transaction")
+
+    rebuild_parser = subparsers.add_parser("rebuild_latest")
+    rebuild_parser.set_defaults(which="rebuild_latest")
+
+    rollup_parser = subparsers.add_parser("rebuild_rollups")
+    rollup_parser.set_defaults(which="rebuild_rollups")
+    rollup_parser.add_argument("--batch_size",
+                               dest="batch_size",
+                               type=int,
+                               default=10000,
+                               help="Number of history rows aggregated per query")
+
     list_parser = subparsers.add_parser("list")
     list_parser.set_defaults(which="list")
 
@@ -342,6 +1228,20 @@ def get_args(args):
                                   dest="table_name",
                                   type=str,
                                   help="Table to clean")
+    clean_name_group.add_argument("--rollups",
+                                  dest="rollups",
+                                  action="store_true",
+                                  help="Delete entries older than days in all rollup tables")
+    clean_parser.add_argument("--chunk_size",
+                              dest="chunk_size",
+                              type=int,
+                              default=10000,
+                              help="Number of rows deleted per transaction")
+    clean_parser.add_argument("--time_budget",
+                              dest="time_budget",
+                              type=int,
+                              default=0,
+                              help="Stop starting new chunks after this many seconds")
 
     clear_parser = subparsers.add_parser("drop")
     clear_parser.set_defaults(which="drop")
@@ -367,6 +1267,14 @@ def main(args=None):
     db_settings = export_settings()["DataBase_Settings"]
     database_cleaner = DataBaseCleaner(db_settings)
 
+    if args.which == "init":
+        database_cleaner.init_tables()
+    if args.which == "migrate":
+        database_cleaner.migrate(args.batch_size)
+    if args.which == "rebuild_latest":
+        database_cleaner.rebuild_latest()
+    if args.which == "rebuild_rollups":
+        database_cleaner.rebuild_rollups(args.batch_size)
     if args.which == "list":
         database_cleaner.list_tables()
     if args.which == "drop":
@@ -375,11 +1283,19 @@ def main(args=None):
         elif args.table_name != None:
             database_cleaner.drop_table(args.table_name)
     if args.which == "clean":
+        deadline = None
+        if args.time_budget > 0:
+            deadline = time.time() + args.time_budget
         if args.all is True:
-            database_cleaner.clean_table(args.days, "userstats")
-            database_cleaner.clean_table(args.days, "directorystats")
+            if database_cleaner.clean_table(args.days, "userstats",
+                                            args.chunk_size, deadline) is True:
+                database_cleaner.clean_table(args.days, "directorystats",
+                                             args.chunk_size, deadline)
+        elif args.rollups is True:
+            database_cleaner.clean_rollups({period: args.days for period in ROLLUP_PERIODS},
+                                           args.chunk_size, deadline)
         elif args.table_name != None:
-            database_cleaner.clean_table(args.days, args.table_name)
+            database_cleaner.clean_table(args.days, args.table_name, args.chunk_size, deadline)
 
 if __name__ == '__main__':
     main()
@@ -8,8 +8,7 @@ import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import sys, os
-sys.path.append(os.path.abspath("../.."))
+import os
 from dkmonitor.utilities import log_setup
 
 class MessageTypeNotFoundError(Exception):
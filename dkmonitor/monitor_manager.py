@@ -6,15 +6,15 @@ given disk or directory that is set by the adminstrator
 
 import threading, argparse, socket
 
-import sys, os
-sys.path.append(os.path.abspath(".."))
+import sys
 
 from dkmonitor.utilities import log_setup
 from dkmonitor.config.settings_manager import export_settings
 from dkmonitor.config.task_manager import export_tasks, create_quick_task
 
-from dkmonitor.database_manager import clean_database
-from dkmonitor.utilities.dk_clean import check_then_clean
+from dkmonitor.database_manager import clean_database, rollup_purge_days, StatsBuffer
+from dkmonitor.utilities.dk_clean import check_then_clean, single_pass_candidates
+from dkmonitor.utilities.dk_clean import resume_candidates
 
 from dkmonitor.utilities.dk_stat import scan_store_email
 from dkmonitor.utilities.dk_stat import scan_store_email_display
@@ -37,15 +37,31 @@ class MonitorManager():
     It runs preset tasks that are found in a database
     """
 
-    def __init__(self):
+    def __init__(self, full_rescan=False, resume=False):
         self.settings = export_settings()
         self.tasks = export_tasks()
+        self.full_rescan = full_rescan
+        self.resume = resume
+        self.threads = []
+
+        #Rows of all tasks are written together when combine_tasks is on
+        self.buffer = None
+        store_settings = self.settings["Store_Settings"]
+        if store_settings["combine_tasks"] is True:
+            self.buffer = StatsBuffer(self.settings["DataBase_Settings"],
+                                      store_settings["use_copy"],
+                                      store_settings["buffer_rows"])
 
         self.logger = log_setup.setup_logger(__name__)
 
-        if self.settings["DataBase_Cleaning_Settings"]["purge_database"] == "yes":
+        cleaning_settings = self.settings["DataBase_Cleaning_Settings"]
+        if cleaning_settings["purge_database"] is True:
             self.logger.info("Cleaning Database")
-            clean_database(self.settings["DataBase_Cleaning_Settings"]["purge_after_day_number"])
+            clean_database(cleaning_settings["purge_after_day_number"],
+                           rollup_purge_days(cleaning_settings),
+                           cleaning_settings["purge_chunk_size"],
+                           cleaning_settings["purge_time_budget"],
+                           cleaning_settings["purge_interval"])
 
     def scan_wrapper(self, scan, task):
         """Error catching wrapper for quick and full scan fucntions"""
@@ -60,48 +76,82 @@ class MonitorManager():
         except PermissionError:
             print("You do not have permissions to {}".format(task["target_path"]), file=sys.stderr)
             self.logger.error("No permissions for %s", task["target_path"])
-        except OSError:
+        except FileNotFoundError:
             print("There is no directory: {}".format(task["target_path"]), file=sys.stderr)
             self.logger.error("There is no directory: %s", task["target_path"])
+        except OSError as err:
+            print("Task '{}' failed: {}".format(task["taskname"], err), file=sys.stderr)
+            self.logger.error("Task %s failed: %s", task["taskname"], err)
 
-    @staticmethod
-    def quick_scan(task):
+    def quick_scan(self, task):
         """
         Meant to be run hourly
         Checks use percent on a task
         if over quota, email users / clean disk if neccessary
         """
+        if self.resume_clean(task) is True:
+            return
         print("Starting Quick Scan of: {}".format(task["target_path"]))
 
         disk_use = get_disk_use_percent(task["target_path"])
         if disk_use > task["usage_warning_threshold"]:
             print("Disk use over threshold, Starting full scan of {}".format(task["target_path"]))
-            scan_store_email(task)
-            check_then_clean(task)
+            candidates = single_pass_candidates(task)
+            scan_store_email(task, candidates, self.full_rescan, self.buffer)
+            check_then_clean(task, candidates)
 
-    @staticmethod
-    def full_scan(task):
+    def full_scan(self, task):
         """
         Performs full scan of directory by default
         saves disk statistics information in db
         if over quota, email users / clean disk if neccessary
         """
+        if self.resume_clean(task) is True:
+            return
         print("Starting Full Scan of: {}".format(task["target_path"]))
 
-        scan_store_email_display(task)
-        check_then_clean(task)
+        candidates = single_pass_candidates(task)
+        scan_store_email_display(task, candidates, self.full_rescan, self.buffer)
+        check_then_clean(task, candidates)
+
+    def resume_clean(self, task):
+        """
+        In resume mode finishes the files an interrupted clean left in the task's journal
+        without scanning. Returns True if there was a clean to resume
+        """
+        if self.resume is False:
+            return False
+        candidates = resume_candidates(task)
+        if candidates is None:
+            return False
+
+        print("Resuming clean of {}: {} files left".format(task["target_path"],
+                                                         candidates.que.qsize()))
+        self.logger.info("Resuming clean of %s", task["target_path"])
+        check_then_clean(task, candidates)
+        return True
 
     def run_task(self, task, scan_function):
         """Runs a single task"""
         check_host_name(task) #raises error if does not match
         if task["enabled"] is True:
-            if self.settings["Thread_Settings"]["thread_mode"] == "yes":
+            if self.settings["Thread_Settings"]["thread_mode"] is True:
                 thread = threading.Thread(target=self.scan_wrapper, args=(scan_function, task,))
                 thread.daemon = False
                 thread.start()
+                self.threads.append(thread)
             else:
                 self.scan_wrapper(scan_function, task)
 
+    def finish(self):
+        """Waits for all task threads and writes the stats that are still buffered"""
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.buffer is not None:
+            self.logger.info("Storing buffered stats")
+            self.buffer.flush()
+
     def start_tasks(self, scan_type="full"):
         """Starts all tasks that are on current host"""
         try:
@@ -161,7 +211,7 @@ def check_host_name(task):
 def main(args=None):
     """Monitor Manager Command line interface"""
     if args is None:
-        args = sys.argv[1:0]
+        args = sys.argv[1:]
 
     description = "The run command line interface is used to run tasks on the current machine"
     parser = argparse.ArgumentParser(description=description)
@@ -169,11 +219,31 @@ def main(args=None):
     all_parser = subparsers.add_parser("all")
     all_parser.set_defaults(which="all")
     all_parser.add_argument("scan_type", help="Specify scan type: 'quick' or 'full'")
+    all_parser.add_argument("--full",
+                            dest="full_rescan",
+                            action="store_true",
+                            default=False,
+                            help="Ignore the incremental scan index and rescan every file")
+    all_parser.add_argument("--resume",
+                            dest="resume",
+                            action="store_true",
+                            default=False,
+                            help="Finish interrupted cleans from their journal without scanning")
 
     task_parser = subparsers.add_parser("task")
     task_parser.set_defaults(which="task")
     task_parser.add_argument("task_name", help="Name of task to run")
     task_parser.add_argument("scan_type", help="Specify scan type: 'quick' or 'full'")
+    task_parser.add_argument("--full",
+                             dest="full_rescan",
+                             action="store_true",
+                             default=False,
+                             help="Ignore the incremental scan index and rescan every file")
+    task_parser.add_argument("--resume",
+                             dest="resume",
+                             action="store_true",
+                             default=False,
+                             help="Finish an interrupted clean from its journal without scanning")
 
     qtask_parser = subparsers.add_parser("quick_task")
     qtask_parser.set_defaults(which="quick_task")
@@ -228,7 +298,7 @@ def main(args=None):
                               help="Specify the percent of users to be flagged as top users")
 
     args = parser.parse_args(args)
-    monitor = MonitorManager()
+    monitor = MonitorManager(getattr(args, "full_rescan", False), getattr(args, "resume", False))
     if args.which == "all":
         monitor.start_tasks(scan_type=args.scan_type)
     elif args.which == "task":
@@ -236,6 +306,7 @@ def main(args=None):
     elif args.which == "quick_task":
         task = create_quick_task(args)
         monitor.run_task(task, monitor.full_scan)
+    monitor.finish()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,105 @@
+"""
+This script puts relocated files back in their original place
+The task's clean journal is read from start to end and every moved or archived
+file that is not back in place yet is restored and recorded as restored
+"""
+
+import argparse
+
+import sys, os
+
+from dkmonitor.utilities import log_setup
+from dkmonitor.config.task_manager import export_tasks
+from dkmonitor.utilities.dk_clean import get_journal, get_journal_path
+from dkmonitor.utilities.clean_journal import read_journal
+from dkmonitor.utilities.relocate import Relocator
+from dkmonitor.utilities.archive import restore_file, ArchiveMemberError
+
+class JournalNotFoundError(Exception):
+    """Error thrown when a task has no clean journal"""
+    def __init__(self, message):
+        super(JournalNotFoundError, self).__init__(message)
+
+
+class RestoreManager:
+    """Restores the files of one task from its clean journal"""
+
+    def __init__(self, task):
+        self.task = task
+        self.journal_path = get_journal_path(task)
+        if (self.journal_path is None) or (os.path.exists(self.journal_path) is False):
+            raise JournalNotFoundError("Task '{}' has no clean journal".format(task["taskname"]))
+
+        self.relocator = None #Created by the first moved file
+        self.restored_count = 0
+        self.missing_count = 0
+
+        self.logger = log_setup.setup_logger(__name__)
+
+    def restore(self, path_prefix=None):
+        """Restores every moved or archived file whose original path starts with path_prefix"""
+        journal = get_journal(self.task)
+        try:
+            for entry in read_journal(self.journal_path):
+                if (entry[0] != "done") or (entry[1] == "delete"):
+                    continue
+                _, action, file_path, destination, _ = entry
+                if (path_prefix is not None) and (file_path.startswith(path_prefix) is False):
+                    continue
+                if os.path.lexists(file_path) is True: #Already back or replaced
+                    continue
+
+                try:
+                    self.restore_entry(action, file_path, destination)
+                except (OSError, ArchiveMemberError) as err:
+                    self.missing_count += 1
+                    self.logger.error("Could not restore %s: %s", file_path, err)
+                    continue
+                journal.restored(file_path)
+                self.restored_count += 1
+        finally:
+            journal.close()
+            if self.relocator is not None:
+                self.relocator.close()
+
+        message = "Restored {restored} files to {path}, {missing} could not be restored".format(
+            restored=self.restored_count,
+            path=self.task["target_path"],
+            missing=self.missing_count)
+        print(message)
+        self.logger.info(message)
+
+    def restore_entry(self, action, file_path, destination):
+        """Puts one moved or archived file back"""
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if action == "archive":
+            restore_file(destination, file_path)
+        else:
+            if self.relocator is None:
+                self.relocator = Relocator(destination, self.task["target_path"])
+            self.relocator.move(destination, file_path)
+
+
+def main(args=None):
+    """Restore command line interface"""
+    if args is None:
+        args = sys.argv[1:]
+
+    description = "The restore command line interface puts relocated files back using the journal"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("task_name", help="Name of the task to restore files of")
+    parser.add_argument("--path",
+                        dest="path_prefix",
+                        help="Only restore files under this path")
+
+    args = parser.parse_args(args)
+    try:
+        task = export_tasks()[args.task_name]
+        RestoreManager(task).restore(args.path_prefix)
+    except KeyError:
+        print("Task '{}' not found".format(args.task_name), file=sys.stderr)
+    except JournalNotFoundError as err:
+        print(err, file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,42 @@ Admin interface is a Command Line interface for Administrators
 that want to view user and system information
 """
 
-import termcolor, argparse
+import termcolor, argparse, datetime
 
-import sys, os
-sys.path.append(os.path.abspath(".."))
+import sys
 
-from dkmonitor.database_manager import DataBase, DirectoryStats, UserStats
+from dkmonitor.database_manager import DataBase, LatestDirectoryStats, LatestUserStats
+from dkmonitor.database_manager import database_options
+from dkmonitor.database_manager import DirectoryStats, UserStats, ROLLUP_TABLES
+from dkmonitor.database_manager import period_start, rollup_purge_days
 from dkmonitor.config.settings_manager import export_settings
 
 
+#Resolutions from fine to coarse with their period length in hours (raw rows have none)
+RESOLUTIONS = (("raw", None), ("hourly", 1), ("daily", 24), ("weekly", 168))
+RAW_HISTORY_DAYS = 2
+MAX_HISTORY_POINTS = 400
+
+def choose_resolution(days, purge_days):
+    """
+    Returns the finest resolution that still holds the last days and
+    shows at most MAX_HISTORY_POINTS points per disk
+
+    INPUT: number of days, dict of resolution to purge_after_day_number (None keeps forever)
+    OUTPUT: 'raw', 'hourly', 'daily' or 'weekly'
+    """
+    for resolution, hours in RESOLUTIONS:
+        keep_days = purge_days.get(resolution, "")
+        if (keep_days not in ("", None, 0)) and (int(keep_days) < days):
+            continue
+        if hours is None:
+            if days <= RAW_HISTORY_DAYS:
+                return resolution
+        elif days * 24 / hours <= MAX_HISTORY_POINTS:
+            return resolution
+    return RESOLUTIONS[-1][0]
+
+
 class AdminStatViewer(DataBase):
     """
     AdminStatViewer is an extention of DataBase that provieds
@@ -20,11 +47,7 @@ class AdminStatViewer(DataBase):
     """
 
     def __init__(self, db_settings):
-        super().__init__(hostname=db_settings["hostname"],
-                         database=db_settings["database"],
-                         password=db_settings["password"],
-                         username=db_settings["username"],
-                         db_type=db_settings["db_type"])
+        super().__init__(**database_options(db_settings))
 
     @staticmethod
     def print_color_key():
@@ -44,21 +67,9 @@ class AdminStatViewer(DataBase):
         DbViewer object from the dkmonitor database
         """
         session = self.create_session()
-        disks_on_user = [disk[0] for disk in session.query(UserStats.target_path).\
-                                             filter(UserStats.username == username).\
-                                             distinct()]
-        hosts_on_user = [host[0] for host in session.query(UserStats.hostname).\
-                                             filter(UserStats.username == username).\
-                                             distinct()]
-
-        user_stats = []
-        for disk in disks_on_user:
-            for host in hosts_on_user:
-                user_stats.append(session.query(UserStats).
-                                  filter(UserStats.username == username).\
-                                  filter(UserStats.target_path == disk).\
-                                  filter(UserStats.hostname == host).\
-                                  order_by(UserStats.datetime.desc()).limit(2).all())
+        user_stats = session.query(LatestUserStats).\
+                             filter(LatestUserStats.username == username).\
+                             order_by(LatestUserStats.hostname, LatestUserStats.target_path).all()
 
         self.print_color_key()
         if user_stats != []:
@@ -66,12 +77,12 @@ class AdminStatViewer(DataBase):
             average_file_age = 0
             print("User Name: {}".format(username))
             for disk in user_stats:
-                print("|System Name: {}".format(disk[0].hostname))
-                print("||Disk Name: {}".format(disk[0].target_path))
+                print("|System Name: {}".format(disk.hostname))
+                print("||Disk Name: {}".format(disk.target_path))
 
                 self.print_size_age_change(disk)
-                total_file_size += disk[0].total_file_size
-                average_file_age += disk[0].average_file_age
+                total_file_size += disk.total_file_size
+                average_file_age += disk.average_file_age
 
                 print("")
 
@@ -89,15 +100,16 @@ class AdminStatViewer(DataBase):
         DbViewer object from the dkmonitor database
         """
         session = self.create_session()
-        disks_on_system = [disk[0] for disk in session.query(DirectoryStats.target_path).\
-                                               filter(DirectoryStats.hostname == hostname).\
-                                               distinct()]
-        system_disk_stats = []
-        for disk in disks_on_system:
-            system_disk_stats.append(session.query(DirectoryStats).\
-                                     filter(DirectoryStats.hostname == hostname).\
-                                     filter(DirectoryStats.target_path == disk).\
-                                     order_by(DirectoryStats.datetime.desc()).limit(2).all())
+        system_disk_stats = session.query(LatestDirectoryStats).\
+                                    filter(LatestDirectoryStats.hostname == hostname).\
+                                    order_by(LatestDirectoryStats.target_path).all()
+        users_on_disk = {}
+        for disk, username in session.query(LatestUserStats.target_path,
+                                            LatestUserStats.username).\
+                                      filter(LatestUserStats.hostname == hostname).\
+                                      order_by(LatestUserStats.target_path,
+                                               LatestUserStats.username):
+            users_on_disk.setdefault(disk, []).append(username)
 
         self.print_color_key()
         if system_disk_stats != []:
@@ -105,17 +117,14 @@ class AdminStatViewer(DataBase):
             average_file_age = 0
             print("System Name        : {}".format(hostname))
             for disk in system_disk_stats:
-                print("|Disk Name         : {}".format(disk[0].target_path))
+                print("|Disk Name         : {}".format(disk.target_path))
                 self.print_size_age_change(disk)
-                print("|Users on: {}".format(disk[0].target_path))
-                for username in session.query(UserStats.username).\
-                                filter(UserStats.hostname == hostname).\
-                                filter(UserStats.target_path == disk[0].target_path).\
-                                distinct():
-                    print("|| {}".format(username[0]))
+                print("|Users on: {}".format(disk.target_path))
+                for username in users_on_disk.get(disk.target_path, []):
+                    print("|| {}".format(username))
 
-                total_file_size += disk[0].total_file_size
-                average_file_age += disk[0].average_file_age
+                total_file_size += disk.total_file_size
+                average_file_age += disk.average_file_age
 
             print("|Total File Size : {} GB".format(round(total_file_size/1024/1024/1024, 2)))
             print("|Average File Age: {} days".format(round(average_file_age/len(system_disk_stats),
@@ -136,28 +145,75 @@ class AdminStatViewer(DataBase):
             color = "red"
         return color
 
-    def print_size_age_change(self, rows):
-        """Prints size and file age change in color for a row from the db"""
+    def print_size_age_change(self, row):
+        """Prints size and file age change in color for a latest stats row from the db"""
         try:
-            size_change = rows[0].total_file_size / rows[1].total_file_size
+            size_change = row.total_file_size / row.previous_total_file_size
             size_color = self.get_color(size_change)
-            age_change = rows[0].average_file_age / rows[1].average_file_age
+            age_change = row.average_file_age / row.previous_average_file_age
             age_color = self.get_color(age_change)
-        except IndexError:
+        except (TypeError, ZeroDivisionError): #No previous snapshot
             age_color, size_color = 'yellow', 'yellow'
 
-        colored_size = termcolor.colored(str(round(rows[0].total_file_size/1024/1024/1024, 2)),
+        colored_size = termcolor.colored(str(round(row.total_file_size/1024/1024/1024, 2)),
                                          size_color)
         print("||Total File Size  : {} GB".format(colored_size))
 
-        colored_access = termcolor.colored(str(round(rows[0].average_file_age, 2)), age_color)
+        colored_access = termcolor.colored(str(round(row.average_file_age, 2)), age_color)
         print("||Average File Age : {} days".format(colored_access))
 
+    def display_history(self, kind, name, days, purge_days):
+        """
+        Displays the size and file age history of a user or system over the last days
+        The resolution is picked by choose_resolution, rollups show period means
+        """
+        resolution = choose_resolution(days, purge_days)
+        start = datetime.datetime.now() - datetime.timedelta(days=days)
+        history_table = UserStats if kind == "user" else DirectoryStats
+        name_column = "username" if kind == "user" else "hostname"
+
+        if resolution == "raw":
+            table = history_table.__table__
+            date_column = table.columns.datetime
+        else:
+            table = ROLLUP_TABLES[history_table.__table__][resolution]
+            date_column = table.columns.period_start
+            start = period_start(start, resolution)
+
+        query = table.select().\
+                where(table.columns[name_column] == name).\
+                where(date_column >= start).\
+                order_by(table.columns.hostname, table.columns.target_path, date_column)
+        disk = None
+        row_count = 0
+        for row in self.db_engine.execute(query):
+            if row_count == 0:
+                print("{} Name: {} ({} resolution)".format(kind.capitalize(), name, resolution))
+            row_count += 1
+            if (row["hostname"], row["target_path"]) != disk:
+                disk = (row["hostname"], row["target_path"])
+                print("|System Name: {}".format(row["hostname"]))
+                print("||Disk Name: {}".format(row["target_path"]))
+
+            if resolution == "raw":
+                total_file_size = row["total_file_size"]
+                average_file_age = row["average_file_age"]
+            else:
+                total_file_size = row["total_file_size_sum"] / row["sample_count"]
+                average_file_age = row["average_file_age_sum"] / row["sample_count"]
+            print("||{}  {} GB  {} days".format(row[date_column.name].strftime("%Y-%m-%d %H:%M"),
+                                               round(total_file_size/1024/1024/1024, 2),
+                                               round(average_file_age, 2)))
+
+        if row_count == 0:
+            print("No history for {} '{}' in the last {} days".format(kind, name, days),
+                  file=sys.stderr)
+
     def display_users(self):
         """Displays all users"""
         session = self.create_session()
-        user_num = len([print(username[0]) for username in session.query(UserStats.username).\
-                                                           distinct()])
+        user_num = len([print(username[0])
+                        for username in session.query(LatestUserStats.username).distinct()])
         if user_num == 0:
             print("There are currently no users in the userstats table")
         session.close()
@@ -165,8 +221,8 @@ class AdminStatViewer(DataBase):
     def display_systems(self):
         """Displays all systems"""
         session = self.create_session()
-        host_num = len([print(hostname[0]) for hostname in session.query(DirectoryStats.hostname).\
-                                                           distinct()])
+        host_num = len([print(hostname[0])
+                        for hostname in session.query(LatestDirectoryStats.hostname).distinct()])
         if host_num == 0:
             print("There are currently no systems in the directorystats table")
         session.close()
@@ -189,6 +245,19 @@ def get_args(args):
     user_parser.add_argument("user_name",
                              help="Name of user you want to search for")
 
+    history_parser = subparsers.add_parser("history")
+    history_parser.set_defaults(which="history")
+    history_parser.add_argument("kind",
+                                choices=["user", "system"],
+                                help="Show the history of a user or a system")
+    history_parser.add_argument("name",
+                                help="Name of the user or system")
+    history_parser.add_argument("--days",
+                                dest="days",
+                                type=int,
+                                default=30,
+                                help="Number of days of history to show")
+
     all_parser = subparsers.add_parser("all")
     all_parser.set_defaults(which="all")
     all_parser.add_argument("display_name",
@@ -202,14 +271,21 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    db_settings = export_settings()["DataBase_Settings"]
-    admin_int = AdminStatViewer(db_settings)
     args = get_args(args)
+    settings = export_settings()
+    admin_int = AdminStatViewer(settings["DataBase_Settings"])
 
     if args.which == "system":
         admin_int.display_system(args.system_host_name)
     elif args.which == "user":
         admin_int.display_user(args.user_name)
+    elif args.which == "history":
+        cleaning_settings = settings["DataBase_Cleaning_Settings"]
+        purge_days = {} #Nothing is purged
+        if cleaning_settings["purge_database"] is True:
+            purge_days = rollup_purge_days(cleaning_settings)
+            purge_days["raw"] = cleaning_settings["purge_after_day_number"]
+        admin_int.display_history(args.kind, args.name, args.days, purge_days)
     elif args.which == "all":
         if args.display_name == "users":
             admin_int.display_users()
@@ -0,0 +1,249 @@
+"""
+This file contains the ArchiveWriter used by the archive relocation mode
+Old files are packed into per user tar archives under relocation_path/<hostname>/<user>/
+Every file is written as its own gzip member (tar header, data and padding), the
+members concatenate into a normal .tar.gz that tar can extract. A manifest next to
+each archive stores the offset of every member so one file can be restored by
+decompressing only its own member
+"""
+
+import os, io, json, stat, zlib, tarfile, threading
+
+READ_SIZE = 1048576
+ARCHIVE_NAME_FORMAT = "archive_{:06d}.tar.gz"
+MANIFEST_SUFFIX = ".idx"
+
+class ArchiveMemberError(Exception):
+    """Error for when a file is not in an archive's manifest"""
+    def __init__(self, message):
+        super(ArchiveMemberError, self).__init__(message)
+
+
+class UserArchive:
+    """
+    The archive a single user's files are currently written to
+    Archived source files are only removed by sync, after the archive and
+    its manifest have been flushed to disk
+    """
+
+    def __init__(self, user_dir, uid, gid, max_size, compress_level):
+        self.user_dir = user_dir
+        self.uid = uid
+        self.gid = gid
+        self.max_size = max_size
+        self.compress_level = compress_level
+
+        self.archive_path = None
+        self.archive_file = None
+        self.offset = 0
+        self.manifest = []
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def open_next(self):
+        """Creates the next free archive file in user_dir"""
+        index = 0
+        while True:
+            archive_path = os.path.join(self.user_dir, ARCHIVE_NAME_FORMAT.format(index))
+            try:
+                archive_fd = os.open(archive_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                break
+            except FileExistsError:
+                index += 1
+
+        os.fchown(archive_fd, self.uid, self.gid)
+        self.archive_path = archive_path
+        self.archive_file = os.fdopen(archive_fd, "wb")
+        self.offset = 0
+
+    def write(self, data):
+        """Writes compressed data at the end of the archive"""
+        self.archive_file.write(data)
+        self.offset += len(data)
+
+    def add(self, file_path, source_fd, source_stat):
+        """Appends one file as a gzip member, a failed member is cut off again"""
+        if self.archive_file is None:
+            self.open_next()
+
+        tarinfo = tarfile.TarInfo(file_path.lstrip("/"))
+        tarinfo.size = source_stat.st_size
+        tarinfo.mtime = source_stat.st_mtime
+        tarinfo.mode = stat.S_IMODE(source_stat.st_mode)
+        tarinfo.uid = source_stat.st_uid
+        tarinfo.gid = source_stat.st_gid
+
+        start = self.offset
+        try:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+            self.write(compressor.compress(tarinfo.tobuf(tarfile.PAX_FORMAT)))
+            remaining = tarinfo.size
+            while remaining > 0:
+                data = os.read(source_fd, min(READ_SIZE, remaining))
+                if not data:
+                    break
+                self.write(compressor.compress(data))
+                remaining -= len(data)
+            #Zeros keep the member a valid tar entry if the file shrank, then block padding
+            padding = remaining + (-tarinfo.size % tarfile.BLOCKSIZE)
+            self.write(compressor.compress(bytes(padding)))
+            self.write(compressor.flush())
+        except BaseException:
+            self.archive_file.flush()
+            os.ftruncate(self.archive_file.fileno(), start)
+            self.archive_file.seek(start)
+            self.offset = start
+            raise
+
+        self.manifest.append([start, self.offset - start, tarinfo.size, int(tarinfo.mtime),
+                              tarinfo.name])
+        self.pending.append(file_path)
+
+    def sync(self, rollover=True):
+        """
+        Flushes the archive and manifest to disk, then removes the archived source files
+        Rolls over to a new archive once max_size is reached if rollover is True
+        Returns the number of source files that could not be removed
+        """
+        if self.archive_file is None:
+            return 0
+
+        self.archive_file.flush()
+        os.fsync(self.archive_file.fileno())
+        if self.manifest:
+            manifest_path = self.archive_path + MANIFEST_SUFFIX
+            with open(manifest_path, "a") as manifest_file:
+                for entry in self.manifest:
+                    manifest_file.write(json.dumps(entry) + "\n")
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            os.chown(manifest_path, self.uid, self.gid)
+            self.manifest = []
+
+        error_count = 0
+        for file_path in self.pending:
+            try:
+                os.unlink(file_path)
+            except OSError:
+                error_count += 1
+        self.pending = []
+
+        if (rollover is True) and (self.offset >= self.max_size):
+            error_count += self.close()
+        return error_count
+
+    def close(self):
+        """Syncs and ends the archive with the two empty tar blocks"""
+        if self.archive_file is None:
+            return 0
+        error_count = self.sync(rollover=False)
+        self.write(zlib.compress(bytes(2 * tarfile.BLOCKSIZE), wbits=31))
+        self.archive_file.flush()
+        os.fsync(self.archive_file.fileno())
+        self.archive_file.close()
+        self.archive_file = None
+        return error_count
+
+
+class ArchiveWriter:
+    """
+    Packs relocated files into per user archives under archive_root/<user>/
+    Archives roll over at max_archive_size compressed bytes, archived files are
+    removed in groups of sync_files once their group is safely on disk
+    """
+
+    def __init__(self, archive_root, resolver, max_archive_size=1073741824,
+                 compress_level=6, sync_files=1000):
+        self.archive_root = archive_root
+        self.resolver = resolver
+        self.max_archive_size = max_archive_size
+        self.compress_level = compress_level
+        self.sync_files = max(1, sync_files)
+
+        self.users = {}
+        self.lock = threading.Lock()
+        self.archived_count = 0
+        self.archived_bytes = 0
+        self.error_count = 0
+
+    def user_archive(self, source_stat):
+        """Returns the UserArchive of the file's owner, creating its directory"""
+        with self.lock:
+            archive = self.users.get(source_stat.st_uid)
+            if archive is None:
+                user_dir = os.path.join(self.archive_root,
+                                        self.resolver.name(source_stat.st_uid))
+                os.makedirs(user_dir, mode=0o700, exist_ok=True)
+                os.chown(user_dir, source_stat.st_uid, source_stat.st_gid)
+                archive = UserArchive(user_dir,
+                                      source_stat.st_uid,
+                                      source_stat.st_gid,
+                                      self.max_archive_size,
+                                      self.compress_level)
+                self.users[source_stat.st_uid] = archive
+        return archive
+
+    def add(self, file_path):
+        """
+        Archives one file and returns the path of the archive it was written to
+        The source is removed at the next sync of its archive
+        """
+        source_fd = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            source_stat = os.fstat(source_fd)
+            archive = self.user_archive(source_stat)
+            with archive.lock:
+                archive.add(file_path, source_fd, source_stat)
+                archive_path = archive.archive_path
+                if (len(archive.pending) >= self.sync_files) or \
+                   (archive.offset >= archive.max_size):
+                    error_count = archive.sync()
+                else:
+                    error_count = 0
+        finally:
+            os.close(source_fd)
+
+        with self.lock:
+            self.archived_count += 1
+            self.archived_bytes += source_stat.st_size
+            self.error_count += error_count
+        return archive_path
+
+    def report(self):
+        """Returns a summary of the archived files"""
+        return "{files} files ({gbs} GB) archived for {users} users".format(
+            files=self.archived_count,
+            gbs=round(self.archived_bytes/1024/1024/1024, 2),
+            users=len(self.users))
+
+    def close(self):
+        """Syncs and closes every open archive"""
+        with self.lock:
+            for archive in self.users.values():
+                with archive.lock:
+                    self.error_count += archive.close()
+
+
+def restore_file(archive_path, file_path, destination="/"):
+    """
+    Restores a single file from an archive by decompressing only its member
+
+    INPUT: archive path, original path of the file, directory the original path is recreated in
+    OUTPUT: path of the restored file
+    """
+    member_name = file_path.lstrip("/")
+    with open(archive_path + MANIFEST_SUFFIX, "r") as manifest_file:
+        for line in manifest_file:
+            offset, length, _, _, name = json.loads(line)
+            if name == member_name:
+                break
+        else:
+            raise ArchiveMemberError("{} is not in {}".format(file_path, archive_path))
+
+    with open(archive_path, "rb") as archive_file:
+        archive_file.seek(offset)
+        member = zlib.decompress(archive_file.read(length), wbits=31)
+
+    with tarfile.open(fileobj=io.BytesIO(member)) as tar:
+        tar.extract(member_name, destination)
+    return os.path.join(destination, member_name)
@@ -0,0 +1,115 @@
+"""
+This file contains the BulkDeleter used to delete old files in batches
+Files are grouped by parent directory and unlinked relative to one open
+directory fd per group. Directories emptied by the deletions are removed
+afterwards from the deepest up, never above the task's target_path
+"""
+
+import os, heapq
+from collections import defaultdict
+from concurrent import futures
+
+class BulkDeleter:
+    """
+    Deletes batches of (file_path, file_size) items
+    Every parent directory is always sent to the same worker
+    (hash of the directory modulo worker_number) so no two workers
+    ever unlink in the same directory
+    """
+
+    def __init__(self, stop_dir, worker_number=1):
+        self.stop_dir = os.path.normpath(stop_dir)
+        self.worker_number = max(1, worker_number)
+        self.workers = None
+        if self.worker_number > 1:
+            self.workers = [futures.ThreadPoolExecutor(max_workers=1)
+                            for _ in range(self.worker_number)]
+
+        self.touched = set()
+        self.pruned_count = 0
+
+    def delete(self, items):
+        """
+        Deletes a batch of que items (priority_num, file_path, file_size)
+        Returns (deleted items, paths that could not be deleted for lack of permission)
+        """
+        groups = defaultdict(list)
+        for item in items:
+            groups[os.path.dirname(item[1])].append(item)
+
+        if self.workers is None:
+            results = [self.delete_group(dir_path, group) for dir_path, group in groups.items()]
+        else:
+            jobs = [self.workers[hash(dir_path) % self.worker_number].submit(self.delete_group,
+                                                                             dir_path,
+                                                                             group)
+                    for dir_path, group in groups.items()]
+            results = [job.result() for job in jobs]
+
+        deleted = []
+        denied = []
+        for group_deleted, group_denied in results:
+            deleted.extend(group_deleted)
+            denied.extend(group_denied)
+        return deleted, denied
+
+    def delete_group(self, dir_path, items):
+        """Unlinks the items of one directory through a single directory fd"""
+        deleted = []
+        denied = []
+        try:
+            dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return deleted, denied
+        except PermissionError:
+            return deleted, [item[1] for item in items]
+
+        try:
+            for item in items:
+                try:
+                    os.unlink(os.path.basename(item[1]), dir_fd=dir_fd)
+                    deleted.append(item)
+                except FileNotFoundError:
+                    pass
+                except PermissionError:
+                    denied.append(item[1])
+        finally:
+            os.close(dir_fd)
+
+        if deleted:
+            self.touched.add(os.path.normpath(dir_path))
+        return deleted, denied
+
+    def prune(self):
+        """Removes the directories emptied by delete, deepest first, returns how many"""
+        pending = [(-path.count(os.sep), path) for path in self.touched]
+        heapq.heapify(pending)
+        seen = set(self.touched)
+        self.touched = set()
+
+        pruned_count = 0
+        while pending:
+            _, dir_path = heapq.heappop(pending)
+            if (dir_path == self.stop_dir) or \
+               (dir_path.startswith(self.stop_dir + os.sep) is False):
+                continue
+            try:
+                os.rmdir(dir_path)
+            except OSError: #Not empty, vanished or not allowed
+                continue
+            pruned_count += 1
+
+            parent = os.path.dirname(dir_path)
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(pending, (-parent.count(os.sep), parent))
+
+        self.pruned_count += pruned_count
+        return pruned_count
+
+    def close(self):
+        """Shuts down the worker pool"""
+        if self.workers is not None:
+            for worker in self.workers:
+                worker.shutdown()
+            self.workers = None
@@ -0,0 +1,130 @@
+"""
+This file contains the CleanJournal, an append-only record of DkClean operations
+Every clean run writes a 'run' entry, a 'plan' entry for every file put in the
+clean que and a 'done' or 'skip' entry once the file has been handled. Entries are
+JSON lists, one per line, fsync'd in batches so a crash loses at most the last batch.
+A plan without a done/skip entry in the last run is unfinished and can be resumed,
+done entries of moved and archived files are used to restore them. After a clean
+run finishes the journal is compacted to the done entries restore still needs
+"""
+
+import os, json, time, threading
+
+class CleanJournal:
+    """
+    Appends entries to a task's journal file
+    A torn last line left by a crash is ended first so the next entry stays readable
+    """
+
+    def __init__(self, journal_path, sync_entries=1000, sync_seconds=5):
+        self.journal_path = journal_path
+        self.sync_entries = max(1, sync_entries)
+        self.sync_seconds = sync_seconds
+
+        self.journal_file = open(journal_path, "a")
+        if self.journal_file.tell() > 0:
+            with open(journal_path, "rb") as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b"\n":
+                    self.journal_file.write("\n")
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def write(self, entry):
+        """Appends one entry and syncs once a batch is full or old enough"""
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_entries) or \
+               ((time.time() - self.last_sync) >= self.sync_seconds):
+                self.sync_locked()
+
+    def begin(self, resumed=False):
+        """Marks the start of a clean run, a resumed run keeps the unfinished plan"""
+        self.write(["resume" if resumed is True else "run", int(time.time())])
+
+    def plan(self, item):
+        """Records a que item (priority_num, file_path, file_size) before it is cleaned"""
+        self.write(["plan", item[0], item[1], item[2]])
+
+    def done(self, action, file_path, destination, file_size):
+        """Records a file that was moved, archived or deleted"""
+        self.write(["done", action, file_path, destination, file_size])
+
+    def skip(self, file_path):
+        """Records a planned file that could not be cleaned"""
+        self.write(["skip", file_path])
+
+    def restored(self, file_path):
+        """Records a file that was put back in its original place"""
+        self.write(["restored", file_path])
+
+    def sync(self):
+        """Flushes all written entries to disk"""
+        with self.lock:
+            self.sync_locked()
+
+    def sync_locked(self):
+        """Flushes all written entries to disk, the caller holds the lock"""
+        if self.unsynced > 0:
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        """Syncs and closes the journal file"""
+        with self.lock:
+            self.sync_locked()
+            self.journal_file.close()
+
+
+def read_journal(journal_path):
+    """Yields the entries of a journal file, a torn last line is ignored"""
+    try:
+        with open(journal_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def unfinished_items(journal_path):
+    """Returns the que items of the last run that have no done or skip entry"""
+    planned = {}
+    for entry in read_journal(journal_path):
+        if entry[0] == "run":
+            planned = {}
+        elif entry[0] == "plan":
+            planned[entry[2]] = (entry[1], entry[2], entry[3])
+        elif entry[0] == "done":
+            planned.pop(entry[2], None)
+        elif entry[0] == "skip":
+            planned.pop(entry[1], None)
+    return sorted(planned.values())
+
+def compact_journal(journal_path):
+    """
+    Rewrites a journal with only the done entries of moved and archived files that
+    have not been restored, the new file replaces the old one once it is synced
+    Returns the number of kept entries
+    """
+    kept = {}
+    for entry in read_journal(journal_path):
+        if (entry[0] == "done") and (entry[1] != "delete"):
+            kept.pop(entry[2], None) #A file cleaned again is kept at its last position
+            kept[entry[2]] = entry
+        elif entry[0] == "restored":
+            kept.pop(entry[1], None)
+
+    compact_path = journal_path + ".compact"
+    with open(compact_path, "w") as journal_file:
+        for entry in kept.values():
+            journal_file.write(json.dumps(entry) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(compact_path, journal_path)
+    return len(kept)
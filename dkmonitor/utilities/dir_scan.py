@@ -1,36 +1,97 @@
 """
-Single function that yeilds every file in a directory tree
+Directory walkers that yeild every file in a directory tree
+
+The walker is built on os.scandir so that the file type of each entry comes
+from the directory listing itself and every file is stat'ed at most once
 """
 
 import os
+from collections import namedtuple, Counter
 
-def dir_scan(base_dir):
+FileRecord = namedtuple('FileRecord', 'path uid size atime mtime inode')
+
+class TreeWalker:
+    """
+    Walks a directory tree with os.scandir and yields a FileRecord for every
+    regular file found. Directories waiting to be listed are kept on a stack,
+    entries are streamed from the directory listing so large directories
+    are never loaded into memory all at once.
+    Symbolic links are not followed.
+    Entries that can not be read are skipped and counted in errors
+    ("permission_denied" or "vanished")
     """
-    Returns every file path in a directory tree
 
-    **Wrapper function for dir_scan_generator that throws a permissions
-    error if base_dir's permisssions are incorrect
+    def __init__(self, base_dir, errors=None):
+        self.base_dir = base_dir
+        self.pending = [base_dir]
+        self.errors = Counter() if errors is None else errors
 
-    INPUT: path to a directory to scan
-    OUTPUT: Generator object that yeild all file paths in a direcotry
-    """
-    def dir_scan_generator(base_dir):
-        """Return every file in a directory tree"""
+    def walk(self):
+        """Yields a FileRecord for every file under base_dir"""
+        while self.pending:
+            yield from self.scan_dir(self.pending.pop())
+
+    def scan_dir(self, dir_path):
+        """
+        Yields a FileRecord for each file directly inside dir_path
+        and pushes its sub directories onto the pending stack
+        """
         try:
-            content_list = os.listdir(base_dir)
-            for path in content_list:
-                current_path = os.path.join(base_dir, path)
-                if os.path.isfile(current_path):
-                    yield current_path
-                elif os.path.isdir(current_path):
-                    yield from dir_scan_generator(current_path)
-                else:
-                    pass
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            self.push_dir(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield file_record(entry)
+                    except PermissionError:
+                        self.errors["permission_denied"] += 1
+                    except FileNotFoundError:
+                        self.errors["vanished"] += 1
         except PermissionError:
-            pass
+            self.errors["permission_denied"] += 1
+        except (FileNotFoundError, NotADirectoryError):
+            self.errors["vanished"] += 1
+
+    def push_dir(self, dir_path):
+        """Adds a directory to the stack of directories waiting to be listed"""
+        self.pending.append(dir_path)
+
+
+def file_record(entry):
+    """Builds a FileRecord from a DirEntry with a single (cached) stat call"""
+    stat_info = entry.stat(follow_symlinks=False)
+    return FileRecord(entry.path,
+                      stat_info.st_uid,
+                      stat_info.st_size,
+                      stat_info.st_atime,
+                      stat_info.st_mtime,
+                      stat_info.st_ino)
+
+def scan_files(base_dir, errors=None):
+    """
+    Returns a generator of FileRecords for every file in a directory tree
+
+    Raises a PermissionError if base_dir can not be read
 
-    #TODO better error catching
+    INPUT: path to a directory to scan
+           optional Counter that unreadable entries are counted in
+    OUTPUT: Generator object that yeilds a FileRecord for every file
+            (path, uid, size, atime, mtime, inode)
+    """
     if os.access(base_dir, os.R_OK) is True:
-        return dir_scan_generator(base_dir)
+        return TreeWalker(base_dir, errors).walk()
     else:
         raise PermissionError
+
+def dir_scan(base_dir):
+    """
+    Returns every file path in a directory tree
+
+    **Wrapper function for scan_files that throws a permissions
+    error if base_dir's permisssions are incorrect
+
+    INPUT: path to a directory to scan
+    OUTPUT: Generator object that yeild all file paths in a direcotry
+    """
+    return (record.path for record in scan_files(base_dir))
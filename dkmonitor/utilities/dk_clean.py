@@ -4,13 +4,19 @@ dk_clean is used to move all old files from one directory to another
 """
 
 import re, time, shutil, pwd, errno
-import threading, queue
+import threading, queue, heapq
 
 import sys, os
-sys.path.append(os.path.abspath("../.."))
 
 from dkmonitor.utilities import log_setup
-from dkmonitor.utilities.dir_scan import dir_scan
+from dkmonitor.utilities.dir_scan import scan_files
+from dkmonitor.utilities.relocate import RelocationTree, Relocator, CapacityPlanner
+from dkmonitor.utilities.relocate import MOVE, DELETE
+from dkmonitor.utilities.bulk_delete import BulkDeleter
+from dkmonitor.utilities.archive import ArchiveWriter
+from dkmonitor.utilities.uid_resolver import get_resolver
+from dkmonitor.utilities.clean_journal import CleanJournal, unfinished_items
+from dkmonitor.utilities.clean_journal import compact_journal
 from dkmonitor.utilities.dk_stat import get_disk_use_percent
 from dkmonitor.config.settings_manager import export_settings
 from dkmonitor.config.task_manager import check_alteration_settings, check_relocate
@@ -21,52 +27,319 @@ class ConflictingSettingsError(Exception):
         super(ConflictingSettingsError, self).__init__(message)
 
 
+#Sorts after every real que item (priority_num, file_path, file_size)
+STOP_ITEM = (float("inf"), "", 0)
+
+class CleanCandidates:
+    """
+    Selects the old files of a task that should be cleaned.
+    Files are kept in a thread safe priority que ordered by size * age so that
+    the same selection can be filled by DkClean's own walk or by DkStat.scan
+    in single pass mode. complete is set once a scan has offered every file
+
+    When bytes_needed is set only the highest priority files whose combined
+    size frees bytes_needed are kept (at most max_candidates of them) in a
+    bounded heap, truncated is set if the cap dropped files that were needed
+
+    Every file put in the que is planned in the journal once one is attached (files
+    a scan queued before are planned by attach_journal), resumed is set when the que
+    was filled from the journal of an interrupted clean
+    """
+
+    def __init__(self, task, bytes_needed=None, max_candidates=None, target_percent=None,
+                 que_size=0):
+        self.task = task
+        self.bytes_needed = bytes_needed
+        self.max_candidates = max_candidates
+        self.target_percent = target_percent
+
+        self.que = queue.PriorityQueue(que_size)
+        self.heap = []
+        self.heap_bytes = 0
+        self.truncated = False
+        self.lock = threading.Lock()
+        self.complete = False
+        self.journal = None
+        self.resumed = False
+
+    def attach_journal(self, journal):
+        """
+        Plans every file in the journal from now on, files already in the que
+        are planned first unless the que was filled from the journal
+        """
+        with self.que.mutex:
+            queued = list(self.que.queue)
+        if self.resumed is False:
+            for item in queued:
+                journal.plan(item)
+        self.journal = journal
+
+    def put(self, item):
+        """Puts a que item in the que and plans it in the journal"""
+        if self.journal is not None:
+            self.journal.plan(item)
+        self.que.put(item)
+
+    def add_record(self, record, now):
+        """Adds a FileRecord to the que if it is older than old_file_threshold"""
+        last_access = (now - record.atime) / 86400
+        if last_access > self.task["old_file_threshold"]:
+            priority_num = record.size * last_access
+            if self.bytes_needed is None:
+                self.put((-priority_num, record.path, record.size))
+            else:
+                self.select(priority_num, record.path, record.size)
+
+    def select(self, priority_num, file_path, file_size):
+        """Adds a file to the bounded heap and drops the files that are not needed"""
+        with self.lock:
+            heapq.heappush(self.heap, (priority_num, file_path, file_size))
+            self.heap_bytes += file_size
+            while self.heap and \
+                  ((self.heap_bytes - self.heap[0][2] >= self.bytes_needed) or \
+                   ((self.max_candidates is not None) and \
+                    (len(self.heap) > self.max_candidates))):
+                _, _, dropped_size = heapq.heappop(self.heap)
+                self.heap_bytes -= dropped_size
+                if self.heap_bytes < self.bytes_needed:
+                    self.truncated = True
+
+    def fill_que(self):
+        """Moves the selected files from the bounded heap to the priority que"""
+        with self.lock:
+            for priority_num, file_path, file_size in self.heap:
+                self.put((-priority_num, file_path, file_size))
+            self.heap = []
+            self.heap_bytes = 0
+
+
 class DkClean:
     """The class dk_clean is used to move old files from one directory to an other.
     The process can be run with multithreading or just iterativly"""
 
-    def __init__(self, task):
+    def __init__(self, task, candidates=None):
         self.task = task
-        self.thread_settings = export_settings()["Thread_Settings"]
+        settings = export_settings()
+        self.thread_settings = settings["Thread_Settings"]
+        self.clean_settings = settings["Cleaning_Settings"]
+
+        #The que only has a size limit when worker threads drain it while it is filled
+        if self.thread_settings["thread_mode"] is True:
+            self.que_size = self.thread_settings["clean_queue_size"]
+        else:
+            self.que_size = 0
 
-        self.que = queue.PriorityQueue()
+        self.pre_scanned = (candidates is not None) and (candidates.complete is True)
+        if self.pre_scanned is False:
+            candidates = new_candidates(task, self.que_size)
+        self.candidates = candidates
+        self.que = candidates.que
         self.permission_error_que = queue.PriorityQueue()
         self.full_disk_que = queue.PriorityQueue()
 
+        self.relocation_tree = None
+        self.relocator = None
+        self.planner = None
+        self.archiver = None
+        if check_relocate(task) is True:
+            self.relocation_tree = RelocationTree(os.path.join(task["relocation_path"],
+                                                               task["hostname"]))
+            self.relocator = Relocator(task["target_path"],
+                                       task["relocation_path"],
+                                       self.thread_settings["copy_threads"],
+                                       self.clean_settings["large_file_size"],
+                                       self.clean_settings["copy_chunk_size"])
+            self.planner = CapacityPlanner(
+                task["relocation_path"],
+                task["delete_when_full"],
+                self.relocator.same_device,
+                self.clean_settings["relocation_reserve"],
+                self.clean_settings["capacity_check_interval"],
+                self.relocator)
+            if self.clean_settings["relocation_mode"] == "archive":
+                self.archiver = ArchiveWriter(
+                    os.path.join(task["relocation_path"], task["hostname"]),
+                    get_resolver(settings["Scan_Settings"]),
+                    self.clean_settings["archive_size"],
+                    self.clean_settings["archive_compress_level"],
+                    self.clean_settings["archive_sync_files"])
+                self.planner.same_device = False #Archives take space on any device
+
+        self.deleter = None
+        if (check_relocate(task) is False) and (task["delete_old_files"] is True):
+            worker_number = 1
+            if self.thread_settings["thread_mode"] is True:
+                worker_number = self.thread_settings["clean_threads"]
+            self.deleter = BulkDeleter(task["target_path"], worker_number)
+
+        self.journal = get_journal(task)
+        if self.journal is not None:
+            self.journal.begin(candidates.resumed)
+            self.candidates.attach_journal(self.journal)
+
+        self.freed_bytes = 0
+        self.cleaned_count = 0
+        self.pass_start_bytes = 0
+        self.reached_target = False
+        self.tally_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.worker_error = None
+
         self.logger = log_setup.setup_logger(__name__)
 
     def build_file_que(self):
-        """Adds old file paths to a thread safe que"""
+        """
+        Adds old file paths to a thread safe que
+        If candidates were already collected by a scan the tree is not walked again
+        """
         print("Moving Files")
-        for file_path in dir_scan(self.task["target_path"]):
-            last_access = (time.time() - os.path.getatime(file_path)) / 86400
-            if last_access > self.task["old_file_threshold"]:
-                old_file_size = int(os.path.getsize(file_path))
-                priority_num = - (old_file_size * last_access)
-                self.que.put((priority_num, file_path))
-
-    def move_file(self, file_path):
-        """Moves individual file while still preseving its file path"""
+        if self.pre_scanned is False:
+            now = time.time()
+            for record in scan_files(self.task["target_path"]):
+                if self.stop_event.is_set() is True:
+                    break
+                self.candidates.add_record(record, now)
+        self.candidates.fill_que()
+        self.logger.info("Cleaning %s candidate files from %s",
+                         self.que.qsize(),
+                         self.task["target_path"])
+
+    def clean_item(self, clean_function, item):
+        """Cleans one que item and returns True once the clean target has been reached"""
+        if self.reached_target is False:
+            _, file_path, file_size = item
+            if clean_function(file_path, file_size) is True:
+                with self.tally_lock:
+                    self.freed_bytes += file_size
+                    self.cleaned_count += 1
+                    if self.check_target() is True:
+                        self.reached_target = True
+                        self.stop_event.set()
+        return self.reached_target
+
+    def clean_batch(self, items):
+        """Deletes a batch of que items, returns True once the clean target has been reached"""
+        if self.reached_target is False:
+            deleted, denied = self.deleter.delete(items)
+            for file_path in denied:
+                self.permission_error_que.put(file_path)
+                self.record_skip(file_path)
+            for _, file_path, file_size in deleted:
+                self.record_done("delete", file_path, None, file_size)
+            with self.tally_lock:
+                for _, _, file_size in deleted:
+                    self.freed_bytes += file_size
+                    self.cleaned_count += 1
+                    if self.check_target() is True:
+                        self.reached_target = True
+                        self.stop_event.set()
+        return self.reached_target
+
+    def next_batch(self, first_item):
+        """Returns first_item and the items that are waiting in the que, up to delete_batch_size"""
+        batch = [first_item]
+        batch_size = self.clean_settings["delete_batch_size"]
+        try:
+            while len(batch) < batch_size:
+                batch.append(self.que.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def check_target(self):
+        """
+        Returns True once enough space has been freed to reach the clean target
+        The byte tally is checked after every file, disk use every usage_check_interval files
+        """
+        if self.candidates.bytes_needed is None:
+            return False
+        if (self.freed_bytes - self.pass_start_bytes) >= self.candidates.bytes_needed:
+            return True
+        if self.cleaned_count % max(1, self.clean_settings["usage_check_interval"]) == 0:
+            disk_use = get_disk_use_percent(self.task["target_path"])
+            return disk_use <= self.candidates.target_percent
+        return False
+
+    def next_pass(self):
+        """
+        Returns True if the clean target was not reached because the bounded
+        selection dropped files, the candidates are reset for another walk
+        """
+        if (self.reached_target is True) or (self.candidates.truncated is False) or \
+           (self.freed_bytes == self.pass_start_bytes) or (self.worker_error is not None):
+            return False
+
+        self.logger.info("Clean target not reached on %s, selecting more files",
+                         self.task["target_path"])
+        self.candidates = new_candidates(self.task)
+        self.candidates.que = self.que
+        if self.journal is not None:
+            self.candidates.attach_journal(self.journal)
+        self.pre_scanned = False
+        self.pass_start_bytes = self.freed_bytes
+        return self.candidates.bytes_needed != 0
+
+    def move_file(self, file_path, file_size=0):
+        """
+        Moves individual file while still preseving its file path
+        In archive mode files up to archive_max_file_size are packed into the owner's archive
+        The capacity planner decides first if the file fits in relocation_path,
+        files that do not fit are deleted (delete_when_full) or skipped
+        Returns True if the file was moved (or deleted because relocation_path is full)
+        """
+        decision = self.planner.decide(file_size)
+        if decision == DELETE:
+            return self.delete_file(file_path, file_size)
+        if decision != MOVE:
+            self.full_disk_que.put(file_path)
+            self.record_skip(file_path)
+            return False
+
         try:
-            new_file_path = self.create_dir_tree(file_path)
-            shutil.move(file_path, new_file_path)
+            if (self.archiver is not None) and \
+               (file_size <= self.clean_settings["archive_max_file_size"]):
+                archive_path = self.archiver.add(file_path)
+                self.record_done("archive", file_path, archive_path, file_size)
+            else:
+                new_file_path = self.create_dir_tree(file_path)
+                self.relocator.move(file_path, new_file_path)
+                self.record_done("move", file_path, new_file_path, file_size)
+            return True
         except IOError as err:
             if err.errno == errno.EACCES: #Permission error
                 self.permission_error_que.put(file_path)
-            if err.errno == errno.ENOSPC: #Disk full
+            if err.errno == errno.ENOSPC: #Disk filled up by someone else
+                self.planner.full()
                 if self.task["delete_when_full"] is True:
-                    self.delete_file(file_path)
+                    return self.delete_file(file_path, file_size)
                 else:
                     self.full_disk_que.put(file_path)
-                    raise err
+        finally:
+            self.planner.finish(file_size)
+        self.record_skip(file_path)
+        return False
 
-    def delete_file(self, file_path):
-        """Deletes file"""
+    def delete_file(self, file_path, file_size=0):
+        """Deletes file, returns True if the file was deleted"""
         try:
             os.remove(file_path)
+            self.record_done("delete", file_path, None, file_size)
+            return True
         except IOError as err:
             if err.errno == errno.EACCES:
                 self.permission_error_que.put(file_path)
+        self.record_skip(file_path)
+        return False
+
+    def record_done(self, action, file_path, destination, file_size):
+        """Records a cleaned file in the journal"""
+        if self.journal is not None:
+            self.journal.done(action, file_path, destination, file_size)
+
+    def record_skip(self, file_path):
+        """Records a file that could not be cleaned in the journal"""
+        if self.journal is not None:
+            self.journal.skip(file_path)
 
     def create_file_tree(self, uid, path):
         """Creates file tree after move_to with user ownership"""
@@ -84,68 +357,190 @@ class DkClean:
 
     def create_dir_tree(self, file_path):
         """Creates file tree with correct permissions and returns the newfile path"""
-        new_path = os.path.join(self.task["relocation_path"], self.task["hostname"])
-
-        dir_path = file_path[:file_path.rfind('/')]
-        split_dir_path = dir_path.split("/")
-        current_path = "/"
-        for directory in split_dir_path:
-            current_path = os.path.join(current_path, directory)
-            try:
-                dir_stat_info = os.stat(current_path)
-                uid = dir_stat_info.st_uid
-                gid = dir_stat_info.st_gid
-                mod = dir_stat_info.st_mode
-
-                new_path = os.path.join(new_path, directory)
-                os.mkdir(new_path)
-                os.chmod(new_path, mod)
-                os.chown(new_path, uid, gid)
-            except OSError as err:
-                if err.errno == errno.EEXIST:
-                    pass
-                elif err.errno == errno.EACCES:
-                    print("ERROR: You must have rootly powers to move files", file=sys.stderr)
-                    self.logger.error("Could not move files because user does not have root access")
-                    os._exit(1)
+        dir_path, file_name = os.path.split(file_path)
+        try:
+            new_path = self.relocation_tree.ensure(dir_path)
+        except PermissionError:
+            print("ERROR: You must have rootly powers to move files", file=sys.stderr)
+            self.logger.error("Could not move files because user does not have root access")
+            os._exit(1)
 
-        new_file_path = file_path.replace(dir_path, new_path)
-        return new_file_path
+        return os.path.join(new_path, file_name)
 
 
 
     #MULTI-THREADING######################################
     def async_worker(self, clean_function):
-        """Worker Function"""
+        """
+        Worker Function, cleans que items until it gets a STOP_ITEM
+        The first error raised by a worker stops the pipeline and is kept in worker_error,
+        later items are taken off the que without being cleaned so the producer never blocks
+        """
         while True:
-            path = self.que.get()
-            clean_function(path[1])
-            self.que.task_done()
+            item = self.que.get()
+            try:
+                if item is STOP_ITEM:
+                    return
+                if self.stop_event.is_set() is False:
+                    self.clean_item(clean_function, item)
+            except Exception as err:
+                with self.tally_lock:
+                    if self.worker_error is None:
+                        self.worker_error = err
+                self.stop_event.set()
+            finally:
+                self.que.task_done()
+
+    def bulk_worker(self):
+        """
+        Worker Function, takes batches off the que and deletes them until it gets a STOP_ITEM
+        Errors are kept in worker_error like in async_worker
+        """
+        while True:
+            batch = self.next_batch(self.que.get())
+            try:
+                items = [item for item in batch if item is not STOP_ITEM]
+                if items and (self.stop_event.is_set() is False):
+                    self.clean_batch(items)
+            except Exception as err:
+                with self.tally_lock:
+                    if self.worker_error is None:
+                        self.worker_error = err
+                self.stop_event.set()
+            finally:
+                for _ in batch:
+                    self.que.task_done()
+            if len(items) < len(batch):
+                return
+
+    def clean_disk_bulk(self):
+        """
+        Starts the batched delete routine
+        In thread mode one thread takes batches off the que while the walk fills it and the
+        BulkDeleter spreads each batch over clean_threads workers, otherwise the que is
+        filled first and deleted batch by batch. Emptied directories are removed at the end
+        """
+        start_time = time.time()
+        if self.thread_settings["thread_mode"] is True:
+            thread = threading.Thread(target=self.bulk_worker)
+            thread.daemon = True
+            thread.start()
+            try:
+                while True:
+                    self.build_file_que()
+                    self.que.join()
+                    if self.next_pass() is False:
+                        break
+            finally:
+                self.que.put(STOP_ITEM)
+                thread.join()
+        else:
+            while True:
+                self.build_file_que()
+                while not self.que.empty():
+                    if self.clean_batch(self.next_batch(self.que.get())) is True:
+                        break
+                if self.next_pass() is False:
+                    break
+
+        self.deleter.close()
+        pruned_count = self.deleter.prune()
+        self.finish(start_time)
+        self.logger.info("Removed %s empty directories from %s", pruned_count,
+                         self.task["target_path"])
+        if self.worker_error is not None:
+            self.logger.error("Cleaning %s stopped: %s", self.task["target_path"], self.worker_error)
+            raise self.worker_error
+        print("Done")
 
     def clean_disk_async(self, clean_function):
-        """Starts the threaded cleaning routine"""
-        #Start async worker thread
-        thread = threading.Thread(target=self.async_worker, args=(clean_function,))
-        thread.daemon = True
-        thread.start()
+        """
+        Starts the threaded cleaning routine
+        The walk feeds the bounded que while clean_threads workers drain it
+        Errors raised in a worker are re-raised here once all workers have stopped
+        """
+        start_time = time.time()
+        threads = []
+        for _ in range(max(1, self.thread_settings["clean_threads"])):
+            thread = threading.Thread(target=self.async_worker, args=(clean_function,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
 
-        self.build_file_que()
-        self.que.join()
+        try:
+            while True:
+                self.build_file_que()
+                self.que.join()
+                if self.next_pass() is False:
+                    break
+        finally:
+            for _ in threads:
+                self.que.put(STOP_ITEM)
+            for thread in threads:
+                thread.join()
 
-        self.print_and_log_file_errors()
+        self.finish(start_time)
+        if self.worker_error is not None:
+            self.logger.error("Cleaning %s stopped: %s", self.task["target_path"], self.worker_error)
+            raise self.worker_error
         print("Done")
 
     #ITERATIVE###########################################
     def clean_disk_iterative(self, clean_function):
         """Cleans disk iteratively"""
-        self.build_file_que()
-        while not self.que.empty():
-            file_path = self.que.get()
-            clean_function(file_path[1])
+        start_time = time.time()
+        while True:
+            self.build_file_que()
+            while not self.que.empty():
+                item = self.que.get()
+                if self.clean_item(clean_function, item) is True:
+                    break
+            if self.next_pass() is False:
+                break
 
-        self.print_and_log_file_errors()
+        self.finish(start_time)
         print("Done")
 
+    def finish(self, start_time):
+        """
+        Closes the relocation engines and the journal, then reports the clean
+        The journal of a clean that no worker error stopped is compacted to the
+        entries restore needs, nothing in it is left to resume
+        """
+        if self.relocator is not None:
+            self.relocator.close()
+        if self.archiver is not None:
+            self.archiver.close()
+        if self.journal is not None:
+            self.journal.close()
+            if self.worker_error is None:
+                compact_journal(self.journal.journal_path)
+        self.report_throughput(start_time)
+        self.print_and_log_file_errors()
+
+    def report_throughput(self, start_time):
+        """Prints and logs the number of files and bytes cleaned per second"""
+        elapsed = max(time.time() - start_time, 0.001)
+        message = ("Cleaned {files} files ({gbs} GB) from {path} in {secs} s: "
+                   "{fps} files/s, {mbps} MB/s").format(
+                       files=self.cleaned_count,
+                       gbs=round(self.freed_bytes/1024/1024/1024, 2),
+                       path=self.task["target_path"],
+                       secs=round(elapsed, 1),
+                       fps=round(self.cleaned_count/elapsed, 1),
+                       mbps=round(self.freed_bytes/1024/1024/elapsed, 2))
+        print(message)
+        self.logger.info(message)
+
+        if self.relocator is not None:
+            report = self.relocator.report()
+            if self.archiver is not None:
+                report = "{}, {}".format(report, self.archiver.report())
+            message = "Relocated to {path}: {report}".format(path=self.task["relocation_path"],
+                                                            report=report)
+            print(message)
+            self.logger.info(message)
+
     def print_and_log_file_errors(self):
         """Logs and prints the number of files that could not be moved or deleted"""
         perror_count = 0
@@ -171,26 +566,120 @@ class DkClean:
                                   dferror_count)
 
 
-def check_then_clean(task):
+def get_clean_target(task, clean_settings):
+    """
+    Returns the disk use percent cleaning should bring the disk down to
+    or None if every old file should be cleaned
+
+    clean_target in Cleaning_Settings is 'all', 'warning' (the task's
+    usage_warning_threshold), 'critical' or a percent
+    """
+    clean_target = str(clean_settings["clean_target"])
+    if clean_target == "warning":
+        return task["usage_warning_threshold"]
+    elif clean_target == "critical":
+        return task["usage_critical_threshold"]
+    elif clean_target.isdigit():
+        return int(clean_target)
+    return None
+
+def new_candidates(task, que_size=0):
+    """Returns an empty CleanCandidates object bounded by the task's clean target"""
+    clean_settings = export_settings()["Cleaning_Settings"]
+    target_percent = get_clean_target(task, clean_settings)
+    if target_percent is None:
+        return CleanCandidates(task, que_size=que_size)
+
+    use = shutil.disk_usage(task["target_path"])
+    bytes_needed = max(0, use.used - int(use.total * target_percent / 100))
+    return CleanCandidates(task,
+                           bytes_needed,
+                           clean_settings["max_clean_candidates"],
+                           target_percent,
+                           que_size)
+
+def get_journal(task):
+    """
+    Returns a CleanJournal for the task
+    or None if journals are turned off in Cleaning_Settings
+    """
+    journal_path = get_journal_path(task)
+    if journal_path is None:
+        return None
+    clean_settings = export_settings()["Cleaning_Settings"]
+    return CleanJournal(journal_path,
+                        clean_settings["journal_sync_entries"],
+                        clean_settings["journal_sync_seconds"])
+
+def get_journal_path(task):
+    """
+    Returns the path of the task's clean journal
+    or None if journals are turned off in Cleaning_Settings
+    """
+    clean_settings = export_settings()["Cleaning_Settings"]
+    if clean_settings["journal"] is False:
+        return None
+
+    journal_dir = os.path.expanduser(clean_settings["journal_dir"])
+    os.makedirs(journal_dir, exist_ok=True)
+    return os.path.join(journal_dir, "{}.journal".format(task["taskname"]))
+
+def resume_candidates(task):
+    """
+    Returns CleanCandidates holding the files an interrupted clean planned but
+    did not finish, bounded by the current clean target.
+    Returns None when there is nothing to resume
+    """
+    journal_path = get_journal_path(task)
+    if journal_path is None:
+        return None
+
+    candidates = new_candidates(task)
+    for item in unfinished_items(journal_path):
+        if os.path.lexists(item[1]) is True:
+            candidates.que.put(item)
+    if candidates.que.empty() is True:
+        return None
+    candidates.complete = True
+    candidates.resumed = True
+    return candidates
+
+def single_pass_candidates(task):
+    """
+    Returns an empty CleanCandidates object for DkStat.scan to fill when
+    single pass mode is on and the task's disk is over its critical threshold.
+    Returns None when the disk will not need cleaning
+    """
+    scan_settings = export_settings()["Scan_Settings"]
+    if (scan_settings["single_pass"] is True) and \
+       (check_alteration_settings(task) is True) and \
+       (get_disk_use_percent(task["target_path"]) > task["usage_critical_threshold"]):
+        return new_candidates(task)
+    return None
+
+def check_then_clean(task, candidates=None):
     """
     Checks weather the disk should be cleaned based on task settings
     and runs the correct routine (iterative/multithreaded
+    candidates collected by a previous scan are cleaned without walking the tree again
     """
     if check_alteration_settings(task) is True:
         print("Checking if disk: '{}' needs to be cleaned".format(task["target_path"]))
 
         disk_use = get_disk_use_percent(task["target_path"])
         if disk_use > task["usage_critical_threshold"]:
-            clean_obj = DkClean(task)
+            clean_obj = DkClean(task, candidates)
             clean_obj.logger.info("Cleaning disk %s on %s", task["target_path"], task["hostname"])
             if check_relocate(task) is True:
                 clean_function = clean_obj.move_file
             elif task["delete_old_files"] is True:
-                clean_function = clean_obj.delete_file
+                clean_function = None
             else:
                 raise ConflictingSettingsError(("Error both relocation_path ",
                                                 "and delete_old_files are set"))
-            if clean_obj.thread_settings["thread_mode"] == 'yes':
+            if clean_function is None: #Deletes are batched by directory
+                clean_obj.clean_disk_bulk()
+            elif clean_obj.thread_settings["thread_mode"] is True:
                 clean_obj.clean_disk_async(clean_function)
             else:
                 clean_obj.clean_disk_iterative(clean_function)
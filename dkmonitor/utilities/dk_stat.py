@@ -3,39 +3,50 @@ This file contains the DkStat object that scans a given disk or directory
 and stores the data in user and directory objects
 """
 
-import shutil, time, operator, datetime, pwd
-from collections import namedtuple
+import shutil, time, operator, datetime
 
 import sys, os
-sys.path.append(os.path.abspath("../.."))
 
-from dkmonitor.utilities.dir_scan import dir_scan
+from dkmonitor.utilities.dir_scan import TreeWalker, scan_files
+from dkmonitor.utilities.parallel_scan import ParallelWalker
+from dkmonitor.utilities.process_scan import ProcessScanner
+from dkmonitor.utilities.scan_index import ScanIndex, IncrementalScanner
+from dkmonitor.utilities.scan_checkpoint import ScanCheckpoint
+from dkmonitor.utilities.scan_totals import ScanTotals
+from dkmonitor.utilities.uid_resolver import get_resolver
 from dkmonitor.utilities import log_setup
 from dkmonitor.config.settings_manager import export_settings
-from dkmonitor.database_manager import DataBase, UserStats, DirectoryStats
+from dkmonitor.database_manager import DataBase, UserStats, DirectoryStats, database_options
 from dkmonitor.config.task_manager import check_alteration_settings, check_relocate
 
-FileTuple = namedtuple('FileTuple', 'file_size last_access')
-
 class DkStat:
     """
     DkStat is a class used to build user and system statictics
     as well as nofitications
     """
 
-    def __init__(self, task):
+    def __init__(self, task, full_rescan=False):
         self.task = task
+        self.full_rescan = full_rescan
         self.users = {}
+        self.unknown_users = set()
         self.directory = None
         self.settings = export_settings()
+        self.resolver = get_resolver(self.settings["Scan_Settings"])
         self.logger = log_setup.setup_logger(__name__)
 
-    def scan(self):
-        """Searches through the target_path for old files"""
+    def scan(self, candidates=None):
+        """
+        Searches through the target_path for old files
+        If a CleanCandidates object is given every file is also offered to it
+        so cleaning does not need to walk the tree a second time
+        (not available in process mode, cleaning then walks the tree itself)
+        """
         print("Scanning...")
         self.logger.info("Scanning %s on %s", self.task["target_path"], self.task["hostname"])
 
         self.users = {}
+        self.unknown_users = set()
 
         self.directory = DirectoryStats(target_path=self.task["target_path"],
                                         hostname=self.task["hostname"],
@@ -43,40 +54,190 @@ class DkStat:
                                         datetime=datetime.datetime.now())
         self.directory.disk_use_percent = get_disk_use_percent(self.task["target_path"])
 
-        for file_path in dir_scan(self.task["target_path"]):
-            last_access = (time.time() - os.path.getatime(file_path)) / 86400
-            file_size = int(os.path.getsize(file_path))
-            name = pwd.getpwuid(os.stat(file_path).st_uid).pw_name
+        totals = self.walk(candidates)
+        if (candidates is not None) and (totals.candidates is candidates):
+            candidates.complete = True
+
+        self.log_scan_errors(totals)
+        self.build_stats(totals)
+
+    def walk(self, candidates):
+        """
+        Walks the target_path with the scan mode set in the settings and returns its ScanTotals
+        Incremental scans take precedence over process, thread and serial scans
+        """
+        process_number = self.settings["Thread_Settings"]["scan_processes"]
+        thread_number = self.get_scan_thread_number()
+        index_path = self.get_index_path()
+        if (index_path is not None) and (candidates is None):
+            return self.walk_incremental(index_path)
+        elif process_number > 1:
+            totals = ScanTotals(time.time(), self.task["old_file_threshold"])
+            return ProcessScanner(self.task["target_path"], process_number, self.logger).run(totals)
+        elif thread_number > 1:
+            totals = ScanTotals(time.time(), self.task["old_file_threshold"], candidates)
+            walker = ParallelWalker(self.task["target_path"], thread_number)
+            for worker_totals in walker.run(totals.new_partial):
+                totals.merge(worker_totals)
+            totals.errors.update(walker.errors)
+            return totals
+        else:
+            return self.walk_serial(candidates)
+
+    def walk_incremental(self, index_path):
+        """Walks the target_path reusing the totals of unchanged directories"""
+        totals = ScanTotals(time.time(), self.task["old_file_threshold"])
+        index = ScanIndex(index_path, self.task["old_file_threshold"])
+        if self.full_rescan is True:
+            index.clear()
+        scanner = IncrementalScanner(self.task["target_path"], index)
+        try:
+            scanner.run(totals)
+        finally:
+            index.close()
+        self.logger.info("Incremental scan of %s: %s directories listed, %s reused",
+                         self.task["target_path"],
+                         scanner.listed_count,
+                         scanner.reused_count)
+        return totals
+
+    def walk_serial(self, candidates):
+        """
+        Walks the target_path in a single thread
+        With checkpoints turned on the frontier and totals are saved periodically
+        and an interrupted scan of the task is resumed from its last checkpoint
+        (files found before the interruption are not offered to candidates)
+        """
+        checkpoint = self.get_checkpoint()
+        if checkpoint is None:
+            totals = ScanTotals(time.time(), self.task["old_file_threshold"], candidates)
+            for record in scan_files(self.task["target_path"], totals.errors):
+                totals.add_record(record)
+            return totals
+
+        walker = TreeWalker(self.task["target_path"], None)
+        resumed = None
+        if self.full_rescan is False:
+            resumed = checkpoint.load(self.task["target_path"], self.task["old_file_threshold"])
+        if resumed is None:
+            if os.access(self.task["target_path"], os.R_OK) is False:
+                raise PermissionError
+            totals = ScanTotals(time.time(), self.task["old_file_threshold"], candidates)
+        else:
+            walker.pending, totals = resumed
+            print("Resuming scan of {} from checkpoint".format(self.task["target_path"]))
+            self.logger.info("Resuming scan of %s from checkpoint with %s files scanned",
+                             self.task["target_path"],
+                             totals.directory.number_of_files)
+        walker.errors = totals.errors
+
+        while walker.pending:
+            for record in walker.scan_dir(walker.pending.pop()):
+                totals.add_record(record)
+            if checkpoint.due(totals) is True:
+                checkpoint.save(self.task["target_path"], walker.pending, totals)
+
+        checkpoint.remove()
+        return totals
+
+    def get_checkpoint(self):
+        """
+        Returns the ScanCheckpoint of the task
+        or None if checkpoints are turned off in Scan_Settings
+        """
+        scan_settings = self.settings["Scan_Settings"]
+        if scan_settings["checkpoint"] is False:
+            return None
+
+        state_dir = os.path.expanduser(scan_settings["state_dir"])
+        os.makedirs(state_dir, exist_ok=True)
+        return ScanCheckpoint(os.path.join(state_dir, "{}.scan.json".format(self.task["taskname"])),
+                              scan_settings["checkpoint_files"],
+                              scan_settings["checkpoint_seconds"],
+                              scan_settings["checkpoint_max_age"])
 
-            file_tup = FileTuple(file_size, last_access)
-            self.directory.add_file(file_tup, self.task["old_file_threshold"])
+    def get_index_path(self):
+        """
+        Returns the path of the task's incremental scan index
+        or None if incremental scans are turned off in Scan_Settings
+        """
+        scan_settings = self.settings["Scan_Settings"]
+        if scan_settings["incremental"] is False:
+            return None
 
+        index_dir = os.path.expanduser(scan_settings["index_dir"])
+        os.makedirs(index_dir, exist_ok=True)
+        return os.path.join(index_dir, "{}.sqlite".format(self.task["taskname"]))
+
+    def log_scan_errors(self, totals):
+        """Prints and logs the number of entries the scan could not read"""
+        for error, count in sorted(totals.errors.items()):
+            print("Scan of {path}: {count} files or directories {error}".format(
+                path=self.task["target_path"],
+                count=count,
+                error=error.replace("_", " ")), file=sys.stderr)
+            self.logger.warning("Scan of %s: %s files or directories %s",
+                                self.task["target_path"],
+                                count,
+                                error.replace("_", " "))
+
+    def get_scan_thread_number(self):
+        """
+        Returns the number of threads to walk the target_path with
+        The task's scan_threads column overrides Thread_Settings
+        """
+        thread_number = self.task.get("scan_threads")
+        if thread_number is None:
+            thread_number = self.settings["Thread_Settings"]["scan_threads"]
+        return int(thread_number)
+
+    def build_stats(self, totals):
+        """
+        Builds the UserStats and DirectoryStats rows from a scan's ScanTotals
+        User names are resolved once per distinct uid
+        """
+        self.directory.add_counts(totals.directory, totals.now)
+        for uid, counter in totals.users.items():
+            name = self.resolver.name(uid)
+            if self.resolver.is_unknown(uid) is True:
+                self.unknown_users.add(name)
             try:
-                self.users[name].add_file(file_tup, self.task["old_file_threshold"])
+                self.users[name].add_counts(counter, totals.now)
             except KeyError:
                 self.users[name] = UserStats(username=name,
                                              target_path=self.task["target_path"],
                                              hostname=self.task["hostname"],
                                              taskname=self.task["taskname"],
                                              datetime=datetime.datetime.now())
-                self.users[name].add_file(file_tup, self.task["old_file_threshold"])
+                self.users[name].add_counts(counter, totals.now)
 
         for _, user in self.users.items():
             user.calculate_stats()
         self.directory.calculate_stats()
+        self.resolver.save()
 
-    def store(self):
-        """Stores all stats in the database"""
+    def store(self, buffer=None):
+        """
+        Stores all stats in the database
+        If a StatsBuffer is given the rows are written later together with other tasks
+        """
         print("Storing stats")
         self.logger.info("Storing stats from %s on %s",
                          self.task["target_path"],
                          self.task["hostname"])
 
-        database = DataBase(**self.settings["DataBase_Settings"])
-
         rows = [x[1] for x in self.users.items()]
         rows.append(self.directory)
-        database.store(rows)
+        if buffer is not None:
+            buffer.add(rows)
+            return
+
+        database = DataBase(**database_options(self.settings["DataBase_Settings"]))
+        store_settings = self.settings["Store_Settings"]
+        if store_settings["bulk_insert"] is True:
+            database.bulk_store(rows, store_settings["use_copy"])
+        else:
+            database.store(rows)
 
     def email_users(self):
         """Emails users if nessesary"""
@@ -86,7 +247,7 @@ class DkStat:
            (disk_use > self.task["usage_critical_threshold"]):
 
             print("Emailing Data alteration notices")
-            for _, user in self.users.items():
+            for user in self.get_emailable_users():
                 if check_relocate(self.task) is True:
                     user.email_alteration_notice(self.task,
                                                  self.settings["Email_Settings"]["user_postfix"],
@@ -100,7 +261,7 @@ class DkStat:
              (self.task["email_usage_warnings"] is True):
             print("Emailing Usage Warnings")
             problem_users = self.get_problem_users()
-            for _, user in self.users.items():
+            for user in self.get_emailable_users():
                 user.email_usage_warning(self.task,
                                          self.settings["Email_Settings"]["user_postfix"],
                                          problem_users)
@@ -109,6 +270,10 @@ class DkStat:
 
 
 
+    def get_emailable_users(self):
+        """Returns all users except uids that have no user name to email"""
+        return [user for name, user in self.users.items() if name not in self.unknown_users]
+
     def get_problem_users(self):
         """
         Returns a list of lists
@@ -150,18 +315,18 @@ class DkStat:
         for user in sorted_user_keys:
             self.users[user].display_stats()
 
-def scan_store_email(task):
+def scan_store_email(task, candidates=None, full_rescan=False, buffer=None):
     """Function that runs entire scan routine on a task"""
-    statobj = DkStat(task)
-    statobj.scan()
-    statobj.store()
+    statobj = DkStat(task, full_rescan)
+    statobj.scan(candidates)
+    statobj.store(buffer)
     statobj.email_users()
 
-def scan_store_email_display(task):
+def scan_store_email_display(task, candidates=None, full_rescan=False, buffer=None):
     """Function that runs entire scan routine and displays the stats"""
-    statobj = DkStat(task)
-    statobj.scan()
-    statobj.store()
+    statobj = DkStat(task, full_rescan)
+    statobj.scan(candidates)
+    statobj.store(buffer)
     statobj.email_users()
     statobj.display_stats()
 
@@ -1,28 +1,176 @@
 """
-File containing simple function that returns log object
+File containing the process wide logging setup of dkmonitor
+Handlers are configured once per process: every dkmonitor logger hands its records
+to a QueueHandler and a QueueListener thread writes them to the rotating log file,
+so scan and clean threads never wait on disk. Levels can be set per module and the
+file can be written as plain text or as JSON lines
 """
 
-import os
-import warnings
+import os, json, copy, queue, atexit, datetime, threading
 import logging
 from logging import handlers
 
+ROOT_LOGGER = "dkmonitor"
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
-def setup_logger(log_file_path):
+LOGGING_DEFAULTS = {"log_file": None,
+                    "log_level": "info",
+                    "module_levels": "",
+                    "log_format": "text",
+                    "max_bytes": 1048576,
+                    "backup_count": 5}
+
+LOGGING_STATE = {"settings": None, "handler": None, "listener": None,
+                 "module_levels": {}, "explicit": False}
+LOGGING_LOCK = threading.Lock()
+
+class LoggingSettingsError(Exception):
+    """Error for when Logging_Settings holds an unknown level or format"""
+    def __init__(self, message):
+        super(LoggingSettingsError, self).__init__(message)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats every record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class RecordQueueHandler(handlers.QueueHandler):
+    """QueueHandler that keeps the message and the traceback of a record apart"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def get_level(name):
+    """Returns the logging level of a name like 'info' or 'DEBUG'"""
+    level = getattr(logging, str(name).strip().upper(), None)
+    if isinstance(level, int) is False:
+        raise LoggingSettingsError("Unknown log level '{}'".format(name))
+    return level
+
+def parse_module_levels(module_levels):
+    """
+    Parses module_levels, a comma separated list of logger:level pairs
+    e.g. 'dkmonitor.utilities.dk_clean:debug, dkmonitor.database_manager:warning'
+    """
+    levels = {}
+    for pair in module_levels.split(","):
+        if pair.strip() == "":
+            continue
+        name, _, level = pair.partition(":")
+        levels[name.strip()] = get_level(level)
+    return levels
+
+def load_logging_settings():
+    """Returns the Logging_Settings section, or the defaults when there is no settings file"""
+    from dkmonitor.config.settings_manager import export_settings, SettingsFileNotFoundError
+    try:
+        return export_settings().get("Logging_Settings", {})
+    except SettingsFileNotFoundError:
+        return {}
+
+def build_file_handler(settings):
+    """Returns the rotating file handler the listener thread writes with"""
+    log_file = settings["log_file"]
+    if not log_file:
+        log_file = os.path.join(os.environ.get("DKM_LOG", "~/.dkmonitor/log"), "dkmonitor.log")
+    log_file = os.path.expanduser(log_file)
+    os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+
+    file_handler = handlers.RotatingFileHandler(log_file,
+                                                maxBytes=settings["max_bytes"],
+                                                backupCount=settings["backup_count"])
+    if settings["log_format"] == "json":
+        file_handler.setFormatter(JsonLinesFormatter())
+    elif settings["log_format"] == "text":
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        raise LoggingSettingsError("Unknown log format '{}'".format(settings["log_format"]))
+    return file_handler
+
+def configure_logging(logging_settings=None):
     """
-    Takes log file name as input are returns a logger object
-    TODO:
+    Sets up the process wide handlers from a Logging_Settings mapping (read from the
+    settings files if None). Calling it again with the same settings does nothing,
+    new settings replace the handlers. Settings passed in are kept until the next
+    call, setup_logger does not reload them from the settings files
     """
+    explicit = logging_settings is not None
+    if logging_settings is None:
+        logging_settings = load_logging_settings()
+    settings = dict(LOGGING_DEFAULTS)
+    settings.update(logging_settings)
+
+    with LOGGING_LOCK:
+        LOGGING_STATE["explicit"] = explicit
+        if LOGGING_STATE["settings"] == settings:
+            return
+        level = get_level(settings["log_level"])
+        module_levels = parse_module_levels(settings["module_levels"])
+        file_handler = build_file_handler(settings)
+
+        stop_logging_locked()
+        record_queue = queue.Queue()
+        queue_handler = RecordQueueHandler(record_queue)
+        listener = handlers.QueueListener(record_queue, file_handler)
+        listener.start()
+
+        root_logger = logging.getLogger(ROOT_LOGGER)
+        root_logger.addHandler(queue_handler)
+        root_logger.setLevel(level)
+        for name in LOGGING_STATE["module_levels"]:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        for name, module_level in module_levels.items():
+            logging.getLogger(name).setLevel(module_level)
 
-    logger = logging.getLogger(log_file_path)
-    logger.setLevel(logging.INFO)
-    handler = handlers.RotatingFileHandler(log_file_path,
-                                           maxBytes=1048576,
-                                           backupCount=5)
-    formatter = logging.Formatter(("%(asctime)s - %(name)s - "
-                                   "%(levelname)s - %(message)s"))
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+        LOGGING_STATE.update(settings=settings, handler=queue_handler, listener=listener,
+                             module_levels=module_levels)
 
-    return logger
+def stop_logging():
+    """Writes out the queued records and removes the handlers"""
+    with LOGGING_LOCK:
+        stop_logging_locked()
 
+def stop_logging_locked():
+    """
+    Writes out the queued records and removes the handlers, the caller holds the lock
+    The settings are forgotten so configuring the same settings again restarts logging
+    """
+    if LOGGING_STATE["listener"] is None:
+        return
+    logging.getLogger(ROOT_LOGGER).removeHandler(LOGGING_STATE["handler"])
+    LOGGING_STATE["listener"].stop()
+    for handler in LOGGING_STATE["listener"].handlers:
+        handler.close()
+    LOGGING_STATE.update(settings=None, handler=None, listener=None)
+
+atexit.register(stop_logging)
+
+def setup_logger(logger_name):
+    """
+    Takes a logger name (dkmonitor passes __name__) and returns the logger object
+    The process wide handlers are configured by the first call, later calls add none
+    and only reconfigure them if Logging_Settings changed
+    """
+    if LOGGING_STATE["explicit"] is False:
+        configure_logging()
+    return logging.getLogger(logger_name)
@@ -0,0 +1,136 @@
+"""
+This file contains the ParallelWalker that scans a directory tree with a pool of threads
+On networked file systems most of a scan is spent waiting on metadata round trips,
+so several threads listing directories at once overlap that latency
+"""
+
+import os, threading, random
+from collections import deque, Counter
+
+from dkmonitor.utilities.dir_scan import TreeWalker
+
+class WorkerWalker(TreeWalker):
+    """
+    TreeWalker used by a single worker thread of a ParallelWalker
+    Sub directories are pushed onto the worker's own deque where other
+    workers can steal them
+    """
+
+    def __init__(self, parent, base_dir):
+        super().__init__(base_dir)
+        self.parent = parent
+        self.pending = deque()
+
+    def push_dir(self, dir_path):
+        """Counts the new directory as outstanding work and queues it"""
+        self.parent.add_pending()
+        self.pending.append(dir_path)
+
+
+class ParallelWalker:
+    """
+    Walks a directory tree with thread_number threads
+    Each worker lists directories from its own deque (newest first) and steals
+    the oldest directory from another worker when its own deque is empty.
+    Every worker feeds the FileRecords it finds to its own consumer so no
+    locking is needed on the hot path, the consumers are returned to be merged
+    """
+
+    def __init__(self, base_dir, thread_number):
+        self.base_dir = base_dir
+        self.thread_number = max(1, thread_number)
+        self.walkers = [WorkerWalker(self, base_dir) for _ in range(self.thread_number)]
+
+        self.pending_count = 0
+        self.condition = threading.Condition()
+        self.error = None
+
+    @property
+    def errors(self):
+        """Returns the combined error counts of all workers"""
+        errors = Counter()
+        for walker in self.walkers:
+            errors.update(walker.errors)
+        return errors
+
+    def add_pending(self):
+        """Marks one more directory as waiting to be listed"""
+        with self.condition:
+            self.pending_count += 1
+            self.condition.notify()
+
+    def finish_dir(self):
+        """Marks a directory as listed and wakes all workers when the walk is done"""
+        with self.condition:
+            self.pending_count -= 1
+            if self.pending_count == 0:
+                self.condition.notify_all()
+
+    def next_dir(self, index):
+        """Returns the next directory for worker index, stealing if needed"""
+        try:
+            return self.walkers[index].pending.pop()
+        except IndexError:
+            pass
+
+        victims = list(range(self.thread_number))
+        random.shuffle(victims)
+        for victim in victims:
+            if victim != index:
+                try:
+                    return self.walkers[victim].pending.popleft()
+                except IndexError:
+                    pass
+        return None
+
+    def worker(self, index, consumer):
+        """Worker thread loop"""
+        walker = self.walkers[index]
+        while True:
+            dir_path = self.next_dir(index)
+            if dir_path is None:
+                with self.condition:
+                    if (self.pending_count == 0) or (self.error is not None):
+                        return
+                    self.condition.wait(0.05)
+                continue
+
+            try:
+                if self.error is None:
+                    for record in walker.scan_dir(dir_path):
+                        consumer.add_record(record)
+            except Exception as err: #Stop the walk and re-raise in the calling thread
+                with self.condition:
+                    if self.error is None:
+                        self.error = err
+                    self.condition.notify_all()
+            finally:
+                self.finish_dir()
+
+    def run(self, consumer_factory):
+        """
+        Runs the walk and returns the list of per worker consumers
+
+        INPUT: consumer_factory, called once per worker, must return an object
+               with an add_record(FileRecord) method
+        OUTPUT: list of consumers
+        """
+        if os.access(self.base_dir, os.R_OK) is False:
+            raise PermissionError
+
+        consumers = [consumer_factory() for _ in range(self.thread_number)]
+        self.add_pending()
+        self.walkers[0].pending.append(self.base_dir)
+
+        threads = []
+        for index, consumer in enumerate(consumers):
+            thread = threading.Thread(target=self.worker, args=(index, consumer))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return consumers
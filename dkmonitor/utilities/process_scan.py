@@ -0,0 +1,75 @@
+"""
+This file contains the process pool scan used for very large directory trees
+The target_path is split into its top level sub trees which are scanned in
+worker processes so per file work is not limited by a single interpreter
+Workers return compact per uid totals instead of per file objects
+"""
+
+import os, time
+from concurrent import futures
+
+from dkmonitor.utilities.dir_scan import TreeWalker
+from dkmonitor.utilities.scan_totals import ScanTotals
+
+PROGRESS_INTERVAL = 30 #Seconds between progress messages
+
+def scan_subtree(dir_path, now, old_file_threshold):
+    """
+    Worker process entry point, scans one sub tree
+
+    INPUT: directory to scan, scan start time, old_file_threshold in days
+    OUTPUT: compact ScanTotals (see ScanTotals.compact)
+    """
+    totals = ScanTotals(now, old_file_threshold)
+    for record in TreeWalker(dir_path, totals.errors).walk():
+        totals.add_record(record)
+    return totals.compact()
+
+
+class ProcessScanner:
+    """
+    Scans a directory tree with a pool of worker processes
+    Files directly in base_dir are scanned by the calling process,
+    every top level sub directory is sent to the pool as a separate job
+    """
+
+    def __init__(self, base_dir, process_number, logger=None):
+        self.base_dir = base_dir
+        self.process_number = max(1, process_number)
+        self.logger = logger
+
+    def run(self, totals):
+        """Scans base_dir and merges all worker results into totals"""
+        if os.access(self.base_dir, os.R_OK) is False:
+            raise PermissionError
+
+        top_walker = TreeWalker(self.base_dir, totals.errors)
+        for record in top_walker.scan_dir(top_walker.pending.pop()):
+            totals.add_record(record)
+        sub_trees = top_walker.pending
+
+        done_count = 0
+        last_report = time.time()
+        with futures.ProcessPoolExecutor(max_workers=self.process_number) as pool:
+            jobs = [pool.submit(scan_subtree, sub_tree, totals.now, totals.old_file_threshold)
+                    for sub_tree in sub_trees]
+            for job in futures.as_completed(jobs):
+                totals.merge_compact(job.result())
+                done_count += 1
+                if time.time() - last_report > PROGRESS_INTERVAL:
+                    last_report = time.time()
+                    self.report_progress(done_count, len(jobs), totals)
+
+        self.report_progress(done_count, len(sub_trees), totals)
+        return totals
+
+    def report_progress(self, done_count, job_count, totals):
+        """Prints and logs how many sub trees and files have been scanned"""
+        message = "Scanned {done}/{jobs} sub trees of {path}: {files} files".format(
+            done=done_count,
+            jobs=job_count,
+            path=self.base_dir,
+            files=totals.directory.number_of_files)
+        print(message)
+        if self.logger is not None:
+            self.logger.info(message)
@@ -0,0 +1,330 @@
+"""
+This file contains the classes used to relocate old files
+Relocated files keep their full path under relocation_path/<hostname>
+"""
+
+import os, stat, errno, time, threading
+from concurrent import futures
+
+class RelocationTree:
+    """
+    Mirrors source directories under a relocation root with the owner and mode
+    of the source directories. Every directory is created exactly once, directories
+    that are known to exist are remembered so later files in them cost no system calls.
+    New directories are created relative to an open parent directory fd
+    """
+
+    def __init__(self, relocation_root):
+        self.relocation_root = relocation_root
+        self.created = set()
+        self.lock = threading.Lock()
+
+    def destination(self, source_dir):
+        """Returns the mirrored path of a source directory"""
+        return os.path.join(self.relocation_root, source_dir.lstrip("/"))
+
+    def ensure(self, source_dir):
+        """Creates the mirror of source_dir (and its missing parents) and returns its path"""
+        source_dir = os.path.normpath(source_dir)
+        if source_dir in self.created:
+            return self.destination(source_dir)
+
+        with self.lock:
+            missing = []
+            current = source_dir
+            while (current not in self.created) and (current != "/"):
+                missing.append(current)
+                current = os.path.dirname(current)
+
+            if current == "/" and ("/" not in self.created):
+                os.makedirs(self.relocation_root, exist_ok=True)
+                self.created.add("/")
+
+            parent_fd = os.open(self.destination(current), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for source_path in reversed(missing):
+                    child_fd = self.make_dir(parent_fd, source_path)
+                    os.close(parent_fd)
+                    parent_fd = child_fd
+                    self.created.add(source_path)
+            finally:
+                os.close(parent_fd)
+
+        return self.destination(source_dir)
+
+    @staticmethod
+    def make_dir(parent_fd, source_path):
+        """
+        Creates one mirrored directory inside parent_fd with the source's owner and mode
+        Directories that already exist are left as they are
+        Returns an open fd of the directory
+        """
+        name = os.path.basename(source_path)
+        source_stat = os.stat(source_path)
+        try:
+            os.mkdir(name, 0o700, dir_fd=parent_fd)
+            created = True
+        except FileExistsError:
+            created = False
+
+        dir_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=parent_fd)
+        if created is True:
+            try:
+                os.fchmod(dir_fd, stat.S_IMODE(source_stat.st_mode))
+                os.fchown(dir_fd, source_stat.st_uid, source_stat.st_gid)
+            except OSError:
+                os.close(dir_fd)
+                raise
+        return dir_fd
+
+
+class Relocator:
+    """
+    Moves files from a task's target_path to its relocation_path
+    When both are on the same device files are renamed, otherwise they are copied
+    in the kernel with os.copy_file_range (os.sendfile or pread/pwrite where that
+    is not supported), files of large_file_size bytes or more are split into
+    chunk_size pieces that are copied in parallel by a pool of copy_threads.
+    Copies keep the source's owner, mode, extended attributes and access/modify times
+    """
+
+    def __init__(self, target_path, relocation_path, copy_threads=4,
+                 large_file_size=268435456, chunk_size=67108864):
+        self.same_device = self.device_of(target_path) == self.device_of(relocation_path)
+        self.copy_threads = max(1, copy_threads)
+        self.large_file_size = large_file_size
+        self.chunk_size = chunk_size
+        self.copy_pool = None
+        self.kernel_copy = hasattr(os, "copy_file_range")
+
+        self.lock = threading.Lock()
+        self.renamed_count = 0
+        self.copied_count = 0
+        self.copied_bytes = 0
+        self.copy_time = 0
+
+    @staticmethod
+    def device_of(path):
+        """Returns the st_dev of path or of its nearest existing parent"""
+        path = os.path.abspath(path)
+        while True:
+            try:
+                return os.stat(path).st_dev
+            except FileNotFoundError:
+                path = os.path.dirname(path)
+
+    def move(self, source, destination):
+        """Moves a single file"""
+        if self.same_device is True:
+            try:
+                os.rename(source, destination)
+                with self.lock:
+                    self.renamed_count += 1
+                return
+            except OSError as err:
+                if err.errno != errno.EXDEV: #Same device number but a different mount
+                    raise
+                self.same_device = False
+
+        start_time = time.time()
+        size = self.copy_file(source, destination)
+        os.unlink(source)
+        with self.lock:
+            self.copied_count += 1
+            self.copied_bytes += size
+            self.copy_time += time.time() - start_time
+
+    def copy_file(self, source, destination):
+        """Copies a file with its metadata and returns the number of bytes copied"""
+        source_fd = os.open(source, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            source_stat = os.fstat(source_fd)
+            dest_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                size = source_stat.st_size
+                if (size >= self.large_file_size) and (self.copy_threads > 1):
+                    self.copy_chunks(source_fd, dest_fd, size)
+                else:
+                    self.copy_range(source_fd, dest_fd, 0, size, whole_file=True)
+
+                os.fchown(dest_fd, source_stat.st_uid, source_stat.st_gid)
+                self.copy_xattrs(source_fd, dest_fd) #Before fchmod, ACLs are xattrs
+                os.fchmod(dest_fd, stat.S_IMODE(source_stat.st_mode))
+                os.utime(dest_fd, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            finally:
+                os.close(dest_fd)
+        except BaseException:
+            try:
+                os.unlink(destination)
+            except OSError:
+                pass
+            raise
+        finally:
+            os.close(source_fd)
+        return size
+
+    @staticmethod
+    def copy_xattrs(source_fd, dest_fd):
+        """
+        Copies the extended attributes (ACLs included) of source_fd to dest_fd
+        like shutil.copystat, attributes a file system does not support are left out
+        """
+        if hasattr(os, "listxattr") is False:
+            return
+        ignored = (errno.ENOTSUP, errno.ENODATA, errno.EINVAL)
+        try:
+            names = os.listxattr(source_fd)
+        except OSError as err:
+            if err.errno not in ignored:
+                raise
+            return
+        for name in names:
+            try:
+                os.setxattr(dest_fd, name, os.getxattr(source_fd, name))
+            except OSError as err:
+                if err.errno not in ignored + (errno.EPERM,):
+                    raise
+
+    def copy_chunks(self, source_fd, dest_fd, size):
+        """Copies a large file as chunk_size pieces on the copy pool"""
+        with self.lock:
+            if self.copy_pool is None:
+                self.copy_pool = futures.ThreadPoolExecutor(max_workers=self.copy_threads)
+
+        os.ftruncate(dest_fd, size)
+        jobs = [self.copy_pool.submit(self.copy_range,
+                                      source_fd,
+                                      dest_fd,
+                                      offset,
+                                      min(self.chunk_size, size - offset))
+                for offset in range(0, size, self.chunk_size)]
+        for job in jobs:
+            job.result() #Re-raises the first copy error
+
+    def copy_range(self, source_fd, dest_fd, offset, length, whole_file=False):
+        """Copies length bytes at offset from source_fd to the same offset in dest_fd"""
+        while length > 0:
+            if self.kernel_copy is True:
+                try:
+                    copied = os.copy_file_range(source_fd, dest_fd, length, offset, offset)
+                except OSError as err:
+                    if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    self.kernel_copy = False
+                    continue
+            elif whole_file is True:
+                os.lseek(dest_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dest_fd, source_fd, offset, length)
+            else:
+                copied = os.pwrite(dest_fd, os.pread(source_fd, min(length, 1048576), offset),
+                                   offset)
+
+            if copied == 0: #Source file shrank while it was copied
+                break
+            offset += copied
+            length -= copied
+
+    def report(self):
+        """Returns a summary of renamed and copied files and the copy throughput"""
+        copy_rate = self.copied_bytes / 1024 / 1024 / max(self.copy_time, 0.001)
+        return "{renamed} files renamed, {copied} files copied ({gbs} GB, {mbps} MB/s)".format(
+            renamed=self.renamed_count,
+            copied=self.copied_count,
+            gbs=round(self.copied_bytes/1024/1024/1024, 2),
+            mbps=round(copy_rate, 2))
+
+    def close(self):
+        """Shuts down the copy pool"""
+        if self.copy_pool is not None:
+            self.copy_pool.shutdown()
+            self.copy_pool = None
+
+
+MOVE = "move"
+DELETE = "delete"
+SKIP = "skip"
+
+class CapacityPlanner:
+    """
+    Decides before any I/O whether a file is moved, deleted or skipped
+    Files are budgeted against the free bytes and inodes of relocation_path,
+    bytes of moves that have not finished yet stay reserved. statvfs is read
+    again every check_interval decisions so space used by other writers is seen
+    With a relocator moves are only unbudgeted renames while the relocator
+    still renames, it falls back to copies after an EXDEV
+    """
+
+    def __init__(self, relocation_path, delete_when_full, same_device=False,
+                 reserve_bytes=0, check_interval=1000, relocator=None):
+        self.relocation_path = relocation_path
+        self.delete_when_full = delete_when_full
+        self.same_device = same_device #Renames need no space
+        self.relocator = relocator
+        self.reserve_bytes = reserve_bytes
+        self.check_interval = max(1, check_interval)
+
+        self.lock = threading.Lock()
+        self.unreserved = threading.local() #Set by decide for a move that reserved nothing
+        self.in_flight_bytes = 0
+        self.in_flight_files = 0
+        self.decisions = 0
+        self.block_size = 1
+        self.free_bytes = 0
+        self.free_inodes = 0
+        self.refresh()
+
+    def refresh(self):
+        """Reads the free space of relocation_path"""
+        path = os.path.abspath(self.relocation_path)
+        while os.path.exists(path) is False:
+            path = os.path.dirname(path)
+        stats = os.statvfs(path)
+        self.block_size = stats.f_frsize or stats.f_bsize or 1
+        self.free_bytes = stats.f_bavail * self.block_size - self.reserve_bytes - \
+                          self.in_flight_bytes
+        self.free_inodes = stats.f_favail - self.in_flight_files
+        self.decisions = 0
+
+    def renames(self):
+        """Returns True while moves are renames on the same device"""
+        if (self.relocator is not None) and (self.relocator.same_device is False):
+            return False
+        return self.same_device
+
+    def decide(self, file_size):
+        """Returns MOVE, DELETE or SKIP for a file of file_size bytes"""
+        self.unreserved.move = self.renames()
+        if self.unreserved.move is True:
+            return MOVE
+
+        needed = -(-file_size // self.block_size) * self.block_size #Whole blocks
+        with self.lock:
+            self.decisions += 1
+            if self.decisions >= self.check_interval:
+                self.refresh()
+            if (needed <= self.free_bytes) and (self.free_inodes > 0):
+                self.free_bytes -= needed
+                self.free_inodes -= 1
+                self.in_flight_bytes += needed
+                self.in_flight_files += 1
+                return MOVE
+        return DELETE if self.delete_when_full is True else SKIP
+
+    def finish(self, file_size):
+        """
+        Releases the reservation of a move once it has finished or failed
+        Called in the thread that decided the move
+        """
+        if getattr(self.unreserved, "move", False) is True:
+            self.unreserved.move = False
+            return
+        needed = -(-file_size // self.block_size) * self.block_size
+        with self.lock:
+            self.in_flight_bytes -= needed
+            self.in_flight_files -= 1
+
+    def full(self):
+        """Called after an unexpected ENOSPC, free space is read again before the next decision"""
+        with self.lock:
+            self.free_bytes = 0
+            self.decisions = self.check_interval
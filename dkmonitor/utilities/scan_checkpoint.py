@@ -0,0 +1,81 @@
+"""
+This file contains the ScanCheckpoint used to resume long running scans
+A checkpoint holds the directories still waiting to be listed and the per uid
+totals of every directory that has already been listed. It is written to a
+local state file after a whole directory has been scanned, so resuming from it
+never counts a file twice
+"""
+
+import os, json, time
+
+from dkmonitor.utilities.scan_totals import ScanTotals
+
+class ScanCheckpoint:
+    """
+    Saves and loads the walk frontier and partial totals of one task's scan
+    A checkpoint is written every file_interval files or time_interval seconds,
+    whichever comes first
+    """
+
+    def __init__(self, state_path, file_interval=100000, time_interval=300, max_age=24):
+        self.state_path = state_path
+        self.file_interval = file_interval
+        self.time_interval = time_interval
+        self.max_age = max_age #Hours a checkpoint can be resumed from
+
+        self.last_files = 0
+        self.last_time = time.time()
+
+    def load(self, target_path, old_file_threshold):
+        """
+        Returns (pending directories, ScanTotals) saved by an interrupted scan
+        Returns None if there is no usable checkpoint for target_path
+        """
+        try:
+            if (time.time() - os.path.getmtime(self.state_path)) > (self.max_age * 3600):
+                return None
+            with open(self.state_path, "r") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+        if (state.get("target_path") != target_path) or \
+           (state.get("old_file_threshold") != old_file_threshold):
+            return None
+
+        totals = ScanTotals(state["now"], old_file_threshold)
+        directory, users, errors = state["totals"]
+        totals.merge_compact((directory, {int(uid): values for uid, values in users.items()},
+                              errors))
+        self.last_files = totals.directory.number_of_files
+        return state["pending"], totals
+
+    def due(self, totals):
+        """Returns True if it is time to write a checkpoint"""
+        return ((totals.directory.number_of_files - self.last_files) >= self.file_interval) or \
+               ((time.time() - self.last_time) >= self.time_interval)
+
+    def save(self, target_path, pending, totals):
+        """Atomically writes the frontier and totals to the state file"""
+        state = {"target_path": target_path,
+                 "old_file_threshold": totals.old_file_threshold,
+                 "now": totals.now,
+                 "pending": pending,
+                 "totals": totals.compact()}
+
+        temp_path = "{}.tmp".format(self.state_path)
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, self.state_path)
+
+        self.last_files = totals.directory.number_of_files
+        self.last_time = time.time()
+
+    def remove(self):
+        """Removes the state file once a scan has finished"""
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
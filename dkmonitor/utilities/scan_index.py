@@ -0,0 +1,174 @@
+"""
+This file contains the ScanIndex and IncrementalScanner used for incremental scans
+The index is a local SQLite file that stores, for every directory of a task,
+the directory's own mtime/ctime, the names of its sub directories and the per
+uid subtotals of the files directly inside it. A directory whose metadata has
+not changed since the last scan reuses those subtotals without being listed,
+its sub directories are still visited.
+
+Changes that do not touch a directory's metadata (a file being read or
+rewritten in place) are only picked up by a full scan
+"""
+
+import os, json, sqlite3
+
+from dkmonitor.utilities.dir_scan import TreeWalker
+from dkmonitor.utilities.scan_totals import FileCounter
+
+class ScanIndex:
+    """Per directory subtotals of one task keyed by (device, inode)"""
+
+    def __init__(self, index_path, old_file_threshold):
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS directories (
+                                       device INTEGER,
+                                       inode INTEGER,
+                                       mtime_ns INTEGER,
+                                       ctime_ns INTEGER,
+                                       young_atime INTEGER,
+                                       children TEXT,
+                                       totals TEXT,
+                                       generation INTEGER,
+                                       PRIMARY KEY (device, inode)) WITHOUT ROWID""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS settings (
+                                       name TEXT PRIMARY KEY,
+                                       value INTEGER)""")
+
+        #Old file counts depend on the threshold, start over if it changed
+        if self.get_setting("old_file_threshold") != old_file_threshold:
+            self.clear()
+            self.set_setting("old_file_threshold", old_file_threshold)
+        self.generation = (self.get_setting("generation") or 0) + 1
+        self.set_setting("generation", self.generation)
+
+    def get_setting(self, name):
+        """Returns an integer saved in the settings table"""
+        row = self.connection.execute("SELECT value FROM settings WHERE name = ?",
+                                      (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_setting(self, name, value):
+        """Saves an integer in the settings table"""
+        self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                                (name, value))
+
+    def clear(self):
+        """Removes every directory from the index"""
+        self.connection.execute("DELETE FROM directories")
+
+    def lookup(self, stat_info, old_cutoff):
+        """
+        Returns (sub directory names, {uid: FileCounter}) for an unchanged directory
+        Returns None if the directory is not indexed, its metadata changed or one of
+        its files has aged past the old file threshold since it was indexed
+        """
+        row = self.connection.execute("""SELECT mtime_ns, ctime_ns, young_atime, children, totals
+                                         FROM directories WHERE device = ? AND inode = ?""",
+                                      (stat_info.st_dev, stat_info.st_ino)).fetchone()
+        if row is None:
+            return None
+
+        mtime_ns, ctime_ns, young_atime, children, totals = row
+        if (mtime_ns != stat_info.st_mtime_ns) or (ctime_ns != stat_info.st_ctime_ns):
+            return None
+        if (young_atime is not None) and (young_atime < old_cutoff):
+            return None
+
+        self.connection.execute("""UPDATE directories SET generation = ?
+                                   WHERE device = ? AND inode = ?""",
+                                (self.generation, stat_info.st_dev, stat_info.st_ino))
+        users = {int(uid): FileCounter.from_tuple(values)
+                 for uid, values in json.loads(totals).items()}
+        return json.loads(children), users
+
+    def update(self, stat_info, children, users, young_atime):
+        """Saves the listing of a directory"""
+        totals = {uid: counter.as_tuple() for uid, counter in users.items()}
+        self.connection.execute("""INSERT OR REPLACE INTO directories
+                                   (device, inode, mtime_ns, ctime_ns, young_atime,
+                                    children, totals, generation)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                (stat_info.st_dev,
+                                 stat_info.st_ino,
+                                 stat_info.st_mtime_ns,
+                                 stat_info.st_ctime_ns,
+                                 young_atime,
+                                 json.dumps(children),
+                                 json.dumps(totals),
+                                 self.generation))
+
+    def finish(self):
+        """Removes directories that were not seen by this scan and commits"""
+        self.connection.execute("DELETE FROM directories WHERE generation != ?",
+                                (self.generation,))
+        self.connection.commit()
+
+    def close(self):
+        """Closes the index without saving the current scan"""
+        self.connection.close()
+
+
+class IncrementalScanner:
+    """
+    Walks a directory tree and adds its files to a ScanTotals, reusing
+    the subtotals of directories that did not change since the last scan
+    """
+
+    def __init__(self, base_dir, index):
+        self.base_dir = base_dir
+        self.index = index
+        self.listed_count = 0
+        self.reused_count = 0
+
+    def run(self, totals):
+        """Scans base_dir into totals and saves the index"""
+        if os.access(self.base_dir, os.R_OK) is False:
+            raise PermissionError
+
+        pending = [self.base_dir]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                stat_info = os.stat(dir_path, follow_symlinks=(dir_path == self.base_dir))
+            except PermissionError:
+                totals.errors["permission_denied"] += 1
+                continue
+            except FileNotFoundError:
+                totals.errors["vanished"] += 1
+                continue
+
+            cached = self.index.lookup(stat_info, totals.old_cutoff)
+            if cached is not None:
+                children, users = cached
+                self.reused_count += 1
+                for uid, counter in users.items():
+                    totals.directory.merge(counter)
+                    totals.merge_user(uid, counter)
+            else:
+                children = self.list_dir(dir_path, stat_info, totals)
+                self.listed_count += 1
+
+            pending.extend(os.path.join(dir_path, child) for child in children)
+
+        self.index.finish()
+        return totals
+
+    def list_dir(self, dir_path, stat_info, totals):
+        """Lists a changed directory, adds its files to totals and indexes it"""
+        walker = TreeWalker(dir_path, totals.errors)
+        walker.pending = []
+        dir_totals = totals.new_partial()
+        young_atime = None
+        error_count = sum(totals.errors.values())
+        for record in walker.scan_dir(dir_path):
+            dir_totals.add_record(record)
+            if (record.atime >= totals.old_cutoff) and \
+               ((young_atime is None) or (record.atime < young_atime)):
+                young_atime = int(record.atime)
+
+        totals.merge(dir_totals)
+        children = [os.path.basename(child) for child in walker.pending]
+        if sum(totals.errors.values()) == error_count: #Only index complete listings
+            self.index.update(stat_info, children, dir_totals.users, young_atime)
+        return children
@@ -0,0 +1,122 @@
+"""
+This file contains the light weight counters that a scan accumulates per uid
+Counters are plain integers so partial totals from several workers can be
+merged in any order and still match a serial scan exactly
+"""
+
+from collections import Counter
+
+class FileCounter:
+    """Running totals of the files owned by one uid (or a whole directory)"""
+
+    __slots__ = ("number_of_files",
+                 "total_file_size",
+                 "number_of_old_files",
+                 "total_old_file_size",
+                 "atime_sum")
+
+    def __init__(self):
+        self.number_of_files = 0
+        self.total_file_size = 0
+        self.number_of_old_files = 0
+        self.total_old_file_size = 0
+        self.atime_sum = 0
+
+    def add(self, size, atime, old_cutoff):
+        """Adds a single file to the counter"""
+        self.number_of_files += 1
+        self.total_file_size += size
+        self.atime_sum += int(atime)
+        if atime < old_cutoff:
+            self.number_of_old_files += 1
+            self.total_old_file_size += size
+
+    def merge(self, other):
+        """Adds the totals of another FileCounter to this one"""
+        self.number_of_files += other.number_of_files
+        self.total_file_size += other.total_file_size
+        self.number_of_old_files += other.number_of_old_files
+        self.total_old_file_size += other.total_old_file_size
+        self.atime_sum += other.atime_sum
+
+    def as_tuple(self):
+        """Returns the counter as a compact tuple that can be pickled cheaply"""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values):
+        """Builds a FileCounter from a tuple made by as_tuple"""
+        counter = cls()
+        for name, value in zip(cls.__slots__, values):
+            setattr(counter, name, value)
+        return counter
+
+    def total_access_time(self, now):
+        """Returns the sum of the last access times of all files in days"""
+        return (self.number_of_files * now - self.atime_sum) / 86400
+
+
+class ScanTotals:
+    """
+    Per uid FileCounters and a directory wide FileCounter for one scan
+    Records can optionally be forwarded to a CleanCandidates object
+    Entries the walk could not read are counted in errors
+    """
+
+    def __init__(self, now, old_file_threshold, candidates=None):
+        self.now = now
+        self.old_file_threshold = old_file_threshold
+        self.old_cutoff = now - (old_file_threshold * 86400)
+        self.candidates = candidates
+
+        self.users = {}
+        self.directory = FileCounter()
+        self.errors = Counter()
+
+    def new_partial(self):
+        """Returns an empty ScanTotals with the same settings for a scan worker"""
+        return ScanTotals(self.now, self.old_file_threshold, self.candidates)
+
+    def add_record(self, record):
+        """Adds a FileRecord to the directory and the owner's counters"""
+        self.directory.add(record.size, record.atime, self.old_cutoff)
+        try:
+            self.users[record.uid].add(record.size, record.atime, self.old_cutoff)
+        except KeyError:
+            self.users[record.uid] = FileCounter()
+            self.users[record.uid].add(record.size, record.atime, self.old_cutoff)
+
+        if self.candidates is not None:
+            self.candidates.add_record(record, self.now)
+
+    def merge(self, other):
+        """Merges the counters of another ScanTotals into this one"""
+        self.directory.merge(other.directory)
+        for uid, counter in other.users.items():
+            self.merge_user(uid, counter)
+        self.errors.update(other.errors)
+
+    def merge_user(self, uid, counter):
+        """Merges a FileCounter into the counter of uid"""
+        try:
+            self.users[uid].merge(counter)
+        except KeyError:
+            self.users[uid] = FileCounter()
+            self.users[uid].merge(counter)
+
+    def compact(self):
+        """
+        Returns the totals as plain tuples and dicts
+        (directory tuple, {uid: user tuple}, {error: count})
+        """
+        return (self.directory.as_tuple(),
+                {uid: counter.as_tuple() for uid, counter in self.users.items()},
+                dict(self.errors))
+
+    def merge_compact(self, compact_totals):
+        """Merges totals returned by compact (from a worker process) into this one"""
+        directory, users, errors = compact_totals
+        self.directory.merge(FileCounter.from_tuple(directory))
+        for uid, values in users.items():
+            self.merge_user(uid, FileCounter.from_tuple(values))
+        self.errors.update(errors)
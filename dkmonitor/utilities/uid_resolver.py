@@ -0,0 +1,113 @@
+"""
+This file contains the UidResolver that maps numeric uids to user names
+Name service lookups can be slow on LDAP/SSSD backed systems, so every uid is
+looked up at most once per process and the results can be saved to disk so
+the next run starts with a warm cache
+"""
+
+import pwd, json, os, time, threading
+
+UNKNOWN_USER_FORMAT = "uid_{}"
+
+class UidResolver:
+    """
+    Resolves uids to user names with an in process memo
+    uids without a passwd entry resolve to a stable placeholder name
+    (uid_<number>) instead of raising a KeyError
+    """
+
+    def __init__(self, cache_path=None, max_age=24):
+        self.cache_path = cache_path
+        self.max_age = max_age #Hours a saved cache file stays valid
+
+        self.names = {}
+        self.unknown = set()
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def preload(self):
+        """Loads every passwd entry with a single getpwall call"""
+        with self.lock:
+            for entry in pwd.getpwall():
+                if entry.pw_uid not in self.names:
+                    self.names[entry.pw_uid] = entry.pw_name
+                    self.changed = True
+
+    def name(self, uid):
+        """Returns the user name of uid"""
+        try:
+            return self.names[uid]
+        except KeyError:
+            pass
+
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = UNKNOWN_USER_FORMAT.format(uid)
+            self.unknown.add(uid)
+
+        with self.lock:
+            self.names[uid] = name
+            self.changed = True
+        return name
+
+    def is_unknown(self, uid):
+        """Returns True if uid has no passwd entry"""
+        self.name(uid)
+        return uid in self.unknown
+
+    def load(self):
+        """Loads names saved by a previous run if the cache file is not too old"""
+        if self.cache_path is None:
+            return
+        try:
+            if (time.time() - os.path.getmtime(self.cache_path)) > (self.max_age * 3600):
+                return
+            with open(self.cache_path, "r") as cache_file:
+                saved = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+
+        with self.lock:
+            for uid, name in saved.get("names", {}).items():
+                self.names.setdefault(int(uid), name)
+            self.unknown.update(saved.get("unknown", []))
+
+    def save(self):
+        """Saves all resolved names to the cache file"""
+        if (self.cache_path is None) or (self.changed is False):
+            return
+
+        with self.lock:
+            saved = {"names": {str(uid): name for uid, name in self.names.items()},
+                     "unknown": sorted(self.unknown)}
+            self.changed = False
+
+        temp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        try:
+            with open(temp_path, "w") as cache_file:
+                json.dump(saved, cache_file)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass
+
+
+RESOLVER = None
+RESOLVER_LOCK = threading.Lock()
+
+def get_resolver(scan_settings):
+    """
+    Returns the process wide UidResolver built from the Scan_Settings section
+    (uid_cache_file, uid_cache_max_age and preload_users)
+    """
+    global RESOLVER
+    with RESOLVER_LOCK:
+        if RESOLVER is None:
+            cache_path = scan_settings["uid_cache_file"]
+            if cache_path is not None:
+                cache_path = os.path.expanduser(cache_path)
+            RESOLVER = UidResolver(cache_path, scan_settings["uid_cache_max_age"])
+            RESOLVER.load()
+            if scan_settings["preload_users"] is True:
+                RESOLVER.preload()
+    return RESOLVER
@@ -1,13 +1,133 @@
 import unittest
 import os
+import pwd
+import time
 import logging
+import tempfile
+import tarfile
+import json
+import datetime
+import sqlite3
+import collections
+import errno
+import threading
+import subprocess
+import socket
+import sys
+import io
+import configparser
+import contextlib
+from unittest import mock
 
-from dkmonitor.utilities.dir_scan import dir_scan
-from dkmonitor.utilities.log_setup import setup_logger
+from dkmonitor.utilities.dir_scan import TreeWalker, dir_scan, scan_files
+from dkmonitor.utilities.parallel_scan import ParallelWalker
+from dkmonitor.utilities.process_scan import ProcessScanner
+from dkmonitor.utilities.scan_totals import ScanTotals
+from dkmonitor.utilities.uid_resolver import UidResolver
+from dkmonitor.utilities.scan_index import ScanIndex, IncrementalScanner
+from dkmonitor.utilities.scan_checkpoint import ScanCheckpoint
+from dkmonitor.utilities.relocate import RelocationTree, Relocator, CapacityPlanner
+from dkmonitor.utilities.relocate import MOVE, DELETE, SKIP
+from dkmonitor.utilities.bulk_delete import BulkDeleter
+from dkmonitor.utilities.archive import ArchiveWriter, restore_file
+from dkmonitor.utilities.clean_journal import CleanJournal, read_journal, unfinished_items
+from dkmonitor.utilities.clean_journal import compact_journal
+from dkmonitor.utilities.log_setup import setup_logger, configure_logging, stop_logging
+from dkmonitor.utilities.dk_stat import DkStat
+from dkmonitor.utilities.dk_clean import DkClean, single_pass_candidates, check_then_clean
+from dkmonitor.utilities.dk_clean import resume_candidates
+from dkmonitor.database_manager import DataBase, Tasks, UserStats, DirectoryStats, StatsBuffer
+from dkmonitor.database_manager import ENGINES, DataBaseCleaner, LatestUserStats
+from dkmonitor.database_manager import LatestDirectoryStats, ROLLUP_TABLES
+from dkmonitor.database_manager import Maintenance, clean_database
+from dkmonitor.stat_viewer import choose_resolution, AdminStatViewer
+from dkmonitor.monitor_manager import MonitorManager
+from dkmonitor.config.settings_manager import export_settings, SettingsValueError
+from sqlalchemy import select, event, inspect
+from sqlalchemy.exc import IntegrityError
 
 
 SCAN_DIR = 'test/dir_scan_test'
 LOG_FILE_NAME = 'test/test_log_file.log'
+LOG_DIR = tempfile.TemporaryDirectory()
+TEST_LOGGING = {"log_file": os.path.join(LOG_DIR.name, "dkmonitor.log")}
+SETTINGS_FILE = 'dkmonitor/config/settings.cfg'
+shutil_usage = collections.namedtuple("usage", "total used free")
+
+
+def write_settings(conf_dir, **sections):
+    """Writes the shipped settings.cfg to conf_dir/settings.cfg with the given values replaced"""
+    raw_settings = configparser.ConfigParser()
+    raw_settings.read(SETTINGS_FILE)
+    for section, values in sections.items():
+        for field, value in values.items():
+            raw_settings.set(section, field, str(value))
+    with open(os.path.join(conf_dir, "settings.cfg"), "w") as settings_file:
+        raw_settings.write(settings_file)
+
+def sqlite_settings(db_path):
+    """Returns DataBase_Settings for a SQLite database file"""
+    return {"db_type": "sqlite", "hostname": "", "database": db_path,
+            "username": "", "password": ""}
+
+def stat_rows(when, size=100, users=("alice", "bob"), hostname="host", target_path="/data"):
+    """Returns the UserStats rows of users and the DirectoryStats row of one scan at when"""
+    rows = [UserStats(datetime=when, hostname=hostname, taskname="test_task",
+                      target_path=target_path, username=username, total_file_size=size,
+                      disk_use_percent=1.0, average_file_age=10.0)
+            for username in users]
+    rows.append(DirectoryStats(datetime=when, hostname=hostname, taskname="test_task",
+                               target_path=target_path, total_file_size=size * len(users),
+                               average_file_age=10.0))
+    return rows
+
+def table_rows(database, table, *columns):
+    """Returns the values of columns of every row in table, sorted"""
+    query = select([table.columns[name] for name in columns])
+    return sorted(tuple(row) for row in database.db_engine.execute(query))
+
+def make_task(target_path, **columns):
+    """Returns a task dict that deletes files older than 10 days from target_path"""
+    task = {"taskname": "test_task",
+            "hostname": "test_host",
+            "target_path": target_path,
+            "relocation_path": None,
+            "delete_old_files": True,
+            "delete_when_full": False,
+            "usage_warning_threshold": 0,
+            "usage_critical_threshold": 0,
+            "old_file_threshold": 10,
+            "email_usage_warnings": False,
+            "email_data_alterations": False,
+            "email_top_percent": 25,
+            "scan_threads": None,
+            "enabled": True}
+    task.update(columns)
+    return task
+
+def fake_disk_usage(tree, base_used=8300, freed=None):
+    """
+    Returns a shutil.disk_usage replacement for a 10000 byte disk that holds base_used
+    bytes plus 100 bytes per file left in tree, minus freed[0] bytes freed by others
+    """
+    def disk_usage(_):
+        file_count = sum(len(file_names) for _, _, file_names in os.walk(tree))
+        used = base_used + 100 * file_count - (freed[0] if freed else 0)
+        return shutil_usage(10000, used, 10000 - used)
+    return disk_usage
+
+def make_old_files(dir_path, count, size=100, first_age=20):
+    """Creates count files of size bytes, file i was last accessed first_age + i days ago"""
+    os.makedirs(dir_path, exist_ok=True)
+    paths = []
+    for index in range(count):
+        file_path = os.path.join(dir_path, "old{}".format(index))
+        with open(file_path, "wb") as test_file:
+            test_file.write(b"x" * size)
+        file_time = time.time() - (first_age + index) * 86400
+        os.utime(file_path, (file_time, file_time))
+        paths.append(file_path)
+    return paths
 
 class TestUtilities(unittest.TestCase):
     """
@@ -16,6 +136,10 @@ class TestUtilities(unittest.TestCase):
         Test Errors
     """
 
+    def setUp(self):
+        #Explicit settings keep the tests from writing to ~/.dkmonitor/log
+        configure_logging(TEST_LOGGING)
+
     def test_dir_scan(self):
         """
         test dir scan
@@ -28,6 +152,911 @@ class TestUtilities(unittest.TestCase):
                                       os.path.join(SCAN_DIR, 'tl2/test2.1'),
                                       os.path.join(SCAN_DIR, 'tl2/test2.2')))
 
+    def test_scan_files(self):
+        """
+        test scandir walker records
+        """
+
+        records = sorted(scan_files(SCAN_DIR))
+        self.assertEqual([record.path for record in records],
+                         sorted(dir_scan(SCAN_DIR)))
+        for record in records:
+            stat_info = os.stat(record.path)
+            self.assertEqual(record.size, stat_info.st_size)
+            self.assertEqual(record.uid, stat_info.st_uid)
+            self.assertEqual(record.inode, stat_info.st_ino)
+
+        self.assertEqual(tuple(scan_files(os.path.join(SCAN_DIR, 'test1.1'))), ())
+
+    def test_parallel_scan(self):
+        """
+        test threaded and process pool walk totals match the serial walk
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            for i in range(20):
+                dir_path = os.path.join(tree, *["d{}".format(j) for j in range(i % 5 + 1)])
+                os.makedirs(dir_path, exist_ok=True)
+                file_path = os.path.join(dir_path, "f{}".format(i))
+                with open(file_path, "w") as test_file:
+                    test_file.write("x" * i)
+                os.utime(file_path, (time.time() - i * 86400 - 3600, time.time()))
+                if os.geteuid() == 0: #Spread the files over several owners
+                    os.chown(file_path, 60000 + i % 3, -1)
+
+            serial = ScanTotals(time.time(), 10)
+            for record in scan_files(tree):
+                serial.add_record(record)
+
+            merged = serial.new_partial()
+            for partial in ParallelWalker(tree, 4).run(merged.new_partial):
+                merged.merge(partial)
+
+            process_merged = ProcessScanner(tree, 2).run(serial.new_partial())
+
+        for totals in (merged, process_merged):
+            self.assertEqual(serial.directory.as_tuple(), totals.directory.as_tuple())
+            self.assertEqual({uid: counter.as_tuple() for uid, counter in serial.users.items()},
+                             {uid: counter.as_tuple() for uid, counter in totals.users.items()})
+            self.assertEqual(serial.errors, totals.errors)
+        self.assertEqual(serial.directory.number_of_files, 20)
+        self.assertEqual(serial.directory.number_of_old_files, 10)
+        self.assertEqual(sum(counter.number_of_files for counter in serial.users.values()), 20)
+
+    def test_uid_resolver(self):
+        """
+        test uid name cache
+        """
+
+        unknown_uid = 2 ** 31 - 3
+        with tempfile.TemporaryDirectory() as cache_dir:
+            resolver = UidResolver(os.path.join(cache_dir, "uids.json"))
+            self.assertEqual(resolver.name(os.getuid()), pwd.getpwuid(os.getuid()).pw_name)
+            self.assertEqual(resolver.name(unknown_uid), "uid_{}".format(unknown_uid))
+            self.assertTrue(resolver.is_unknown(unknown_uid))
+            resolver.save()
+
+            warm_resolver = UidResolver(os.path.join(cache_dir, "uids.json"))
+            warm_resolver.load()
+            self.assertEqual(warm_resolver.names, resolver.names)
+            self.assertTrue(warm_resolver.is_unknown(unknown_uid))
+
+    def test_incremental_scan(self):
+        """
+        test incremental scans reuse unchanged directories and match a serial scan
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            index_path = os.path.join(tree, "index.sqlite")
+            target = os.path.join(tree, "target")
+            for dir_name in ("a", "b", os.path.join("b", "c")):
+                os.makedirs(os.path.join(target, dir_name))
+                with open(os.path.join(target, dir_name, "file"), "w") as test_file:
+                    test_file.write(dir_name)
+
+            def incremental_totals():
+                scanner = IncrementalScanner(target, ScanIndex(index_path, 10))
+                scanner.run(ScanTotals(time.time(), 10))
+                return scanner
+
+            self.assertEqual(incremental_totals().listed_count, 4)
+            with open(os.path.join(target, "b", "new_file"), "w") as test_file:
+                test_file.write("new")
+
+            scanner = incremental_totals()
+            self.assertEqual((scanner.listed_count, scanner.reused_count), (1, 3))
+
+            serial = ScanTotals(time.time(), 10)
+            for record in scan_files(target):
+                serial.add_record(record)
+            incremental = ScanTotals(time.time(), 10)
+            IncrementalScanner(target, ScanIndex(index_path, 10)).run(incremental)
+            self.assertEqual(serial.directory.as_tuple(), incremental.directory.as_tuple())
+
+    def test_scan_checkpoint(self):
+        """
+        test a scan resumed from a checkpoint matches an uninterrupted scan
+        """
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            checkpoint = ScanCheckpoint(os.path.join(state_dir, "scan.json"))
+            totals = ScanTotals(time.time(), 0)
+            walker = TreeWalker(SCAN_DIR, totals.errors)
+            for record in walker.scan_dir(walker.pending.pop()):
+                totals.add_record(record)
+            checkpoint.save(SCAN_DIR, walker.pending, totals)
+
+            self.assertIsNone(checkpoint.load(SCAN_DIR, 10))
+            pending, resumed = checkpoint.load(SCAN_DIR, 0)
+            walker = TreeWalker(SCAN_DIR, resumed.errors)
+            walker.pending = pending
+            for record in walker.walk():
+                resumed.add_record(record)
+
+        serial = ScanTotals(totals.now, 0)
+        for record in scan_files(SCAN_DIR):
+            serial.add_record(record)
+        self.assertEqual(serial.directory.as_tuple(), resumed.directory.as_tuple())
+
+    def test_relocation_tree(self):
+        """
+        test relocation directories mirror the source tree
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            source_dir = os.path.join(tree, "source", "a", "b")
+            os.makedirs(source_dir)
+            os.chmod(os.path.join(tree, "source", "a"), 0o750)
+            relocation_tree = RelocationTree(os.path.join(tree, "relocation"))
+
+            new_dir = relocation_tree.ensure(source_dir)
+            self.assertEqual(new_dir, os.path.join(tree, "relocation", source_dir.lstrip("/")))
+            self.assertTrue(os.path.isdir(new_dir))
+            self.assertEqual(os.stat(os.path.dirname(new_dir)).st_mode & 0o777, 0o750)
+            self.assertIn(source_dir, relocation_tree.created)
+            self.assertEqual(relocation_tree.ensure(source_dir), new_dir)
+
+    def test_relocator(self):
+        """
+        test files are renamed on the same device and copied with their metadata otherwise
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            relocator = Relocator(tree, tree, copy_threads=3, large_file_size=1000, chunk_size=300)
+            self.assertTrue(relocator.same_device)
+            for name, size in (("small", 100), ("large", 1000)):
+                source = os.path.join(tree, name)
+                with open(source, "wb") as test_file:
+                    test_file.write(os.urandom(size))
+                os.chmod(source, 0o640)
+                os.utime(source, (1000000, 2000000))
+
+            relocator.move(os.path.join(tree, "small"), os.path.join(tree, "small_renamed"))
+            self.assertEqual(relocator.renamed_count, 1)
+
+            relocator.same_device = False #Forces the copy path
+            with open(os.path.join(tree, "large"), "rb") as test_file:
+                data = test_file.read()
+            relocator.move(os.path.join(tree, "large"), os.path.join(tree, "large_copied"))
+            relocator.close()
+
+            copied = os.path.join(tree, "large_copied")
+            self.assertFalse(os.path.exists(os.path.join(tree, "large")))
+            with open(copied, "rb") as test_file:
+                self.assertEqual(test_file.read(), data)
+            self.assertEqual(os.stat(copied).st_mode & 0o777, 0o640)
+            self.assertEqual(os.stat(copied).st_mtime, 2000000)
+            self.assertEqual((relocator.copied_count, relocator.copied_bytes), (1, 1000))
+
+    def test_capacity_planner(self):
+        """
+        test relocations are budgeted against the free space of the relocation path
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            planner = CapacityPlanner(tree, delete_when_full=False)
+            free_bytes = planner.free_bytes
+            self.assertEqual(planner.decide(1), MOVE)
+            self.assertEqual(planner.in_flight_files, 1)
+            self.assertEqual(planner.decide(free_bytes), SKIP)
+            planner.finish(1)
+            self.assertEqual(planner.in_flight_bytes, 0)
+
+            planner.delete_when_full = True
+            self.assertEqual(planner.decide(free_bytes * 2), DELETE)
+            planner.same_device = True
+            self.assertEqual(planner.decide(free_bytes * 2), MOVE)
+
+            relocator = Relocator(tree, tree)
+            planner = CapacityPlanner(tree, False, relocator.same_device, relocator=relocator)
+            self.assertEqual(planner.decide(free_bytes * 2), MOVE)
+            with open(os.path.join(tree, "file"), "w") as test_file:
+                test_file.write("x")
+            with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Cross-device link")):
+                relocator.move(os.path.join(tree, "file"), os.path.join(tree, "moved"))
+            planner.finish(free_bytes * 2) #The rename reserved nothing
+            self.assertEqual(planner.in_flight_bytes, 0)
+            self.assertEqual(planner.decide(free_bytes * 2), SKIP) #Copies are budgeted
+
+    def test_relocator_xattrs(self):
+        """
+        test files copied to another device keep their extended attributes
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            source = os.path.join(tree, "file")
+            with open(source, "w") as test_file:
+                test_file.write("x")
+            try:
+                os.setxattr(source, "user.dkmonitor", b"kept")
+            except OSError as err:
+                if err.errno not in (errno.ENOTSUP, errno.EPERM):
+                    raise
+                self.skipTest("file system without user extended attributes")
+
+            relocator = Relocator(tree, tree)
+            with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Cross-device link")):
+                relocator.move(source, os.path.join(tree, "moved"))
+            self.assertEqual(relocator.copied_count, 1)
+            self.assertEqual(os.getxattr(os.path.join(tree, "moved"), "user.dkmonitor"),
+                             b"kept")
+
+    def test_bulk_deleter(self):
+        """
+        test files are deleted in directory groups and emptied directories are pruned
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            items = []
+            for dir_name in ("a/b", "a/c", "d"):
+                os.makedirs(os.path.join(tree, dir_name))
+                for file_name in ("f1", "f2"):
+                    file_path = os.path.join(tree, dir_name, file_name)
+                    with open(file_path, "w") as test_file:
+                        test_file.write("x")
+                    items.append((-1, file_path, 1))
+            with open(os.path.join(tree, "d", "keep"), "w") as test_file:
+                test_file.write("x")
+
+            deleter = BulkDeleter(tree, worker_number=2)
+            deleted, denied = deleter.delete(items + [(-1, os.path.join(tree, "d", "gone"), 1)])
+            deleter.close()
+            self.assertEqual(sorted(deleted), sorted(items))
+            self.assertEqual(denied, [])
+
+            self.assertEqual(deleter.prune(), 3)
+            self.assertEqual(sorted(os.listdir(tree)), ["d"])
+            self.assertEqual(os.listdir(os.path.join(tree, "d")), ["keep"])
+
+    def test_archive_writer(self):
+        """
+        test archived files can be read with tarfile and restored one by one
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            source_dir = os.path.join(tree, "source")
+            os.makedirs(source_dir)
+            writer = ArchiveWriter(os.path.join(tree, "archive"), UidResolver(),
+                                   max_archive_size=1500, sync_files=2)
+            contents = {}
+            for index in range(4):
+                file_path = os.path.join(source_dir, "file{}".format(index))
+                contents[file_path] = os.urandom(1000)
+                with open(file_path, "wb") as test_file:
+                    test_file.write(contents[file_path])
+                writer.add(file_path)
+            writer.close()
+
+            self.assertEqual(os.listdir(source_dir), [])
+            user_dir = os.path.join(tree, "archive", UidResolver().name(os.getuid()))
+            archives = sorted(name for name in os.listdir(user_dir) if name.endswith(".tar.gz"))
+            self.assertEqual(len(archives), 2)
+
+            names = []
+            for archive_name in archives:
+                with tarfile.open(os.path.join(user_dir, archive_name)) as tar:
+                    names.extend(tar.getnames())
+            self.assertEqual(sorted(names), sorted(path.lstrip("/") for path in contents))
+
+            file_path = sorted(contents)[2]
+            restored = restore_file(os.path.join(user_dir, archives[1]), file_path, tree)
+            with open(restored, "rb") as test_file:
+                self.assertEqual(test_file.read(), contents[file_path])
+
+    def test_clean_journal(self):
+        """
+        test unfinished journal entries are found after an interrupted clean
+        """
+
+        with tempfile.TemporaryDirectory() as tree:
+            journal_path = os.path.join(tree, "task.journal")
+            journal = CleanJournal(journal_path, sync_entries=2)
+            journal.begin()
+            journal.plan((-1, "/old/a", 10))
+            journal.close()
+
+            journal = CleanJournal(journal_path)
+            journal.begin()
+            for item in ((-3, "/a", 10), (-2, "/b", 20), (-1, "/c", 30)):
+                journal.plan(item)
+            journal.done("move", "/a", "/relocated/a", 10)
+            journal.skip("/b")
+            journal.close()
+            with open(journal_path, "a") as journal_file:
+                journal_file.write('["done", "mo') #Torn write
+
+            self.assertEqual(unfinished_items(journal_path), [(-1, "/c", 30)])
+            self.assertEqual(len(list(read_journal(journal_path))), 8)
+
+            journal = CleanJournal(journal_path)
+            journal.done("archive", "/c", "/archive/c.tar.gz", 30)
+            journal.done("delete", "/d", None, 40)
+            journal.restored("/a")
+            journal.close()
+            self.assertEqual(compact_journal(journal_path), 1)
+            self.assertEqual(list(read_journal(journal_path)),
+                             [["done", "archive", "/c", "/archive/c.tar.gz", 30]])
+            self.assertEqual(unfinished_items(journal_path), [])
+
+    def test_resume_single_pass_clean(self):
+        """
+        test a single pass clean killed partway is finished by resuming from its journal
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, tempfile.TemporaryDirectory() as tree, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            journal_dir = os.path.join(conf_dir, "journal")
+            write_settings(conf_dir,
+                           Thread_Settings={"thread_mode": "no"},
+                           Scan_Settings={"single_pass": "yes"},
+                           Cleaning_Settings={"journal": "yes",
+                                              "journal_dir": journal_dir,
+                                              "journal_sync_entries": 1,
+                                              "delete_batch_size": 2})
+            task = make_task(tree)
+            old_files = make_old_files(tree, 6)
+            journal_path = os.path.join(journal_dir, "test_task.journal")
+
+            candidates = single_pass_candidates(task)
+            with contextlib.redirect_stdout(io.StringIO()):
+                DkStat(task).scan(candidates)
+
+            real_delete = BulkDeleter.delete
+            def killed_after_first_batch(deleter, items):
+                if len(old_files) - len(os.listdir(tree)) >= 2:
+                    raise KeyboardInterrupt
+                return real_delete(deleter, items)
+            clean_obj = DkClean(task, candidates)
+            with mock.patch.object(BulkDeleter, "delete", killed_after_first_batch), \
+                 contextlib.redirect_stdout(io.StringIO()), self.assertRaises(KeyboardInterrupt):
+                clean_obj.clean_disk_bulk()
+            clean_obj.journal.close()
+            clean_obj.deleter.close()
+
+            self.assertEqual(len([path for path in old_files if os.path.exists(path)]), 4)
+            self.assertEqual(sorted(item[1] for item in unfinished_items(journal_path)),
+                             sorted(path for path in old_files if os.path.exists(path)))
+
+            resumed = resume_candidates(task)
+            self.assertEqual(resumed.que.qsize(), 4)
+            with contextlib.redirect_stdout(io.StringIO()):
+                check_then_clean(task, resumed)
+            self.assertEqual([path for path in old_files if os.path.exists(path)], [])
+            self.assertEqual(list(read_journal(journal_path)), []) #Compacted, deletes are final
+
+    def test_single_pass_candidates(self):
+        """
+        test the candidates collected by the stats scan are cleaned without walking the tree again
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, tempfile.TemporaryDirectory() as tree, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            write_settings(conf_dir,
+                           Thread_Settings={"thread_mode": "no"},
+                           Scan_Settings={"single_pass": "yes"},
+                           Cleaning_Settings={"journal": "no"})
+            task = make_task(tree)
+            old_files = make_old_files(os.path.join(tree, "a"), 4)
+            with open(os.path.join(tree, "new"), "w") as test_file:
+                test_file.write("new")
+
+            candidates = single_pass_candidates(task)
+            with contextlib.redirect_stdout(io.StringIO()):
+                DkStat(task).scan(candidates)
+            self.assertTrue(candidates.complete)
+            self.assertEqual(sorted(item[1] for item in candidates.que.queue), sorted(old_files))
+
+            late_file = make_old_files(os.path.join(tree, "late"), 1)[0] #Not seen by the scan
+            self.assertTrue(DkClean(task, candidates).pre_scanned)
+            with contextlib.redirect_stdout(io.StringIO()):
+                check_then_clean(task, candidates)
+
+            self.assertEqual([path for path in old_files if os.path.exists(path)], [])
+            self.assertTrue(os.path.exists(late_file))
+            self.assertTrue(os.path.exists(os.path.join(tree, "new")))
+
+    def test_clean_target(self):
+        """
+        test cleaning stops at the clean target and selects more files when the capped heap
+        did not hold enough
+        """
+
+        def clean(tree, freed=None, **clean_settings):
+            with tempfile.TemporaryDirectory() as conf_dir, \
+                 mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}), \
+                 mock.patch("shutil.disk_usage", fake_disk_usage(tree, freed=freed)):
+                settings = {"journal": "no", "clean_target": 85, "delete_batch_size": 1}
+                settings.update(clean_settings)
+                write_settings(conf_dir,
+                               Thread_Settings={"thread_mode": "no"},
+                               Cleaning_Settings=settings)
+                clean_obj = DkClean(make_task(tree))
+                self.assertEqual(clean_obj.candidates.bytes_needed, 400) #8900 used, 8500 target
+                with contextlib.redirect_stdout(io.StringIO()):
+                    clean_obj.clean_disk_bulk()
+                return clean_obj
+
+        with tempfile.TemporaryDirectory() as tree: #Freed bytes reach the target
+            old_files = make_old_files(tree, 6)
+            clean_obj = clean(tree)
+            self.assertTrue(clean_obj.reached_target)
+            self.assertEqual((clean_obj.freed_bytes, clean_obj.pass_start_bytes), (400, 0))
+            self.assertEqual([os.path.exists(path) for path in old_files], [True] * 2 + [False] * 4)
+
+        with tempfile.TemporaryDirectory() as tree: #Two files per pass
+            old_files = make_old_files(tree, 6)
+            clean_obj = clean(tree, max_clean_candidates=2)
+            self.assertTrue(clean_obj.reached_target)
+            self.assertEqual((clean_obj.freed_bytes, clean_obj.pass_start_bytes), (400, 200))
+            self.assertEqual([os.path.exists(path) for path in old_files], [True] * 2 + [False] * 4)
+
+        with tempfile.TemporaryDirectory() as tree: #Space freed by others is seen by the usage check
+            make_old_files(tree, 6)
+            freed = [0]
+            def delete_and_free(items):
+                freed[0] = 500 #Another user removed files, nothing is really deleted
+                return items, []
+            with mock.patch("dkmonitor.utilities.dk_clean.BulkDeleter.delete",
+                            side_effect=delete_and_free):
+                clean_obj = clean(tree, freed, usage_check_interval=1)
+            self.assertTrue(clean_obj.reached_target)
+            self.assertEqual(clean_obj.cleaned_count, 1)
+
+    def test_clean_worker_error(self):
+        """
+        test an error raised in a clean worker stops the bounded pipeline and reaches the caller
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, tempfile.TemporaryDirectory() as tree, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            write_settings(conf_dir,
+                           Thread_Settings={"thread_mode": "yes",
+                                            "clean_threads": 2,
+                                            "clean_queue_size": 2},
+                           Cleaning_Settings={"journal": "no"})
+            make_old_files(tree, 20)
+            cleaned = []
+            cleaned_lock = threading.Lock()
+            def fill_disk(file_path, file_size):
+                with cleaned_lock:
+                    if len(cleaned) == 3:
+                        raise OSError(errno.ENOSPC, "No space left on device")
+                    cleaned.append(file_path)
+                return True
+
+            clean_obj = DkClean(make_task(tree))
+            self.assertEqual(clean_obj.que.maxsize, 2)
+            with contextlib.redirect_stdout(io.StringIO()), self.assertRaises(OSError) as raised:
+                clean_obj.clean_disk_async(fill_disk)
+            self.assertEqual(raised.exception.errno, errno.ENOSPC)
+            self.assertEqual(clean_obj.cleaned_count, 3)
+
+    def test_bulk_store(self):
+        """
+        test store, bulk_store and StatsBuffer write the same rows, all or nothing
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            settings = sqlite_settings(os.path.join(db_dir, "dkmonitor.db"))
+            database = DataBase(**settings)
+            start = datetime.datetime(2026, 1, 5, 12)
+            database.store(stat_rows(start))
+            database.bulk_store(stat_rows(start + datetime.timedelta(hours=1), size=200))
+
+            buffer = StatsBuffer(settings, max_rows=4)
+            buffer.add(stat_rows(start + datetime.timedelta(hours=2), size=300))
+            self.assertEqual(len(table_rows(database, UserStats.__table__, "id")), 4)
+            buffer.add(stat_rows(start + datetime.timedelta(hours=3), size=400))
+            self.assertEqual(buffer.rows, [])
+            self.assertEqual(table_rows(database, DirectoryStats.__table__,
+                                        "total_file_size", "taskname"),
+                             [(200, "test_task"), (400, "test_task"),
+                              (600, "test_task"), (800, "test_task")])
+            self.assertEqual(len(set(table_rows(database, UserStats.__table__, "id"))), 8)
+
+            rows = stat_rows(start + datetime.timedelta(hours=4))
+            rows[-1].datetime = None #Not nullable, the whole transaction is rolled back
+            with self.assertRaises(IntegrityError):
+                database.bulk_store(rows)
+            self.assertEqual(len(table_rows(database, UserStats.__table__, "id")), 8)
+
+    def test_engine_registry(self):
+        """
+        test DataBase objects on one url share an engine and give back every connection they use
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            settings = sqlite_settings(os.path.join(db_dir, "dkmonitor.db"))
+            first = DataBase(**settings)
+            second = DataBase(**settings)
+            self.assertIs(first.db_engine, second.db_engine)
+            self.assertIs(ENGINES[first.eng_str], first.db_engine)
+
+            pool_events = collections.Counter()
+            def count_event(name):
+                def listener(*_):
+                    pool_events[name] += 1
+                return listener
+            for name in ("checkout", "checkin"):
+                event.listen(first.db_engine, name, count_event(name))
+            first.create_session().query(Tasks).all()
+            first.create_session().query(Tasks).all()
+            with second.session_scope() as session:
+                session.query(Tasks).all()
+            self.assertEqual(pool_events["checkin"], 1)
+            first.close()
+            self.assertEqual(first.sessions, [])
+            self.assertEqual(dict(pool_events), {"checkout": 3, "checkin": 3})
+
+    def test_migrate(self):
+        """
+        test migrate copies stats tables keyed by datetime into the indexed layout in batches
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_path = os.path.join(db_dir, "dkmonitor.db")
+            start = datetime.datetime(2026, 1, 5, 12)
+            connection = sqlite3.connect(db_path)
+            connection.execute("CREATE TABLE userstats (datetime DATETIME PRIMARY KEY, "
+                               "hostname VARCHAR, taskname VARCHAR, target_path VARCHAR, "
+                               "total_file_size BIGINT, disk_use_percent FLOAT, "
+                               "average_file_age FLOAT, username VARCHAR)")
+            connection.execute("CREATE TABLE directorystats (datetime DATETIME PRIMARY KEY, "
+                               "hostname VARCHAR, taskname VARCHAR, target_path VARCHAR, "
+                               "total_file_size BIGINT, average_file_age FLOAT)")
+            connection.execute("CREATE TABLE tasks (taskname VARCHAR PRIMARY KEY)")
+            for hour in range(5):
+                when = (start + datetime.timedelta(hours=hour)).strftime("%Y-%m-%d %H:%M:%S.%f")
+                connection.execute("INSERT INTO userstats VALUES (?, 'host', 'test_task', "
+                                   "'/data', ?, 1.0, 10.0, 'alice')", (when, hour * 100))
+                connection.execute("INSERT INTO directorystats VALUES (?, 'host', 'test_task', "
+                                   "'/data', ?, 10.0)", (when, hour * 100))
+            connection.commit()
+            connection.close()
+
+            cleaner = DataBaseCleaner(sqlite_settings(db_path))
+            with contextlib.redirect_stdout(io.StringIO()):
+                cleaner.migrate(batch_size=2)
+                cleaner.migrate(batch_size=2) #Nothing left to migrate
+
+            inspector = inspect(cleaner.db_engine)
+            for table in (UserStats.__table__, DirectoryStats.__table__):
+                self.assertIn("id", [column["name"] for column in inspector.get_columns(table.name)])
+                self.assertEqual(sorted(index["name"] for index in inspector.get_indexes(table.name)),
+                                 sorted(index.name for index in table.indexes))
+                self.assertEqual(table_rows(cleaner, table, "id", "total_file_size"),
+                                 [(hour + 1, hour * 100) for hour in range(5)])
+            self.assertNotIn("userstats_new", inspector.get_table_names())
+            self.assertEqual(sorted(column["name"] for column in inspector.get_columns("tasks")),
+                             sorted(column.name for column in Tasks.__table__.columns))
+            self.assertEqual(table_rows(cleaner, LatestUserStats.__table__,
+                                        "total_file_size", "previous_total_file_size"),
+                             [(400, 300)])
+
+    def test_latest_snapshots(self):
+        """
+        test the window function and grouped queries find the same latest two snapshots
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            database = DataBase(**sqlite_settings(os.path.join(db_dir, "dkmonitor.db")))
+            start = datetime.datetime(2026, 1, 5, 12)
+            for hour in range(3):
+                database.store(stat_rows(start + datetime.timedelta(hours=hour), size=hour))
+            database.store(stat_rows(start, size=7, users=("alice",), target_path="/scratch"))
+
+            partition = [UserStats.hostname, UserStats.target_path, UserStats.username]
+            results = []
+            for window_functions in (True, False):
+                with mock.patch.object(DataBase, "window_functions",
+                                       return_value=window_functions), \
+                     database.session_scope() as session:
+                    results.append([[(row.target_path, row.username, row.total_file_size)
+                                     for row in snapshots]
+                                    for snapshots in database.latest_snapshots(
+                                        session, UserStats, [UserStats.hostname == "host"],
+                                        partition)])
+
+            self.assertEqual(results[0], [[("/data", "alice", 2), ("/data", "alice", 1)],
+                                          [("/data", "bob", 2), ("/data", "bob", 1)],
+                                          [("/scratch", "alice", 7)]])
+            self.assertEqual(results[1], results[0])
+
+    def test_latest_tables(self):
+        """
+        test the latest tables follow every store and match a rebuild from the history
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            cleaner = DataBaseCleaner(sqlite_settings(os.path.join(db_dir, "dkmonitor.db")))
+            start = datetime.datetime(2026, 1, 5, 12)
+            cleaner.store(stat_rows(start, size=100))
+            cleaner.bulk_store(stat_rows(start + datetime.timedelta(hours=2), size=300) +
+                               stat_rows(start + datetime.timedelta(hours=1), size=200))
+            cleaner.store(stat_rows(start - datetime.timedelta(hours=1), size=50)) #Late rows
+            cleaner.store(stat_rows(start, size=5, users=("carol",)))
+
+            columns = ("target_path", "datetime", "total_file_size", "previous_total_file_size")
+            latest_users = table_rows(cleaner, LatestUserStats.__table__, "username", *columns)
+            latest_directories = table_rows(cleaner, LatestDirectoryStats.__table__, *columns)
+            self.assertEqual(latest_users,
+                             [("alice", "/data", start + datetime.timedelta(hours=2), 300, 200),
+                              ("bob", "/data", start + datetime.timedelta(hours=2), 300, 200),
+                              ("carol", "/data", start, 5, None)])
+            self.assertEqual(latest_directories,
+                             [("/data", start + datetime.timedelta(hours=2), 600, 400)])
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                cleaner.rebuild_latest()
+            self.assertEqual(table_rows(cleaner, LatestUserStats.__table__, "username", *columns),
+                             latest_users)
+            self.assertEqual(table_rows(cleaner, LatestDirectoryStats.__table__, *columns),
+                             latest_directories)
+
+    def test_rollups(self):
+        """
+        test rollup buckets follow every store and keep the aggregates of purged rows
+        through migrate and rebuild_rollups
+        """
+
+        def rollup_rows(database):
+            return {period: table_rows(database, rollup_table, "period_start", "username",
+                                       "sample_count", "total_file_size_sum",
+                                       "total_file_size_max", "last_datetime")
+                    for period, rollup_table in ROLLUP_TABLES[UserStats.__table__].items()}
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            cleaner = DataBaseCleaner(sqlite_settings(os.path.join(db_dir, "dkmonitor.db")))
+            monday = datetime.datetime(2026, 1, 5)
+            times = [monday + datetime.timedelta(hours=hours)
+                     for hours in (12, 12.5, 13, 36)] #Monday 12:00, 12:30, 13:00, Tuesday 12:00
+            cleaner.store(stat_rows(times[0], size=100, users=("alice",)))
+            cleaner.bulk_store(stat_rows(times[1], size=300, users=("alice",)) +
+                               stat_rows(times[2], size=200, users=("alice",)))
+            cleaner.store(stat_rows(times[3], size=400, users=("alice",)))
+
+            rollups = rollup_rows(cleaner)
+            self.assertEqual(rollups["hourly"],
+                             [(monday + datetime.timedelta(hours=12), "alice", 2, 400, 300,
+                               times[1]),
+                              (monday + datetime.timedelta(hours=13), "alice", 1, 200, 200,
+                               times[2]),
+                              (monday + datetime.timedelta(hours=36), "alice", 1, 400, 400,
+                               times[3])])
+            self.assertEqual(rollups["daily"],
+                             [(monday, "alice", 3, 600, 300, times[2]),
+                              (monday + datetime.timedelta(days=1), "alice", 1, 400, 400,
+                               times[3])])
+            self.assertEqual(rollups["weekly"], [(monday, "alice", 4, 1000, 400, times[3])])
+
+            for table in (UserStats, DirectoryStats): #Purge the rows of Monday 12:xx
+                cleaner.delete_chunks(table.__table__, table.__table__.columns.datetime,
+                                      times[1], chunk_size=1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                cleaner.migrate()
+                self.assertEqual(rollup_rows(cleaner), rollups)
+                cleaner.rebuild_rollups(batch_size=1)
+                self.assertEqual(rollup_rows(cleaner), rollups)
+
+                for rollup_tables in ROLLUP_TABLES.values():
+                    for rollup_table in rollup_tables.values():
+                        cleaner.db_engine.execute(rollup_table.delete())
+                cleaner.migrate() #Empty rollups are built from the history that is left
+            self.assertEqual(rollup_rows(cleaner)["weekly"],
+                             [(monday, "alice", 2, 600, 400, times[3])])
+
+    def test_choose_resolution(self):
+        """
+        test history is shown at the finest resolution that is kept and fits on screen
+        """
+
+        self.assertEqual(choose_resolution(1, {}), "raw")
+        self.assertEqual(choose_resolution(2, {"raw": 1}), "hourly")
+        self.assertEqual(choose_resolution(7, {"raw": 30}), "hourly")
+        self.assertEqual(choose_resolution(7, {"hourly": 3}), "daily")
+        self.assertEqual(choose_resolution(30, {"hourly": 90}), "daily")
+        self.assertEqual(choose_resolution(1000, {"daily": 365}), "weekly")
+        self.assertEqual(choose_resolution(1000, {"weekly": 10}), "weekly")
+
+    def test_chunked_purge(self):
+        """
+        test old rows are purged in chunks within the time budget, once per interval
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            db_path = os.path.join(conf_dir, "dkmonitor.db")
+            write_settings(conf_dir, DataBase_Settings=sqlite_settings(db_path))
+            cleaner = DataBaseCleaner(sqlite_settings(db_path))
+            start = datetime.datetime.now() - datetime.timedelta(days=10)
+            for hour in range(5):
+                cleaner.store(stat_rows(start + datetime.timedelta(hours=hour)))
+            cleaner.store(stat_rows(datetime.datetime.now()))
+
+            table = UserStats.__table__
+            too_old = start + datetime.timedelta(hours=1)
+            self.assertEqual(cleaner.delete_chunks(table, table.columns.datetime, too_old, 3,
+                                                   deadline=time.time() - 1), (0, False))
+            self.assertEqual(cleaner.delete_chunks(table, table.columns.datetime, too_old, 3),
+                             (4, True)) #Two scans of two users, rows sharing a date go together
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                with mock.patch.object(DataBaseCleaner, "clean_table",
+                                       side_effect=RuntimeError("lock timeout")), \
+                     contextlib.redirect_stderr(io.StringIO()) as error_output:
+                    self.assertFalse(clean_database(5, chunk_size=2, interval=24))
+                self.assertIn("lock timeout", error_output.getvalue())
+                self.assertEqual(table_rows(cleaner, Maintenance.__table__, "name"), [])
+
+                self.assertTrue(clean_database(5, {"hourly": 1}, chunk_size=2, interval=24))
+                self.assertFalse(clean_database(5, chunk_size=2, interval=24))
+            self.assertEqual(len(table_rows(cleaner, table, "id")), 2)
+            self.assertEqual(len(table_rows(cleaner, DirectoryStats.__table__, "id")), 1)
+            self.assertEqual(len(table_rows(cleaner, ROLLUP_TABLES[table]["hourly"], "hostname")),
+                             2)
+
+            last_run = table_rows(cleaner, Maintenance.__table__, "last_run")
+            with self.assertRaises(RuntimeError), \
+                 cleaner.maintenance_claim("purge", datetime.timedelta(0)) as claimed:
+                self.assertTrue(claimed)
+                raise RuntimeError("purge failed")
+            self.assertEqual(table_rows(cleaner, Maintenance.__table__, "last_run"), last_run)
+
+    def test_failed_purge_runs_tasks(self):
+        """
+        test a purge that fails does not keep MonitorManager from running its tasks
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            db_path = os.path.join(conf_dir, "dkmonitor.db")
+            write_settings(conf_dir, DataBase_Settings=sqlite_settings(db_path),
+                           DataBase_Cleaning_Settings={"purge_database": "yes",
+                                                       "purge_after_day_number": 5},
+                           Thread_Settings={"thread_mode": "no"})
+            database = DataBase(**sqlite_settings(db_path))
+            with database.session_scope() as session:
+                session.add(Tasks(**make_task(conf_dir, hostname=socket.gethostname())))
+
+            with mock.patch("dkmonitor.database_manager.purge_tables",
+                            side_effect=RuntimeError("lock timeout")), \
+                 mock.patch.object(MonitorManager, "full_scan") as full_scan, \
+                 contextlib.redirect_stdout(io.StringIO()), \
+                 contextlib.redirect_stderr(io.StringIO()) as error_output:
+                monitor = MonitorManager()
+                monitor.start_tasks("full")
+                monitor.finish()
+            self.assertIn("Database purge failed", error_output.getvalue())
+            self.assertEqual([call[0][0]["taskname"] for call in full_scan.call_args_list],
+                             ["test_task"])
+
+    def test_settings_cache(self):
+        """
+        test settings are typed, read only and parsed again only when the file changes
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            settings_path = os.path.join(conf_dir, "settings.cfg")
+            write_settings(conf_dir, Thread_Settings={"clean_threads": 3})
+            settings = export_settings()
+            self.assertIs(export_settings(), settings)
+            self.assertEqual(settings["Thread_Settings"]["clean_threads"], 3)
+            self.assertIs(settings["Thread_Settings"]["thread_mode"], True)
+            self.assertIsNone(settings["DataBase_Cleaning_Settings"]["purge_after_day_number"])
+            with self.assertRaises(TypeError):
+                settings["Thread_Settings"]["clean_threads"] = 8
+            with self.assertRaises(TypeError):
+                settings["New_Settings"] = {}
+
+            write_settings(conf_dir, Thread_Settings={"clean_threads": 8})
+            changed_time = os.stat(settings_path).st_mtime_ns + 10 ** 9
+            os.utime(settings_path, ns=(changed_time, changed_time))
+            self.assertEqual(export_settings()["Thread_Settings"]["clean_threads"], 8)
+            self.assertEqual(settings["Thread_Settings"]["clean_threads"], 3)
+
+            write_settings(conf_dir, Thread_Settings={"clean_threads": "many"})
+            os.utime(settings_path, ns=(changed_time + 10 ** 9, changed_time + 10 ** 9))
+            with self.assertRaises(SettingsValueError):
+                export_settings()
+
+    def test_database_settings_extra_keys(self):
+        """
+        test keys of DataBase_Settings that DataBase does not take are ignored
+        """
+
+        with tempfile.TemporaryDirectory() as conf_dir, \
+             mock.patch.dict(os.environ, {"DKM_CONF": conf_dir}):
+            db_settings = sqlite_settings(os.path.join(conf_dir, "dkmonitor.db"))
+            db_settings["schema"] = "dkmonitor"
+            write_settings(conf_dir, DataBase_Settings=db_settings)
+            settings = export_settings()["DataBase_Settings"]
+            self.assertEqual(settings["schema"], "dkmonitor")
+            for database in (AdminStatViewer(settings), DataBaseCleaner(settings)):
+                self.assertEqual(database.db_engine.dialect.name, "sqlite")
+            buffer = StatsBuffer(settings)
+            buffer.add(stat_rows(datetime.datetime.now()))
+            buffer.flush()
+            self.assertEqual(len(table_rows(database, UserStats.__table__, "id")), 2)
+
+    def test_lazy_subcommands(self):
+        """
+        test 'python -m dkmonitor view --help' does not import the scan and clean modules
+        """
+
+        run_view_help = ("import atexit, runpy, sys\n"
+                         "atexit.register(lambda: print(*sorted(sys.modules), file=sys.stderr))\n"
+                         "sys.argv = ['dkmonitor', 'view', '--help']\n"
+                         "runpy.run_module('dkmonitor', run_name='__main__', alter_sys=True)\n")
+        with tempfile.TemporaryDirectory() as work_dir:
+            env = dict(os.environ, PYTHONPATH=os.path.abspath("."))
+            result = subprocess.run([sys.executable, "-c", run_view_help],
+                                    cwd=work_dir, env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(os.listdir(work_dir), [])
+
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("usage:", result.stdout)
+        modules = result.stderr.split()
+        self.assertIn("dkmonitor.stat_viewer", modules)
+        for module in ("dkmonitor.monitor_manager", "dkmonitor.utilities.dk_stat",
+                       "dkmonitor.utilities.dk_clean", "dkmonitor.utilities.dir_scan",
+                       "dkmonitor.utilities.relocate"):
+            self.assertNotIn(module, modules)
+
+    def test_tasks_column_migration(self):
+        """
+        test task columns added since a tasks table was created are added when it is opened
+        """
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_path = os.path.join(db_dir, "dkmonitor.db")
+            connection = sqlite3.connect(db_path)
+            connection.execute("CREATE TABLE tasks (taskname VARCHAR PRIMARY KEY, "
+                               "hostname VARCHAR, target_path VARCHAR, enabled BOOLEAN)")
+            connection.execute("INSERT INTO tasks VALUES ('old_task', 'host', '/data', 1)")
+            connection.commit()
+            connection.close()
+
+            database = DataBase(**sqlite_settings(db_path))
+            with database.session_scope() as session:
+                tasks = session.query(Tasks).all()
+            self.assertEqual([(task.taskname, task.scan_threads) for task in tasks],
+                             [("old_task", None)])
+
+    def test_logging_queue(self):
+        """Test that records of all loggers go through one queue handler to a JSON lines file"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "dkmonitor.log")
+            configure_logging({"log_file": log_path,
+                               "log_format": "json",
+                               "module_levels": "dkmonitor.test_quiet:error"})
+            for _ in range(3):
+                logger = setup_logger("dkmonitor.test_logging")
+            logger.info("stored %s rows", 5)
+            setup_logger("dkmonitor.test_quiet").warning("hidden")
+            self.assertEqual(len(logging.getLogger("dkmonitor").handlers), 1)
+            stop_logging()
+
+            with open(log_path, "r") as log_file:
+                entries = [json.loads(line) for line in log_file]
+            self.assertEqual([entry["message"] for entry in entries], ["stored 5 rows"])
+            self.assertEqual(entries[0]["logger"], "dkmonitor.test_logging")
+
+    def test_logging_restart(self):
+        """Test that the same settings start logging again after stop_logging"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_settings = {"log_file": os.path.join(log_dir, "dkmonitor.log")}
+            configure_logging(log_settings)
+            stop_logging()
+            configure_logging(log_settings)
+            setup_logger("dkmonitor.test_restart").info("restarted")
+            self.assertEqual(len(logging.getLogger("dkmonitor").handlers), 1)
+            stop_logging()
+
+            with open(log_settings["log_file"], "r") as log_file:
+                self.assertIn("restarted", log_file.read())
+
     def test_setup_logger(self):
         """Test logging setup function"""
         assert(isinstance(setup_logger(LOG_FILE_NAME), logging.Logger))